@@ -0,0 +1,137 @@
+"""Benchmarks the exported QFAT inference forward (see `qfat.models.export`) against the eager
+`QFAT.forward`, on a randomly initialized model with a full context. The "onnx" method runs
+the graph of `export_onnx` with ONNX Runtime and samples with numpy (on the CPU).
+
+Usage:
+    python scripts/benchmark_export.py --batch-size 1 --context-len 10 --device cuda
+    python scripts/benchmark_export.py --methods torchscript onnx
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+import torch
+from omegaconf import OmegaConf
+
+from qfat.conf.configs import (
+    DecoderBlockCfg,
+    IdentityEncoderCfg,
+    MultiheadAttentionCfg,
+    OptimizerCfg,
+)
+from qfat.datasets.dataset import Batch
+from qfat.models.export import export_onnx, export_qfat, sample_gmm_tensors
+from qfat.models.qfat import QFAT
+
+logger = logging.getLogger(__name__)
+
+
+def timeit(fn: Callable, device: str, repeats: int) -> float:
+    fn()  # warmup
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--context-len", type=int, default=10)
+    parser.add_argument("--input-dim", type=int, default=60)
+    parser.add_argument("--out-dim", type=int, default=9)
+    parser.add_argument("--mixtures", type=int, default=4)
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--embed-dim", type=int, default=128)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument(
+        "--methods", type=str, nargs="+", default=["compile", "torchscript", "export"]
+    )
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(0)
+
+    model = QFAT(
+        context_len=args.context_len,
+        input_dim=args.input_dim,
+        n_layer=args.n_layer,
+        out_dim=args.out_dim,
+        mixture_size=args.mixtures,
+        embd_dropout=0,
+        encoder_cfg=IdentityEncoderCfg(),
+        decoder_block_cfg=OmegaConf.structured(
+            DecoderBlockCfg(
+                mha_cfg=MultiheadAttentionCfg(
+                    embed_dim=args.embed_dim, num_heads=args.num_heads
+                )
+            )
+        ),
+        optimizer_cfg=OptimizerCfg(n_epochs=1),
+    )
+    model.to(args.device)
+    model.eval()
+    x = torch.randn(
+        args.batch_size, args.context_len, args.input_dim, device=args.device
+    )
+
+    def eager():
+        out = model(Batch(x=x))
+        model.get_distribution(out.output, last_only=True).sample()
+
+    with torch.inference_mode():
+        t_eager = timeit(eager, args.device, args.repeats)
+        reference = model(Batch(x=x)).output[:, -1]
+    logger.info(
+        f"B={args.batch_size} T={args.context_len} | eager {1e3 * t_eager:7.3f} ms"
+    )
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    for method in args.methods:
+        start = time.perf_counter()
+        if method == "onnx":
+            from qfat.deploy.onnx_policy import OnnxPolicy, sample_gmm_numpy
+
+            policy = OnnxPolicy(export_onnx(model, Path(tmp_dir.name) / "qfat.onnx", x))
+            x_numpy = x.cpu().numpy()
+
+            def exported():
+                sample_gmm_numpy(*policy.predict(x_numpy))
+
+            def fn(x):
+                return [torch.from_numpy(a) for a in policy.predict(x.cpu().numpy())]
+        else:
+            fn = export_qfat(model, x, method=method)
+
+            def exported():
+                sample_gmm_tensors(*fn(x=x))
+
+        t_export = time.perf_counter() - start
+
+        with torch.inference_mode():
+            t_exported = timeit(exported, args.device, args.repeats)
+            locs, mixture_probs, variances = (a.to(args.device) for a in fn(x=x))
+        max_diff = max(
+            (locs - reference.locs).abs().max().item(),
+            (mixture_probs - reference.mixture_probs).abs().max().item(),
+            (variances - reference.variances).abs().max().item(),
+        )
+        logger.info(
+            f"B={args.batch_size} T={args.context_len} | {method:11s} "
+            f"{1e3 * t_exported:7.3f} ms ({t_eager / t_exported:5.2f}x) | "
+            f"export {t_export:6.2f} s | max abs diff {max_diff:.2e}"
+        )
+    tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
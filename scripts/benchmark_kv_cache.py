@@ -0,0 +1,116 @@
+"""Benchmarks the cached decoding of `AutoRegressiveSampler` (use_kv_cache) against the full
+forward over the context, on a randomly initialized QFAT and a closed loop of random
+observations.
+
+The latencies are reported separately for the warm-up steps, while the context fills up and
+the decoding is incremental, and for the steady state, where the window slides at every step
+and the keys and values of the whole window are recomputed.
+
+Usage:
+    python scripts/benchmark_kv_cache.py --context-len 10 --steps 100 --device cuda
+    python scripts/benchmark_kv_cache.py --context-len 64 --n-layer 8
+"""
+
+import argparse
+import logging
+import time
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from qfat.conf.configs import (
+    DecoderBlockCfg,
+    IdentityEncoderCfg,
+    MultiheadAttentionCfg,
+    OptimizerCfg,
+)
+from qfat.models.qfat import QFAT
+from qfat.samplers.sampler import AutoRegressiveSampler
+
+logger = logging.getLogger(__name__)
+
+
+def run_episode(
+    sampler: AutoRegressiveSampler, observations: np.ndarray, device: str
+) -> Tuple[List[float], List[torch.Tensor]]:
+    """Samples every step of an episode, returning the step latencies and the GMM locs."""
+    sampler.reset()
+    latencies, locs = [], []
+    for obs in observations:
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        _, out, _ = sampler.sample(obs)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - start)
+        locs.append(out.output.locs[:, -1].cpu())
+    return latencies, locs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--context-len", type=int, default=10)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--input-dim", type=int, default=60)
+    parser.add_argument("--out-dim", type=int, default=9)
+    parser.add_argument("--mixtures", type=int, default=4)
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--embed-dim", type=int, default=128)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(0)
+
+    model = QFAT(
+        context_len=args.context_len,
+        input_dim=args.input_dim,
+        n_layer=args.n_layer,
+        out_dim=args.out_dim,
+        mixture_size=args.mixtures,
+        embd_dropout=0,
+        encoder_cfg=IdentityEncoderCfg(),
+        decoder_block_cfg=OmegaConf.structured(
+            DecoderBlockCfg(
+                mha_cfg=MultiheadAttentionCfg(
+                    embed_dim=args.embed_dim, num_heads=args.num_heads
+                )
+            )
+        ),
+        optimizer_cfg=OptimizerCfg(n_epochs=1),
+    )
+    model.to(args.device)
+    model.eval()
+    observations = (
+        np.random.default_rng(0)
+        .standard_normal((args.steps, args.input_dim))
+        .astype(np.float32)
+    )
+
+    results = {}
+    for use_kv_cache in [False, True]:
+        sampler = AutoRegressiveSampler(
+            model, sample_fn="gmm", use_kv_cache=use_kv_cache
+        )
+        run_episode(sampler, observations[: args.context_len + 1], args.device)
+        results[use_kv_cache] = run_episode(sampler, observations, args.device)
+
+    max_diff = max(
+        (a - b).abs().max().item() for a, b in zip(results[False][1], results[True][1])
+    )
+    warmup = slice(0, args.context_len)
+    steady = slice(args.context_len, None)
+    for name, steps in [("warm-up", warmup), ("steady", steady)]:
+        t_full = np.mean(results[False][0][steps])
+        t_cached = np.mean(results[True][0][steps])
+        logger.info(
+            f"T={args.context_len} {name:7s} | full {1e3 * t_full:7.3f} ms | "
+            f"cached {1e3 * t_cached:7.3f} ms ({t_full / t_cached:5.2f}x)"
+        )
+    logger.info(f"max abs diff of the locs {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmarks the per-step sampling latency of QFAT in the lower inference precisions of
+`quantize_qfat` against float32, on a randomly initialized model and random contexts.
+
+The accuracy of a trained model should be checked on held-out data with `compare_precision`,
+e.g through the 'precision_check_dataset_cfg' of the inference entrypoint.
+
+Usage:
+    python scripts/benchmark_quantization.py --context-len 10 --embed-dim 256
+"""
+
+import argparse
+import logging
+import time
+from typing import Callable
+
+import torch
+from omegaconf import OmegaConf
+
+from qfat.conf.configs import (
+    DecoderBlockCfg,
+    IdentityEncoderCfg,
+    MultiheadAttentionCfg,
+    OptimizerCfg,
+)
+from qfat.models.qfat import QFAT
+from qfat.models.quantization import quantize_qfat
+
+logger = logging.getLogger(__name__)
+
+
+def timeit(fn: Callable, repeats: int) -> float:
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--context-len", type=int, default=10)
+    parser.add_argument("--input-dim", type=int, default=60)
+    parser.add_argument("--out-dim", type=int, default=9)
+    parser.add_argument("--mixtures", type=int, default=4)
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--precisions", type=str, nargs="+", default=["bf16", "int8"])
+    parser.add_argument("--sample-fn", type=str, default="gmm")
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(0)
+
+    model = QFAT(
+        context_len=args.context_len,
+        input_dim=args.input_dim,
+        n_layer=args.n_layer,
+        out_dim=args.out_dim,
+        mixture_size=args.mixtures,
+        embd_dropout=0,
+        encoder_cfg=IdentityEncoderCfg(),
+        decoder_block_cfg=OmegaConf.structured(
+            DecoderBlockCfg(
+                mha_cfg=MultiheadAttentionCfg(
+                    embed_dim=args.embed_dim, num_heads=args.num_heads
+                )
+            )
+        ),
+        optimizer_cfg=OptimizerCfg(n_epochs=1),
+        sample_fn=args.sample_fn,
+    )
+    model.eval()
+    x = torch.randn(args.batch_size, args.context_len, args.input_dim)
+
+    t_fp32 = timeit(lambda: model.sample(x=x, return_output=False), args.repeats)
+    with torch.inference_mode():
+        reference = model._sampling_forward(x).output
+    logger.info(
+        f"B={args.batch_size} T={args.context_len} | fp32 {1e3 * t_fp32:7.3f} ms"
+    )
+
+    for precision in args.precisions:
+        quantized = quantize_qfat(model, precision)
+        t = timeit(lambda: quantized.sample(x=x, return_output=False), args.repeats)
+        with torch.inference_mode():
+            params = quantized._sampling_forward(x).output
+        errors = " ".join(
+            f"{name} {(getattr(params, name) - getattr(reference, name)).abs().max().item():.2e}"
+            for name in ("locs", "mixture_probs", "variances")
+        )
+        logger.info(
+            f"B={args.batch_size} T={args.context_len} | {precision:4s} "
+            f"{1e3 * t:7.3f} ms ({t_fp32 / t:5.2f}x) | max abs err {errors}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Manages the local model registry (see `qfat.registry`), from which the inference entrypoint
+and the rollout callback load models without network access.
+
+Usage:
+    python scripts/model_registry.py pull --run-id entity/project/abc123 --afid entity/project/model_epoch_10_abc123:v0
+    python scripts/model_registry.py list
+    python scripts/model_registry.py tag my_policy 3f2a9c
+"""
+
+import argparse
+import json
+import logging
+
+from qfat.constants import MODEL_REGISTRY_PATH
+from qfat.registry import ModelRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", type=str, default=str(MODEL_REGISTRY_PATH))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pull = subparsers.add_parser("pull", help="Fetches a model from wandb.")
+    pull.add_argument("--run-id", type=str, required=True)
+    pull.add_argument("--afid", type=str, required=True)
+    subparsers.add_parser("list", help="Lists the registered models.")
+    tag = subparsers.add_parser("tag", help="Names a registered model.")
+    tag.add_argument("name", type=str)
+    tag.add_argument("digest", type=str)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    registry = ModelRegistry(args.root)
+    if args.command == "pull":
+        entry = registry.fetch_from_wandb(args.run_id, args.afid)
+        logger.info(f"Registered '{args.afid}' as {entry.digest} in {entry.path}")
+    elif args.command == "list":
+        for manifest in registry.list():
+            print(json.dumps(manifest))
+    elif args.command == "tag":
+        registry.tag(args.name, registry.get(args.digest).digest)
+        logger.info(f"Tagged {args.digest} as '{args.name}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,22 @@
 import logging
 from typing import List, Literal, Optional
 
+import gym
 import hydra
 import numpy as np
 import pandas as pd
 import torch
-from tqdm import tqdm
 
 import wandb
 from qfat.callbacks.callbacks import Callback
 from qfat.conf.configs import EnvCfg, SamplerCfg
+from qfat.constants import MODEL_REGISTRY_PATH
 from qfat.entrypoints.training import TrainingEntrypoint
-from qfat.environments.goal_conditional import GoalAppendingWrapper
 from qfat.models.generative_model import ModelOutput
+from qfat.registry import ModelRegistry
+from qfat.rollout.rollout import EpisodeResult, SerialRollout, VectorizedRollout
+from qfat.rollout.workers import RolloutWorkerPool
+from qfat.samplers.sampler import BatchedAutoRegressiveSampler
 from qfat.utils import compute_component_variances
 
 logger = logging.getLogger(__name__)
@@ -79,6 +83,12 @@ class RolloutCallback(Callback):
         min_sequence_length: int = 1,
         max_sequence_length: int = 1,
         skip: int = 0,
+        n_envs: int = 1,
+        model_ref: Optional[str] = None,
+        registry_path: str = str(MODEL_REGISTRY_PATH),
+        n_workers: int = 0,
+        worker_threads: int = 1,
+        max_pending: int = 2,
         **kwargs,
     ):
         """Rolls out the model in an environment and computes the average collected rewards per episode.
@@ -99,6 +109,18 @@ class RolloutCallback(Callback):
             max_sequence_length (int, optional): The maximum task-completion sequence length to be considered in the
                 entropy computations. Defaults to 1.
             skip (int, optional): How many epochs to skip before invoking the callback during training. Defaults to 0.
+            n_envs (int, optional): The number of environment copies to roll out concurrently, with one batched
+                model call per step. If larger than 1, the sampler config must target a BatchedAutoRegressiveSampler.
+                Defaults to 1.
+            model_ref (Optional[str], optional): The name (or digest) of a model in the local model registry to roll
+                out instead of the trained model, e.g as a baseline. Defaults to None.
+            registry_path (str, optional): The directory of the model registry. Defaults to MODEL_REGISTRY_PATH.
+            n_workers (int, optional): If positive, the rollouts run on a snapshot of the model in that many
+                background processes while the training continues, and their results are logged against the epoch
+                of the snapshot once they finish. Defaults to 0, i.e the rollouts block the training.
+            worker_threads (int, optional): The number of torch threads of every rollout worker. Defaults to 1.
+            max_pending (int, optional): The maximum number of epochs whose rollouts run at once, the training
+                waits for the oldest ones beyond that. Defaults to 2.
         """
         self.env_cfg = env_cfg
         self.sampler_cfg = sampler_cfg
@@ -113,8 +135,29 @@ class RolloutCallback(Callback):
         self.min_sequence_length = min_sequence_length
         self.max_sequence_length = max_sequence_length
         self.skip = skip
+        self.n_envs = n_envs
+        self.model_ref = model_ref
+        self.registry_path = registry_path
+        self._registry_model: Optional[torch.nn.Module] = None
+        self.n_workers = n_workers
+        self.worker_threads = worker_threads
+        self.max_pending = max_pending
+        self.pool: Optional[RolloutWorkerPool] = None
         super().__init__()
 
+    def rollout_model(self, ep: TrainingEntrypoint) -> torch.nn.Module:
+        """Returns the model to roll out, the registered one of 'model_ref' if set (loaded once)
+        and the trained one otherwise."""
+        if self.model_ref is None:
+            return ep.model
+        if self._registry_model is None:
+            self._registry_model = (
+                ModelRegistry(self.registry_path)
+                .get(self.model_ref)
+                .load_model(ep.cfg.device)
+            )
+        return self._registry_model
+
     def reduce_episode_rewards(self, episode_rewards: List[float]) -> float:
         if self.reward_reduction == "mean":
             val = sum(episode_rewards) / len(episode_rewards)
@@ -126,92 +169,155 @@ class RolloutCallback(Callback):
             val = sum(episode_rewards)
         return val
 
+    def _record_completed_tasks(self, task: List[str]) -> None:
+        if len(task) >= self.min_sequence_length:
+            if len(task) > self.max_sequence_length:
+                task = task[: self.max_sequence_length + 1]
+            task_str = "->".join(task)
+            self.completed_tasks.append(task_str)
+
+    def _check_envs(self, envs: List[gym.Env]) -> None:
+        if self.log_entropy and not all(
+            hasattr(env, "completed_tasks") for env in envs
+        ):
+            raise Exception(
+                "Environment must have a 'completed_tasks' attribute when log_entropy is True."
+            )
+
+    def _serial_rollouts(self, ep: TrainingEntrypoint) -> List[EpisodeResult]:
+        """Runs the rollouts one after the other."""
+        env = hydra.utils.instantiate(self.env_cfg, _recursive_=True, _convert_="none")
+        self._check_envs([env])
+        sampler = hydra.utils.instantiate(
+            self.sampler_cfg,
+            model=self.rollout_model(ep),
+            _recursive_=False,
+            _convert_="none",
+        )
+        try:
+            return SerialRollout(
+                env=env,
+                sampler=sampler,
+                max_steps=self.max_steps,
+                is_goal_conditional=self.is_goal_conditional,
+            ).run(n_episodes=self.n_rollouts)
+        finally:
+            env.close()
+
+    def _vectorized_rollouts(self, ep: TrainingEntrypoint) -> List[EpisodeResult]:
+        """Runs the rollouts in n_envs environment copies."""
+        envs = [
+            hydra.utils.instantiate(self.env_cfg, _recursive_=True, _convert_="none")
+            for _ in range(self.n_envs)
+        ]
+        self._check_envs(envs)
+        sampler = hydra.utils.instantiate(
+            self.sampler_cfg,
+            model=self.rollout_model(ep),
+            batch_size=self.n_envs,
+            _recursive_=False,
+            _convert_="none",
+        )
+        if not isinstance(sampler, BatchedAutoRegressiveSampler):
+            raise Exception(
+                "For n_envs > 1, the sampler must be an instance of the class BatchedAutoRegressiveSampler"
+            )
+        try:
+            return VectorizedRollout(
+                envs=envs,
+                sampler=sampler,
+                max_steps=self.max_steps,
+                is_goal_conditional=self.is_goal_conditional,
+            ).run(n_episodes=self.n_rollouts)
+        finally:
+            for env in envs:
+                env.close()
+
+    def _submit_rollouts(self, ep: TrainingEntrypoint) -> None:
+        """Hands a snapshot of the model to the rollout workers, waiting for the oldest pending
+        rollouts first if 'max_pending' of them are still running."""
+        if self.pool is None:
+            self.pool = RolloutWorkerPool(self.n_workers, self.worker_threads)
+            # the results arrive later, they are plotted against the epoch of the snapshot
+            wandb.define_metric("rollout/epoch")
+            for name in (self.reward_metric, "val/task_entropy"):
+                wandb.define_metric(name, step_metric="rollout/epoch")
+        for epoch, results in self.pool.collect(max_pending=self.max_pending - 1):
+            self._log_results(results, epoch)
+        model_cfg = ep.cfg.model_cfg
+        if self.model_ref is not None:
+            registry = ModelRegistry(self.registry_path)
+            model_cfg = registry.get(self.model_ref).load_config().model_cfg
+        self.pool.submit(
+            ep.epoch,
+            self.rollout_model(ep),
+            model_cfg,
+            n_episodes=self.n_rollouts,
+            seed=ep.cfg.seed + ep.epoch * self.n_workers,
+            env_cfg=self.env_cfg,
+            sampler_cfg=self.sampler_cfg,
+            max_steps=self.max_steps,
+            is_goal_conditional=self.is_goal_conditional,
+            n_envs=self.n_envs,
+        )
+
+    @property
+    def reward_metric(self) -> str:
+        return f"val/average_{self.reward_reduction}_reward"
+
+    def _log_results(
+        self, results: List[EpisodeResult], epoch: Optional[int] = None
+    ) -> None:
+        """Logs the average reduced reward (and the task entropy) of the episodes, against the
+        epoch of the rolled out model if it is passed."""
+        episodes_reward = 0
+        for result in results:
+            if self.log_entropy:
+                self._record_completed_tasks(result.completed_tasks)
+            episodes_reward += self.reduce_episode_rewards(
+                episode_rewards=result.rewards
+            )
+        metrics = {self.reward_metric: episodes_reward / len(results)}
+        if self.log_entropy:
+            df = pd.DataFrame({"completed_task": self.completed_tasks})
+            df = df.value_counts().reset_index()
+            df["probability"] = df["count"] / df["count"].sum()
+            entropy = (
+                -(df["probability"].values * np.log2(df["probability"].values))
+                .sum()
+                .item()
+            )
+            metrics["val/task_entropy"] = entropy
+        self.completed_tasks = []
+        if epoch is not None:
+            metrics["rollout/epoch"] = epoch
+        wandb.log(metrics)
+
     def __call__(self, ep: TrainingEntrypoint):
+        if self.pool is not None:
+            for epoch, results in self.pool.collect():
+                self._log_results(results, epoch)
         if ep.epoch >= self.skip:
             if ep.epoch % self.frequency == 0 and ep.epoch != 0:
-                logger.info("Rolling out model on the environment")
-                self.env = hydra.utils.instantiate(
-                    self.env_cfg, _recursive_=True, _convert_="none"
-                )
-                if self.log_entropy:
-                    if not hasattr(self.env, "completed_tasks"):
-                        raise Exception(
-                            "Environment must have a 'completed_tasks' attribute when log_entropy is True."
-                        )
-                if self.is_goal_conditional:
-                    if not isinstance(self.env, GoalAppendingWrapper):
-                        raise Exception(
-                            "For goal conditional tasks, the environment must be an instance of the class GoalAppendingWrapper"
-                        )
-                self.sampler = hydra.utils.instantiate(
-                    self.sampler_cfg,
-                    model=ep.model,
-                    _recursive_=False,
-                    _convert_="none",
-                )
-                episodes_reward = 0
-                for _ in tqdm(range(self.n_rollouts), desc="Model Rollouts"):
-                    s = self.env.reset()
-                    self.sampler.reset()
-                    done = False
-                    step = 0
-                    episode_reward = []
-                    s_context = [s]
-                    while not done and step < self.max_steps:
-                        model_kwargs = {}
-                        if self.is_goal_conditional:
-                            model_kwargs = {"conditional_seq": self.env.current_goal}
-                        a, *_ = self.sampler.sample(
-                            x=s_context, model_kwargs=model_kwargs
-                        )
-                        a: List[np.ndarray] = np.split(
-                            a.squeeze(), self.sampler.horizon + 1
-                        )
-                        horizon = 0
-                        s_context = []
-                        while (
-                            not done
-                            and step < self.max_steps
-                            and horizon < self.sampler.horizon + 1
-                        ):
-                            a_h = a[horizon]
-                            s, r, *_ = self.env.step(a_h)
-                            episode_reward.append(r)
-                            s_context.append(s)
-                            step += 1
-                            horizon += 1
-
-                    if self.log_entropy:
-                        task = self.env.completed_tasks
-                        if len(task) >= self.min_sequence_length:
-                            if len(task) > self.max_sequence_length:
-                                task = task[: self.max_sequence_length + 1]
-                            task_str = "->".join(task)
-                            self.completed_tasks.append(task_str)
-
-                    episodes_reward += self.reduce_episode_rewards(
-                        episode_rewards=episode_reward
+                if self.n_workers > 0:
+                    logger.info(
+                        f"Submitting the rollouts of epoch {ep.epoch} to the rollout workers"
                     )
-                average_reward = episodes_reward / self.n_rollouts
-                wandb.log(
-                    {f"val/average_{self.reward_reduction}_reward": average_reward}
-                )
+                    self._submit_rollouts(ep)
+                    return
+                logger.info("Rolling out model on the environment")
+                if self.n_envs > 1:
+                    results = self._vectorized_rollouts(ep)
+                else:
+                    results = self._serial_rollouts(ep)
+                self._log_results(results)
 
-                if self.log_entropy:
-                    df = pd.DataFrame({"completed_task": self.completed_tasks})
-                    df = df.value_counts().reset_index()
-                    df["probability"] = df["count"] / df["count"].sum()
-                    entropy = (
-                        -(df["probability"].values * np.log2(df["probability"].values))
-                        .sum()
-                        .item()
-                    )
-                    wandb.log(
-                        {
-                            "val/task_entropy": entropy,
-                        }
-                    )
-                self.completed_tasks = []
-                self.sampler = None
-                self.env.close()
-                self.env = None
+    def finalize(self) -> None:
+        """Waits for the pending rollouts of the workers and logs them."""
+        if self.pool is None:
+            return
+        logger.info(f"Waiting for the rollouts of {self.pool.n_pending} epoch(s)")
+        for epoch, results in self.pool.collect(wait=True):
+            self._log_results(results, epoch)
+        self.pool.shutdown()
+        self.pool = None
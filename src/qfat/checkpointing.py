@@ -0,0 +1,141 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Deque, List, Optional, Union
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_state(state: Any) -> Any:
+    """Copies every tensor of a (nested) state dict to the cpu, such that the training can keep
+    updating the original tensors while the copy is serialized."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot_state(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(v) for v in state)
+    return state
+
+
+class AsyncCheckpointWriter:
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        max_checkpoints: Optional[int] = None,
+        max_pending: int = 2,
+        blocking: bool = False,
+    ) -> None:
+        """Writes checkpoints from a background thread, such that the training loop only waits
+        for the copy of the state to the cpu.
+
+        Checkpoints are written in submission order to a temporary file that is then renamed, so
+        a checkpoint on disk is always complete. A callback can be attached to every checkpoint,
+        e.g to log it to wandb, which runs on the writer thread once the file is written.
+
+        Args:
+            directory (Union[str, Path]): Where to write the checkpoints.
+            max_checkpoints (Optional[int]): How many of the rotating checkpoints to keep on disk,
+                the oldest are deleted. Defaults to None, i.e all of them.
+            max_pending (int): How many checkpoints can wait to be written, `save` blocks on the
+                oldest beyond that, which bounds the memory of the snapshots. Defaults to 2.
+            blocking (bool): Whether to write on the calling thread instead, e.g for debugging.
+                Defaults to False.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_checkpoints = max_checkpoints
+        self.max_pending = max_pending
+        self.blocking = blocking
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt")
+        self._pending: List[Future] = []
+        self._rotating: Deque[Path] = deque()
+
+    def save(
+        self,
+        state: Any,
+        filename: str,
+        on_saved: Optional[Callable[[Path, Any], None]] = None,
+        rotate: bool = False,
+    ) -> Future:
+        """Snapshots a state and schedules its write.
+
+        Args:
+            state (Any): The state, e.g a dict of state dicts.
+            filename (str): The name of the file in the directory.
+            on_saved (Optional[Callable[[Path, Any], None]]): Called with the path and the
+                snapshot once the file is written. Defaults to None.
+            rotate (bool): Whether the checkpoint counts towards 'max_checkpoints'. Defaults
+                to False.
+
+        Returns:
+            Future: The future of the write.
+
+        Raises:
+            Exception: The exception of a previous write that failed.
+        """
+        self._raise_failed()
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+        snapshot = snapshot_state(state)
+        path = self.directory / filename
+        if self.blocking:
+            future = Future()
+            future.set_result(self._write(snapshot, path, on_saved, rotate))
+        else:
+            future = self._executor.submit(
+                self._write, snapshot, path, on_saved, rotate
+            )
+        self._pending.append(future)
+        return future
+
+    def _write(
+        self,
+        snapshot: Any,
+        path: Path,
+        on_saved: Optional[Callable[[Path, Any], None]],
+        rotate: bool,
+    ) -> Path:
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f"Wrote checkpoint {path}")
+        if on_saved is not None:
+            on_saved(path, snapshot)
+        if rotate:
+            if path in self._rotating:
+                self._rotating.remove(path)
+            self._rotating.append(path)
+            while (
+                self.max_checkpoints is not None
+                and len(self._rotating) > self.max_checkpoints
+            ):
+                old_path = self._rotating.popleft()
+                old_path.unlink(missing_ok=True)
+                logger.info(f"Removed checkpoint {old_path}")
+        return path
+
+    def _raise_failed(self) -> None:
+        for future in [f for f in self._pending if f.done()]:
+            self._pending.remove(future)
+            future.result()
+
+    def wait(self) -> None:
+        """Blocks until all the scheduled checkpoints are written.
+
+        Raises:
+            Exception: The exception of a write that failed.
+        """
+        while self._pending:
+            self._pending.pop(0).result()
+
+    def close(self) -> None:
+        """Waits for the scheduled checkpoints and stops the writer thread."""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
@@ -3,11 +3,13 @@ from hydra.core.config_store import ConfigStore
 from qfat.conf.configs import (
     AntTrajectoryDatasetCfg,
     AutoRegressiveSamplerCfg,
+    BatchedAutoRegressiveSamplerCfg,
     ConcatPrevActionsTransformCfg,
     DataLoaderCfg,
     DecoderBlockCfg,
     DualContextAutoRegressiveSamplerCfg,
     DummyDatasetCfg,
+    ExportedSamplerCfg,
     GoalConditionalEnvCfg,
     HeirarchicalResNetEncoderCfg,
     IdentityEncoderCfg,
@@ -189,6 +191,13 @@ def register_all():
         group=SAMPLER_GROUP,
         node=AutoRegressiveSamplerCfg,
     )
+    CONFIG_STORE.store(
+        name=BatchedAutoRegressiveSamplerCfg.__name__,
+        package=CONF_PACKAGE,
+        provider=PROVIDER,
+        group=SAMPLER_GROUP,
+        node=BatchedAutoRegressiveSamplerCfg,
+    )
     CONFIG_STORE.store(
         name=DualContextAutoRegressiveSamplerCfg.__name__,
         package=CONF_PACKAGE,
@@ -196,6 +205,13 @@ def register_all():
         group=SAMPLER_GROUP,
         node=DualContextAutoRegressiveSamplerCfg,
     )
+    CONFIG_STORE.store(
+        name=ExportedSamplerCfg.__name__,
+        package=CONF_PACKAGE,
+        provider=PROVIDER,
+        group=SAMPLER_GROUP,
+        node=ExportedSamplerCfg,
+    )
 
     # environments
     CONFIG_STORE.store(
@@ -6,6 +6,7 @@ from omegaconf import MISSING
 from qfat.constants import (
     ANT_DATA_PATH,
     KITCHEN_DATA_PATH,
+    MODEL_REGISTRY_PATH,
     PUSHT_DATA_PATH,
     UR3_DATA_PATH,
 )
@@ -50,6 +51,9 @@ class IdentityEncoderCfg(EncoderCfg):
 class HeirarchicalResNetEncoderCfg(EncoderCfg):
     _target_: str = "qfat.models.encoders.HierarchicalResNet"
     freeze_weights: bool = True
+    input_resolution: Optional[int] = 224  # None keeps the native image resolution
+    channels_last: bool = False
+    use_bfloat16: bool = False
 
 
 @dataclass
@@ -96,6 +100,7 @@ class QFATCfg(ModelCfg):
     history_mask_prob: float = (
         0.0  # masking each element in the history of the states with this probability
     )
+    compile_loss: bool = False  # whether to torch.compile the fused GMM loss
 
 
 @dataclass
@@ -149,6 +154,8 @@ class KitchenTrajectoryDatasetCfg(TrajectoryDatasetCfg):
     data_dir: str = KITCHEN_DATA_PATH
     mode: Optional[str] = None
     stats_path: str = str(KITCHEN_DATA_PATH / "data_stats.json")
+    image_cache_bytes: int = 2**30  # total over the dataloader workers, split evenly
+    prefetch_chunks: int = 1
 
 
 @dataclass
@@ -165,6 +172,7 @@ class PushTTrajectoryDatasetCfg(TrajectoryDatasetCfg):
     embedding_path: str = str(PUSHT_DATA_PATH / "resnet_embeddings")
     include_goals: bool = False
     include_prev_actions: bool = False
+    cache_dir: Optional[str] = str(PUSHT_DATA_PATH / "cache")
 
 
 @dataclass
@@ -185,6 +193,9 @@ class SlicedTrajectoryDatasetCfg:
     only_sample_tail: bool = (
         False  #  Whether to only sample the tail for the future goal sequence.
     )
+    batched_fetch: bool = (
+        False  # build whole batches in the dataset instead of per window
+    )
 
 
 @dataclass
@@ -250,6 +261,30 @@ class AutoRegressiveSamplerCfg(SamplerCfg):
     horizon: int = 0
     use_tensors: bool = False
     sample_fn: str = "modes"
+    use_kv_cache: bool = False  # incremental decoding until the context is full
+
+
+@dataclass
+class BatchedAutoRegressiveSamplerCfg(SamplerCfg):
+    """batch_size is filled in by the caller from the number of environments"""
+
+    _target_: str = "qfat.samplers.sampler.BatchedAutoRegressiveSampler"
+    batch_size: int = MISSING
+    context_len: Optional[int] = None
+    temperature: float = 1
+    horizon: int = 0
+    use_tensors: bool = False
+    sample_fn: str = "gmm"
+
+
+@dataclass
+class ExportedSamplerCfg(SamplerCfg):
+    _target_: str = "qfat.samplers.sampler.ExportedSampler"
+    context_len: Optional[int] = None
+    temperature: float = 1
+    horizon: int = 0
+    sample_fn: str = "modes"  # "modes", "gmm" or "mean"
+    method: str = "compile"  # "compile", "torchscript" or "export"
 
 
 @dataclass
@@ -293,9 +328,39 @@ class TrainingEntrypointCfg(EntrypointCfg):
         1  # every how many batches should you log the train loss to wandb.
     )
     collate_fn_name: str = "collate_policy"
+    device_resident_data: bool = (
+        False  # upload the whole dataset to the device once, bypassing the DataLoader
+    )
+    window_store_dir: Optional[str] = (
+        None  # if set, the sliced windows are compiled into memory-mapped arrays there
+    )
+    embedding_cache_dir: Optional[str] = (
+        None  # if set, the frozen image encoder features are precomputed and cached there
+    )
     log_best_model: bool = (
         False  # wether to log the best model every n_save_model epochs
     )
+    registry_path: Optional[str] = (
+        None  # if set, the logged models are also stored in the local model registry there
+    )
+    precision: str = "fp32"  # "fp32", "bf16" or "fp16" (with loss scaling, not on cpu)
+    grad_accumulation_steps: int = (
+        1  # optimizer steps every n batches, the effective batch size is n * batch_size
+    )
+    distributed_backend: Optional[str] = (
+        None  # e.g "gloo", trains data-parallel on the processes launched by torchrun
+    )
+    find_unused_parameters: bool = False  # passed to DistributedDataParallel
+    val_subsample: Optional[int] = (
+        None  # if set, validates on a fixed random subset of that many windows, cached on the device
+    )
+    checkpoint_dir: Optional[str] = None  # defaults to the directory of the wandb run
+    max_local_checkpoints: Optional[int] = (
+        None  # how many epoch checkpoints to keep on disk, the oldest are deleted
+    )
+    async_checkpointing: bool = (
+        True  # write and log the checkpoints from a background thread
+    )
 
 
 @dataclass
@@ -307,8 +372,10 @@ class ConditionalEnvParams:
 @dataclass
 class InferenceEntrypointCfg(EntrypointCfg):
     device: str = "cpu"
-    training_run_id: str = MISSING
-    model_afid: str = MISSING
+    training_run_id: Optional[str] = None  # only needed to fetch the model from wandb
+    model_afid: str = MISSING  # the registered name (or digest) of the model
+    registry_path: str = str(MODEL_REGISTRY_PATH)
+    wandb_fallback: bool = False  # fetch the model from wandb if it is not registered
     sampler_cfg: SamplerCfg = MISSING
     env_cfg: EnvCfg = MISSING
     render_mode: Optional[str] = "human"  # or rgb_array or None
@@ -316,3 +383,7 @@ class InferenceEntrypointCfg(EntrypointCfg):
     max_steps_per_episode: int = MISSING
     callbacks: Optional[Dict[str, List]] = None
     conditional_env_params: Optional[ConditionalEnvParams] = None
+    precision: str = "fp32"  # "fp32", "bf16" or "int8" (dynamic quantization, cpu only)
+    precision_check_dataset_cfg: Optional[TrajectoryDatasetCfg] = (
+        None  # held-out data to compare the GMM parameters of the precision against fp32
+    )
@@ -8,3 +8,4 @@ PUSHT_DATA_PATH = DATA_PATH / "pusht"
 ANT_DATA_PATH = DATA_PATH / "ant"
 UR3_DATA_PATH = DATA_PATH / "ur3"
 DERIVED_DATA_PATH = PROJECT_PATH / "derived_data"
+MODEL_REGISTRY_PATH = PROJECT_PATH / "model_registry"
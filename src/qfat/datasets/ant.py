@@ -47,6 +47,12 @@ class AntTrajectoryDataset(TrajectoryDataset):
     def include_goals(self):
         return self._include_goals
 
+    def data_files(self) -> List[Path]:
+        return [
+            self.data_dir / name
+            for name in ["a_save.npy", "ob_save.npy", "goal_save.npy", "mask_save.npy"]
+        ]
+
     def _load_data(self) -> Tuple[NDArray, NDArray, NDArray, NDArray]:
         """Load data from files."""
         actions = np.load(self.data_dir / "a_save.npy")
@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass, fields
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.utils
@@ -98,6 +99,16 @@ class TrajectoryDataset(Dataset, metaclass=ABCMeta):
         """
         return len(self.trajectories[idx])
 
+    def data_files(self) -> List[Path]:
+        """The files the trajectories are read from, such that the stores compiled from the
+        dataset (e.g `compile_window_store`) are recompiled when the raw data changes.
+
+        Returns:
+            List[Path]: The data files, empty if the dataset doesn't read any (e.g generated
+                trajectories) or doesn't list them.
+        """
+        return []
+
     def split(
         self, **kwargs
     ) -> Tuple["SubsetTrajectoryDataset", "SubsetTrajectoryDataset"]:
@@ -132,6 +143,26 @@ class SubsetTrajectoryDataset(TrajectoryDataset):
     def get_trajectory_len(self, idx) -> int:
         return len(self.subset.dataset[self.subset.indices[idx]])
 
+    def data_files(self) -> List[Path]:
+        return self.subset.dataset.data_files()
+
+
+def data_files_signature(dataset: TrajectoryDataset) -> List[str]:
+    """Returns the path, size and modification time of every data file of a dataset, which
+    changes when the raw data is regenerated or edited in place.
+
+    Args:
+        dataset (TrajectoryDataset): The dataset.
+
+    Returns:
+        List[str]: One entry per data file, in sorted order.
+    """
+    signature = []
+    for path in sorted(dataset.data_files()):
+        stat = path.stat()
+        signature.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+    return signature
+
 
 @dataclass
 class Batch:
@@ -148,6 +179,18 @@ class Batch:
             if attr is not None and isinstance(attr, torch.Tensor):
                 setattr(self, f.name, attr.to(device))
 
+    def pin_memory(self) -> "Batch":
+        """Returns a copy of the batch with its tensors in pinned memory, called by the
+        DataLoader when pin_memory=True."""
+        return Batch(
+            **{
+                f.name: getattr(self, f.name).pin_memory()
+                if isinstance(getattr(self, f.name), torch.Tensor)
+                else getattr(self, f.name)
+                for f in fields(self)
+            }
+        )
+
     def transform(
         self, transform_fns: Dict[str, Callable[[NDArray], NDArray]]
     ) -> "Batch":
@@ -238,6 +281,22 @@ def collate_policy(batch: List[Trajectory]) -> Batch:
     )
 
 
+def collate_prebatched(batch: Union[Batch, List[Trajectory]]) -> Batch:
+    """A collate function for datasets that gather whole batches themselves (through
+    `__getitems__`), falling back to `collate_policy` for lists of trajectories.
+
+    Args:
+        batch (Union[Batch, List[Trajectory]]): A batch built by the dataset, or a list of trajectories.
+
+    Returns:
+        Batch: The batch.
+    """
+    if isinstance(batch, Batch):
+        return batch
+    return collate_policy(batch)
+
+
 IMPLEMENTED_COLLATE_FNS = {
     "collate_policy": collate_policy,
+    "collate_prebatched": collate_prebatched,
 }
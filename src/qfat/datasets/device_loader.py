@@ -0,0 +1,157 @@
+import logging
+import math
+from typing import Iterator, Optional, Union
+
+import numpy as np
+import torch
+
+from qfat.datasets.dataset import Batch, TrajectoryDataset, collate_policy
+from qfat.datasets.slicer import SlicedTrajectoryDataset
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceResidentLoader:
+    def __init__(
+        self,
+        dataset: Union[SlicedTrajectoryDataset, TrajectoryDataset],
+        batch_size: int,
+        shuffle: bool = True,
+        device: Union[str, torch.device] = "cpu",
+        drop_last: bool = False,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ) -> None:
+        """A DataLoader replacement for datasets that fit in (device) memory.
+
+        All the (padded) windows are built once and uploaded to the device, every epoch then
+        only draws a `torch.randperm` and indexes the resident tensors. The future goals of a
+        sliced dataset are re-sampled for every batch, like `SlicedTrajectoryDataset` does.
+
+        Args:
+            dataset (Union[SlicedTrajectoryDataset, TrajectoryDataset]): The dataset to upload.
+            batch_size (int): The batch size.
+            shuffle (bool): Whether to shuffle the windows every epoch. Defaults to True.
+            device (Union[str, torch.device]): The device to keep the data on. Defaults to "cpu".
+            drop_last (bool): Whether to drop the last incomplete batch. Defaults to False.
+            num_replicas (int): The number of ranks of a distributed run, each of which iterates
+                over a disjoint shard of the (shuffled) windows, like `DistributedSampler`.
+                Defaults to 1.
+            rank (int): The rank of this process. Defaults to 0.
+            seed (int): The seed of the shuffling when distributed, which must be the same on
+                every rank. Defaults to 0.
+        """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = torch.device(device)
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self._goal_dataset = None
+        if isinstance(dataset, SlicedTrajectoryDataset):
+            data = dataset.get_batch(range(len(dataset)))
+            self._lengths = (
+                torch.as_tensor(dataset.slices)[:, 2]
+                - torch.as_tensor(dataset.slices)[:, 1]
+            )
+            if dataset.dataset.include_goals:
+                self._init_goals(dataset)
+                data.conditional_seq = None
+        else:
+            data = collate_policy([dataset[i] for i in range(len(dataset))])
+            self._lengths = data.validity_mask.sum(dim=1)
+        data.to(self.device)
+        self.data = data
+        self.n_samples = self.data.x.size(0)
+        logger.info(
+            f"Uploaded {self.n_samples} windows of length {self.data.x.size(1)} to {self.device}"
+        )
+
+    def _init_goals(self, dataset: SlicedTrajectoryDataset) -> None:
+        """Uploads the goals of every trajectory once, such that they can be sampled per batch."""
+        base = dataset.dataset
+        slices = np.asarray(dataset.slices, dtype=np.int64)
+        traj_ids, inverse = np.unique(slices[:, 0], return_inverse=True)
+        goals = [np.asarray(base[int(i)].goals) for i in traj_ids]
+        traj_lens = np.asarray([len(g) for g in goals], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(traj_lens)[:-1]])
+        self._goal_dataset = dataset
+        self._goals = torch.as_tensor(
+            np.concatenate(goals, axis=0), dtype=torch.float32, device=self.device
+        )
+        self._goal_offsets = offsets[inverse]
+        self._traj_lens = traj_lens[inverse]
+        self._ends = slices[:, 2]
+
+    def _sample_goals(self, idx: np.ndarray) -> torch.Tensor:
+        goal_starts, goal_ends = self._goal_dataset._sample_goal_bounds(
+            self._ends[idx], self._traj_lens[idx]
+        )
+        G = int((goal_ends - goal_starts).max())
+        t = goal_ends[:, None] - G + np.arange(G)[None, :]
+        valid = t >= goal_starts[:, None]
+        rows = self._goal_offsets[idx][:, None] + np.where(valid, t, 0)
+        goals = self._goals[torch.from_numpy(rows).to(self.device)]
+        valid = torch.from_numpy(valid).to(self.device)
+        return goals * valid.view(*valid.shape, *([1] * (goals.ndim - 2)))
+
+    @property
+    def n_rank_samples(self) -> int:
+        """The number of windows of every rank, the shards are padded to the same size."""
+        return math.ceil(self.n_samples / self.num_replicas)
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch that seeds the shuffling of a distributed run."""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.n_rank_samples // self.batch_size
+        return math.ceil(self.n_rank_samples / self.batch_size)
+
+    def _order(self) -> torch.Tensor:
+        if self.num_replicas == 1:
+            return (
+                torch.randperm(self.n_samples)
+                if self.shuffle
+                else torch.arange(self.n_samples)
+            )
+        # every rank draws the same permutation and keeps its strided shard of it
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = (
+            torch.randperm(self.n_samples, generator=generator)
+            if self.shuffle
+            else torch.arange(self.n_samples)
+        )
+        padding = self.n_rank_samples * self.num_replicas - self.n_samples
+        order = torch.cat([order, order[:padding]])
+        return order[self.rank :: self.num_replicas]
+
+    def __iter__(self) -> Iterator[Batch]:
+        order = self._order()
+        for b in range(len(self)):
+            idx = order[b * self.batch_size : (b + 1) * self.batch_size]
+            # trims the batch to its longest window, like collate_policy
+            L = int(self._lengths[idx].max())
+            idx_device = idx.to(self.device, non_blocking=True)
+            yield Batch(
+                x=self.data.x[idx_device, -L:],
+                y=self.data.y[idx_device, -L:],
+                prev_actions=self.data.prev_actions[idx_device, -L:]
+                if self.data.prev_actions is not None
+                else None,
+                validity_mask=self.data.validity_mask[idx_device, -L:],
+                conditional_seq=self._sample_goals(idx.numpy())
+                if self._goal_dataset is not None
+                else self._index_optional(self.data.conditional_seq, idx_device),
+            )
+
+    @staticmethod
+    def _index_optional(
+        x: Optional[torch.Tensor], idx: torch.Tensor
+    ) -> Optional[torch.Tensor]:
+        return x[idx] if x is not None else None
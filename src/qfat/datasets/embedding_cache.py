@@ -0,0 +1,340 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from qfat.datasets.dataset import (
+    SubsetTrajectoryDataset,
+    Trajectory,
+    TrajectoryDataset,
+    data_files_signature,
+)
+from qfat.models.encoders import HierarchicalResNet
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+# the per step fields stored next to the features, such that the parent dataset is not accessed
+TRAJECTORY_FIELDS = ["actions", "prev_actions", "goals", "raw_goals", "labels"]
+
+
+class _Episodes(Dataset):
+    """Serves the trajectories as numpy arrays, such that DataLoader workers can load them."""
+
+    def __init__(self, dataset: TrajectoryDataset):
+        self.dataset = dataset
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> Tuple[int, Trajectory]:
+        traj: Trajectory = self.dataset[idx]
+        return idx, traj.transform(
+            {
+                name: lambda value: None if value is None else np.asarray(value)
+                for name in ["states", *TRAJECTORY_FIELDS]
+            }
+        )
+
+
+def _unwrap(batch: List[Tuple[int, Trajectory]]) -> Tuple[int, Trajectory]:
+    return batch[0]
+
+
+def _root_dataset(dataset: TrajectoryDataset) -> TrajectoryDataset:
+    if isinstance(dataset, SubsetTrajectoryDataset):
+        return dataset.subset.dataset
+    return dataset
+
+
+def _check_transforms(dataset: TrajectoryDataset) -> None:
+    """Raises if a trajectory transform is random, since the store would freeze a single draw
+    of it (e.g a single augmentation of every image)."""
+    for ds in {id(d): d for d in [dataset, _root_dataset(dataset)]}.values():
+        for transform in ds.transforms or []:
+            if getattr(transform, "is_random", True):
+                raise ValueError(
+                    f"The embedding store can't be compiled with the random transform "
+                    f"{type(transform).__name__}, image augmentations can't be cached."
+                )
+
+
+def _fingerprint(
+    encoder: HierarchicalResNet,
+    lengths: np.ndarray,
+    dataset: TrajectoryDataset,
+    dataset_cfg: Optional[Any] = None,
+) -> str:
+    """Hashes the encoder, the trajectory lengths, the dataset class and transforms, the
+    config the dataset was instantiated from and the signature of its data files."""
+    h = hashlib.sha1()
+    h.update(encoder.fingerprint().encode())
+    h.update(lengths.astype(np.int64).tobytes())
+    root = _root_dataset(dataset)
+    if isinstance(dataset, SubsetTrajectoryDataset):
+        h.update(np.asarray(dataset.subset.indices, dtype=np.int64).tobytes())
+    h.update(
+        json.dumps(
+            [
+                f"{type(root).__module__}.{type(root).__qualname__}",
+                [type(t).__qualname__ for t in root.transforms or []],
+                TRAJECTORY_FIELDS,
+            ]
+        ).encode()
+    )
+    h.update("\n".join(data_files_signature(root)).encode())
+    if dataset_cfg is not None:
+        h.update(OmegaConf.to_yaml(OmegaConf.create(dataset_cfg)).encode())
+    return h.hexdigest()
+
+
+def compile_embedding_store(
+    dataset: TrajectoryDataset,
+    encoder: HierarchicalResNet,
+    store_dir: Union[str, Path],
+    batch_size: int = 512,
+    num_workers: int = 0,
+    device: Union[str, torch.device] = "cpu",
+    overwrite: bool = False,
+    dataset_cfg: Optional[Any] = None,
+) -> Path:
+    """Runs the frozen backbone of an encoder once over every frame of a trajectory dataset.
+
+    The pooled backbone features (see `HierarchicalResNet.extract_features`) of all the frames are
+    written to a single memory-mapped array, in trajectory order, together with the offset of every
+    trajectory. The other per step fields of the trajectories (actions, goals, ...) are stored as
+    well, such that the images are only loaded and transformed here, random transforms are
+    therefore rejected. The frames of consecutive trajectories are encoded together in batches of
+    `batch_size`, while `num_workers` DataLoader processes load the trajectories. The store is
+    fingerprinted with the encoder weights, the preprocessing, the trajectory lengths and the
+    dataset config, and is only recomputed when the fingerprint changes.
+
+    Args:
+        dataset (TrajectoryDataset): The dataset whose states are images.
+        encoder (HierarchicalResNet): The encoder, whose ResNet weights must be frozen.
+        store_dir (Union[str, Path]): The directory to write the store to.
+        batch_size (int): The number of frames encoded at once. Defaults to 512.
+        num_workers (int): The number of processes loading the trajectories. Defaults to 0.
+        device (Union[str, torch.device]): The device to run the encoder on. Defaults to "cpu".
+        overwrite (bool): Whether to recompute a store that matches the dataset. Defaults to False.
+        dataset_cfg (Optional[Any]): The config the dataset was instantiated from, which is
+            part of the fingerprint, such that e.g a change of the normalization recomputes the
+            store. Defaults to None.
+
+    Returns:
+        Path: The store directory.
+
+    Raises:
+        ValueError: If the encoder weights are not frozen.
+        ValueError: If a transform of the dataset is random.
+        ValueError: If the fields of a trajectory don't match the first trajectory's.
+    """
+    if not encoder.freeze_weights:
+        raise ValueError("Only the features of a frozen encoder can be cached.")
+    _check_transforms(dataset)
+    store_dir = Path(store_dir)
+    lengths = np.asarray(
+        [dataset.get_trajectory_len(i) for i in range(len(dataset))], dtype=np.int64
+    )
+    fingerprint = _fingerprint(encoder, lengths, dataset, dataset_cfg)
+    meta_path = store_dir / META_FILE
+    if meta_path.exists() and not overwrite:
+        with open(meta_path, "r") as f:
+            if json.load(f)["fingerprint"] == fingerprint:
+                logger.info(f"Reusing the embedding store at {store_dir}")
+                return store_dir
+        logger.info(f"The embedding store at {store_dir} is stale, recomputing it.")
+    store_dir.mkdir(parents=True, exist_ok=True)
+    if meta_path.exists():
+        meta_path.unlink()  # invalidates the store until it is fully written
+
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    np.save(store_dir / "offsets.npy", offsets)
+    features = open_memmap(
+        store_dir / "features.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(int(offsets[-1]), encoder.feature_dim),
+    )
+
+    loader = DataLoader(
+        _Episodes(dataset),
+        batch_size=1,
+        num_workers=num_workers,
+        collate_fn=_unwrap,
+    )
+    was_training = encoder.training
+    encoder.eval().to(device)
+    pending: List[np.ndarray] = []
+    n_pending = 0
+    cursor = 0
+    # the stored fields, set by the first trajectory, and whether the goals are its frames
+    fields: Optional[Dict[str, List[np.ndarray]]] = None
+    frame_goals = False
+
+    def flush(min_frames: int) -> None:
+        nonlocal pending, n_pending, cursor
+        while n_pending >= max(min_frames, 1):
+            frames = np.concatenate(pending, axis=0)
+            n = min(batch_size, len(frames))
+            img = torch.as_tensor(frames[:n], dtype=torch.float32, device=device)
+            features[cursor : cursor + n] = (
+                encoder.extract_features(img).float().cpu().numpy()
+            )
+            cursor += n
+            pending, n_pending = [frames[n:]], len(frames) - n
+
+    with torch.inference_mode():
+        for idx, traj in tqdm(loader, desc="Computing embeddings"):
+            frames = traj.states
+            if len(frames) != lengths[idx]:
+                raise ValueError(
+                    f"Trajectory {idx} has {len(frames)} frames, expected {lengths[idx]}."
+                )
+            if fields is None:
+                frame_goals = (
+                    traj.goals is not None and traj.goals.shape == frames.shape
+                )
+                fields = {
+                    name: []
+                    for name in TRAJECTORY_FIELDS
+                    if getattr(traj, name) is not None
+                    and not (name == "goals" and frame_goals)
+                }
+            for name in TRAJECTORY_FIELDS:
+                value = getattr(traj, name)
+                if (name in fields or (name == "goals" and frame_goals)) != (
+                    value is not None
+                ):
+                    raise ValueError(
+                        f"Trajectory {idx} has a different set of fields than the first one "
+                        f"(field {name})."
+                    )
+                if name in fields:
+                    fields[name].append(value)
+            pending.append(frames)
+            n_pending += len(frames)
+            flush(batch_size)
+        flush(0)
+    encoder.train(was_training)
+    features.flush()
+    for name, values in (fields or {}).items():
+        # the fields aren't necessarily aligned with the frames, e.g the goals
+        np.save(
+            store_dir / f"{name}_offsets.npy",
+            np.concatenate([[0], np.cumsum([len(value) for value in values])]),
+        )
+        np.save(store_dir / f"{name}.npy", np.concatenate(values, axis=0))
+
+    meta = {
+        "fingerprint": fingerprint,
+        "n_trajectories": len(lengths),
+        "n_frames": int(offsets[-1]),
+        "feature_dim": encoder.feature_dim,
+        "fields": list(fields or {}),
+        "frame_goals": frame_goals,
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"Cached the features of {meta['n_frames']} frames into {store_dir}")
+    return store_dir
+
+
+class EmbeddingStoreDataset(TrajectoryDataset):
+    def __init__(
+        self,
+        dataset: TrajectoryDataset,
+        store_dir: Union[str, Path],
+        mmap_mode: Optional[str] = "r",
+    ):
+        """Replaces the image states (and image goals) of a dataset with their cached features.
+
+        The frozen encoder of the model accepts the features in place of the images, such that
+        training does not run the backbone at all. The other fields of the trajectories are read
+        from the store as well, the parent dataset (and its transforms) is not accessed.
+
+        Args:
+            dataset (TrajectoryDataset): The dataset the store was compiled from.
+            store_dir (Union[str, Path]): The directory of the store, see `compile_embedding_store`.
+            mmap_mode (Optional[str]): The numpy memory-map mode, None loads the features in memory.
+                Defaults to "r".
+        """
+        super().__init__()
+        self.dataset = dataset
+        self.store_dir = Path(store_dir)
+        self.mmap_mode = mmap_mode
+        with open(self.store_dir / META_FILE, "r") as f:
+            self.meta = json.load(f)
+        if self.meta["n_trajectories"] != len(dataset):
+            raise ValueError(
+                f"The embedding store holds {self.meta['n_trajectories']} trajectories, "
+                f"the dataset has {len(dataset)}."
+            )
+        self.offsets = np.load(self.store_dir / "offsets.npy")
+        self.field_offsets = {
+            name: np.load(self.store_dir / f"{name}_offsets.npy")
+            for name in self.meta["fields"]
+        }
+        self._features = None
+        self._fields = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_features"] = None
+        state["_fields"] = None
+        return state
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            self._features = np.load(
+                self.store_dir / "features.npy", mmap_mode=self.mmap_mode
+            )
+        return self._features
+
+    @property
+    def fields(self) -> Dict[str, np.ndarray]:
+        if self._fields is None:
+            self._fields = {
+                name: np.load(self.store_dir / f"{name}.npy", mmap_mode=self.mmap_mode)
+                for name in self.meta["fields"]
+            }
+        return self._fields
+
+    @property
+    def trajectories(self) -> None:
+        raise NotImplementedError(
+            "The trajectories are built on access, use indexing instead."
+        )
+
+    @property
+    def include_goals(self) -> bool:
+        return self.dataset.include_goals
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def get_trajectory_len(self, idx: int) -> int:
+        return int(self.offsets[idx + 1] - self.offsets[idx])
+
+    def data_files(self) -> List[Path]:
+        # the metadata is rewritten whenever the store is recomputed
+        return [self.store_dir / META_FILE, *self.dataset.data_files()]
+
+    def __getitem__(self, idx: int) -> Trajectory:
+        features = np.asarray(self.features[self.offsets[idx] : self.offsets[idx + 1]])
+        fields = {}
+        for name, values in self.fields.items():
+            offsets = self.field_offsets[name]
+            fields[name] = np.asarray(values[offsets[idx] : offsets[idx + 1]])
+        if self.meta["frame_goals"]:
+            fields["goals"] = features  # the goals are the frames themselves
+        return Trajectory(states=features, **fields)
@@ -6,6 +6,7 @@ import zarr
 
 from qfat.constants import KITCHEN_DATA_PATH
 from qfat.datasets.dataset import Trajectory, TrajectoryDataset
+from qfat.datasets.lazy_frames import ChunkCache, LazyFrames
 from qfat.datasets.transform import TrajectoryTransform
 from qfat.normalizer.normalizer import MeanStdNormalizer
 
@@ -22,7 +23,24 @@ class KitchenTrajectoryDataset(TrajectoryDataset):
         mode: Optional[str] = None,
         normalize: bool = True,
         include_prev_actions: bool = False,
+        image_cache_bytes: int = 2**30,
+        prefetch_chunks: int = 1,
     ):
+        """
+        Args:
+            data_dir (str): Path to the dataset directory.
+            transforms (Optional[List[TrajectoryTransform]]): Transforms to apply to the trajectories.
+            include_goals (bool): Whether to include goals in the trajectories.
+            stats_path (str): Path to save the normalization stats to.
+            mode (Optional[str]): "image" to use the precomputed images as states, otherwise the
+                low dimensional observations are used.
+            normalize (bool): Whether to normalize the states and actions.
+            include_prev_actions (bool): Whether to include the previous actions in the trajectories.
+            image_cache_bytes (int): In image mode, the size of the LRU cache of decompressed image
+                chunks, split evenly across the DataLoader workers. Defaults to 1 GiB.
+            prefetch_chunks (int): In image mode, the number of following chunks of an episode
+                to read in the background on a cache miss. Defaults to 1.
+        """
         super().__init__()
         self._include_goals = include_goals
         self._data_dir = Path(data_dir)
@@ -41,10 +59,13 @@ class KitchenTrajectoryDataset(TrajectoryDataset):
         self._stats_path = stats_path
 
         if self.mode == "image":
+            # the episodes are read lazily, chunk by chunk, when their frames are accessed
             self._states = zarr.open_group(
                 KITCHEN_DATA_PATH / "precomputed_images.zarr", mode="r"
             )
-            self._states = {key: self._states[key][:] for key in self._states.keys()}
+            self._image_cache = ChunkCache(
+                max_bytes=image_cache_bytes, prefetch_chunks=prefetch_chunks
+            )
         else:
             self._states = np.load(
                 self._data_dir / "observations_seq.npy", mmap_mode="r"
@@ -72,22 +93,14 @@ class KitchenTrajectoryDataset(TrajectoryDataset):
         """
         if self.mode == "image":
             all_actions = []
-            all_goals = [] if self._include_goals else None
 
             for i in range(self.num_trajectories):
                 mask_i = self._mask[i, :]
                 valid_len = int(mask_i.sum().item())
                 actions = self._actions[i, :valid_len, :]
                 all_actions.append(actions)
-                if self._include_goals:
-                    goals = self._states[i, :valid_len]
-                    all_goals.append(goals)
 
             all_actions = np.concatenate(all_actions, axis=0)
-            if self._include_goals and len(all_goals) > 0:
-                all_goals = np.concatenate(all_goals, axis=0)
-            else:
-                all_goals = None
 
             self.normalizer.update_stats(
                 None,  # no state normalization
@@ -139,6 +152,21 @@ class KitchenTrajectoryDataset(TrajectoryDataset):
     def __len__(self):
         return self.num_trajectories
 
+    def get_trajectory_len(self, idx: int) -> int:
+        return int(self._mask[idx, :].sum().item())
+
+    def data_files(self) -> List[Path]:
+        files = [
+            self._data_dir / name
+            for name in ["actions_seq.npy", "existence_mask.npy", "onehot_goals.npy"]
+        ]
+        if self.mode == "image":
+            images = KITCHEN_DATA_PATH / "precomputed_images.zarr"
+            files.extend(p for p in images.rglob("*") if p.is_file())
+        else:
+            files.append(self._data_dir / "observations_seq.npy")
+        return files
+
     def __getitem__(self, index: int) -> Trajectory:
         if index >= self.num_trajectories or index < 0:
             raise IndexError(
@@ -153,8 +181,12 @@ class KitchenTrajectoryDataset(TrajectoryDataset):
 
         # Get states or images depending on mode
         if self.mode == "image":
-            episode_images = self._states[f"episode_{index}"][:]
-            states = episode_images[:valid_len]
+            states = LazyFrames(
+                self._states[f"episode_{index}"],
+                name=index,
+                cache=self._image_cache,
+                length=valid_len,
+            )
             goals = states if self._include_goals else None
         else:
             states = self._states[index, :valid_len, :]
@@ -0,0 +1,247 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Hashable, Iterator, Optional, Tuple
+
+import numpy as np
+import zarr
+from torch.utils.data import get_worker_info
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkCache:
+    def __init__(self, max_bytes: int = 2**30, prefetch_chunks: int = 0) -> None:
+        """A bounded LRU cache of decompressed zarr chunks.
+
+        The cache is thread-safe and evicts the least recently used chunks once it holds more
+        than its budget. It is emptied when pickled (e.g to spawned DataLoader workers), while
+        forked workers inherit the chunks that were already loaded by the main process. The
+        processes can't share the chunks, so inside a DataLoader worker the budget is
+        `max_bytes` divided by the number of workers, which bounds the total memory of the
+        caches of all the workers by `max_bytes`.
+
+        Args:
+            max_bytes (int): The maximum size of the cached chunks in bytes, over all the
+                DataLoader workers. Defaults to 1 GiB.
+            prefetch_chunks (int): The number of following chunks of an episode to read in the
+                background after every chunk miss. Defaults to 0.
+        """
+        self.max_bytes = max_bytes
+        self.prefetch_chunks = prefetch_chunks
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._chunks: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._nbytes = 0
+        self._init_process_state()
+
+    def _init_process_state(self) -> None:
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+        self._budget = None
+        self._pid = os.getpid()
+
+    def _check_process(self) -> None:
+        """Resets the state that a forked process (e.g a DataLoader worker) can't inherit: the
+        lock may have been held by a prefetch thread at the time of the fork, and neither that
+        thread nor the reads it had pending exist in the child."""
+        if self._pid != os.getpid():
+            self._init_process_state()
+        if self._budget is None:
+            worker_info = get_worker_info()
+            n_workers = 1 if worker_info is None else worker_info.num_workers
+            self._budget = self.max_bytes // n_workers
+            with self._lock:
+                self._evict()
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes, "prefetch_chunks": self.prefetch_chunks}
+
+    def __setstate__(self, state) -> None:
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def _lookup(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+            return chunk
+
+    def _insert(self, key: Hashable, chunk: np.ndarray) -> None:
+        with self._lock:
+            if key in self._chunks:
+                return
+            self._chunks[key] = chunk
+            self._nbytes += chunk.nbytes
+            self._evict()
+
+    def _evict(self) -> None:
+        budget = self.max_bytes if self._budget is None else self._budget
+        while self._nbytes > budget and len(self._chunks) > 1:
+            _, evicted = self._chunks.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+
+    def _read(self, key: Hashable, array: zarr.Array, chunk_idx: int) -> np.ndarray:
+        chunk_len = array.chunks[0]
+        chunk = array[chunk_idx * chunk_len : (chunk_idx + 1) * chunk_len]
+        self._insert(key, chunk)
+        return chunk
+
+    def get(self, name: Hashable, array: zarr.Array, chunk_idx: int) -> np.ndarray:
+        """Returns a chunk of an array along its first axis, reading it on a miss.
+
+        Args:
+            name (Hashable): A name that identifies the array, e.g the episode key.
+            array (zarr.Array): The array to read from.
+            chunk_idx (int): The index of the chunk along the first axis.
+
+        Returns:
+            np.ndarray: The decompressed chunk.
+        """
+        self._check_process()
+        key = (name, chunk_idx)
+        chunk = self._lookup(key)
+        if chunk is not None:
+            return chunk
+        chunk = self._read(key, array, chunk_idx)
+        if self.prefetch_chunks > 0:
+            n_chunks = -(-array.shape[0] // array.chunks[0])
+            self._prefetch(
+                name,
+                array,
+                range(
+                    chunk_idx + 1, min(chunk_idx + 1 + self.prefetch_chunks, n_chunks)
+                ),
+            )
+        return chunk
+
+    def _prefetch(self, name: Hashable, array: zarr.Array, chunk_ids) -> None:
+        if self._executor is None:
+            # executors are not fork-safe, every (worker) process starts its own
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        for chunk_idx in chunk_ids:
+            key = (name, chunk_idx)
+            with self._lock:
+                if key in self._chunks or key in self._pending:
+                    continue
+                self._pending.add(key)
+            self._executor.submit(self._prefetch_one, key, array, chunk_idx)
+
+    def _prefetch_one(self, key: Hashable, array: zarr.Array, chunk_idx: int) -> None:
+        try:
+            self._read(key, array, chunk_idx)
+        except Exception as e:
+            logger.warning(f"Failed to prefetch chunk {key}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+class LazyFrames:
+    def __init__(
+        self,
+        array: zarr.Array,
+        name: Hashable,
+        cache: ChunkCache,
+        length: Optional[int] = None,
+    ) -> None:
+        """An array-like view over the frames of a zarr array that only reads the chunks
+        covering the requested frames.
+
+        Slicing returns a numpy array, such that a window `frames[start:end]` only decompresses
+        the chunks it overlaps. Converting the whole view with `np.asarray` reads every chunk.
+
+        Args:
+            array (zarr.Array): The frames, chunked along the first axis.
+            name (Hashable): The name of the array in the chunk cache.
+            cache (ChunkCache): The chunk cache to read through.
+            length (Optional[int]): Truncates the view to the first `length` frames.
+                Defaults to None, i.e all the frames.
+        """
+        self.array = array
+        self.name = name
+        self.cache = cache
+        self.length = array.shape[0] if length is None else min(length, array.shape[0])
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (self.length, *self.array.shape[1:])
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.array.dtype
+
+    @property
+    def ndim(self) -> int:
+        return self.array.ndim
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _read_range(self, start: int, stop: int) -> np.ndarray:
+        """Reads the frames [start, stop) by concatenating the chunks that cover them."""
+        if stop <= start:
+            return np.empty((0, *self.array.shape[1:]), dtype=self.dtype)
+        chunk_len = self.array.chunks[0]
+        first, last = start // chunk_len, (stop - 1) // chunk_len
+        parts = []
+        for chunk_idx in range(first, last + 1):
+            chunk = self.cache.get(self.name, self.array, chunk_idx)
+            offset = chunk_idx * chunk_len
+            parts.append(chunk[max(start - offset, 0) : stop - offset])
+        return parts[0].copy() if len(parts) == 1 else np.concatenate(parts, axis=0)
+
+    def __getitem__(self, idx: Any) -> np.ndarray:
+        rest = ()
+        if isinstance(idx, tuple):
+            idx, rest = idx[0], idx[1:]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.length)
+            if step > 0:
+                out = self._read_range(start, stop)[::step]
+            else:
+                out = self._read_range(0, self.length)[idx]
+        elif isinstance(idx, (int, np.integer)):
+            idx = int(idx)
+            i = idx + self.length if idx < 0 else idx
+            if not 0 <= i < self.length:
+                raise IndexError(f"Index {idx} out of range for {self.length} frames.")
+            out = self._read_range(i, i + 1)[0]
+        else:
+            idx = np.asarray(idx)
+            if idx.dtype == bool:
+                idx = np.flatnonzero(idx)
+            idx = np.where(idx < 0, idx + self.length, idx)
+            if idx.size == 0:
+                out = self._read_range(0, 0)
+            else:
+                lo = int(idx.min())
+                out = self._read_range(lo, int(idx.max()) + 1)[idx - lo]
+        if not rest:
+            return out
+        # the first axis is consumed by an integer index, and kept otherwise
+        return out[rest] if isinstance(idx, int) else out[(slice(None), *rest)]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        chunk_len = self.array.chunks[0]
+        for start in range(0, self.length, chunk_len):
+            yield from self._read_range(start, min(start + chunk_len, self.length))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        out = self._read_range(0, self.length)
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def astype(self, dtype, copy: bool = True) -> np.ndarray:
+        return np.asarray(self).astype(dtype, copy=copy)
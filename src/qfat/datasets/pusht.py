@@ -1,3 +1,7 @@
+import hashlib
+import json
+import logging
+import os
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
@@ -12,6 +16,10 @@ from qfat.datasets.transform import (
 )
 from qfat.normalizer.normalizer import MinMaxNormalizer
 
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
 
 class PushTTrajectoryDataset(TrajectoryDataset):
     """Adapted from https://github.com/jayLEE0301/vq_bet_official"""
@@ -25,6 +33,7 @@ class PushTTrajectoryDataset(TrajectoryDataset):
         embedding_path: str = str(PUSHT_DATA_PATH / "resnet_embeddings"),
         include_goals: bool = False,
         include_prev_actions: bool = False,
+        cache_dir: Optional[str] = str(PUSHT_DATA_PATH / "cache"),
     ):
         """
         Initialize the dataset.
@@ -36,6 +45,10 @@ class PushTTrajectoryDataset(TrajectoryDataset):
             mode (str): Input mode for the dataset - "keypoints", "image", or "embeddings".
             embedding_path (str): Path to the directory containing precomputed embeddings.
             include_goals (bool): Whether to include goals in the trajectories.
+            include_prev_actions (bool): Whether to include the previous actions in the trajectories.
+            cache_dir (Optional[str]): Directory of the persisted columnar cache, which holds the
+                normalized columns and the normalizer stats of a given zarr store. None disables
+                the cache.
         """
         super().__init__(transforms)
 
@@ -51,27 +64,25 @@ class PushTTrajectoryDataset(TrajectoryDataset):
                 f"Invalid mode '{self.mode}'. Choose 'keypoints', 'image', or 'embeddings'."
             )
 
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.mode == "embeddings":
+            self._check_embeddings_exist()
+
         src_root = self._load_zarr_data()
         meta, data = self._load_metadata_and_data(src_root)
+        self._meta = meta
+        self._data = data
+        self._bounds = self._episode_bounds(meta)
 
         self.normalizer = MinMaxNormalizer(normalize_actions_flag=True)
-
-        if self.mode == "keypoints":
-            all_states, all_actions, all_goals = self._collect_data_for_normalization(
-                data, meta
-            )
-            self.normalizer.update_stats(all_states, all_actions, goals=all_goals)
-        else:
-            if self.mode == "embeddings":
-                self._check_embeddings_exist()
-            all_actions = self._collect_actions_for_normalization(data, meta)
-            self.normalizer.update_stats(states=None, actions=all_actions, goals=None)
+        self._columns = self._load_cached_columns()
+        if self._columns is None:
+            self._columns = self._build_columns(data)
+            self._save_cached_columns(self._columns)
 
         if self.stats_path:
             self.normalizer.save_stats(self.stats_path)
 
-        self._meta = meta
-        self._data = data
         self._trajectories = self._create_trajectories()
 
     @property
@@ -82,9 +93,23 @@ class PushTTrajectoryDataset(TrajectoryDataset):
     def include_goals(self):
         return self._include_goals
 
+    @property
+    def zarr_path(self) -> Path:
+        return self.data_dir / "pusht_cchi_v7_replay.zarr"
+
+    def _zarr_data_files(self) -> List[Path]:
+        data_dir = self.zarr_path / "data"
+        return sorted(p for p in data_dir.rglob("*") if p.is_file())
+
+    def data_files(self) -> List[Path]:
+        files = self._zarr_data_files()
+        if self.mode == "embeddings":
+            files.extend(sorted(self.embedding_path.glob("*.npy")))
+        return files
+
     def _load_zarr_data(self):
         """Load the root Zarr group from the data directory."""
-        return zarr.group(self.data_dir / "pusht_cchi_v7_replay.zarr")
+        return zarr.group(self.zarr_path)
 
     def _load_metadata_and_data(
         self, src_root
@@ -106,66 +131,133 @@ class PushTTrajectoryDataset(TrajectoryDataset):
                 f"Embeddings not found in '{self.embedding_path}'. Please run the embedding generation script first."
             )
 
-    def _collect_data_for_normalization(
-        self, data: Dict[str, Any], meta: Dict[str, NDArray]
-    ) -> Tuple[NDArray, NDArray, Optional[NDArray]]:
-        """Collect states, actions, and goals for normalization."""
-        all_states, all_actions, all_goals = [], [], []
-        start = 0
-        if self.mode != "keypoints":
-            raise ValueError(
-                "This method should only be called when mode is keypoints."
-            )
+    @staticmethod
+    def _episode_bounds(meta: Dict[str, NDArray]) -> List[Tuple[int, int, int]]:
+        """Returns the (episode index, start, end) of the kept episodes.
 
-        obs = self._extract_keypoints(data)
-        goals = obs
-        for end in meta["episode_ends"]:
+        Episodes of 300 steps or more are dropped, without moving the start of the next episode.
+        """
+        bounds = []
+        start = 0
+        for idx, end in enumerate(meta["episode_ends"]):
+            end = int(end)
             if (300 - (end - start)) <= 0:
                 continue
-            all_states.append(obs[start:end])
-            all_actions.append(data["action"][start:end])
-            if self.include_goals:
-                all_goals.append(goals[start:end])
+            bounds.append((idx, start, end))
             start = end
+        return bounds
 
-        return (
-            np.concatenate(all_states, axis=0),
-            np.concatenate(all_actions, axis=0),
-            np.concatenate(all_goals, axis=0) if self.include_goals else None,
+    def _cache_path(self) -> Path:
+        """The cache file of the zarr store, episode layout and dataset flags.
+
+        The size and modification time of every file of the data arrays are part of the key,
+        such that regenerating or editing the store in place invalidates the cache.
+        """
+        h = hashlib.sha1()
+        h.update(str(self.zarr_path.resolve()).encode())
+        data_dir = self.zarr_path / "data"
+        for path in self._zarr_data_files():
+            stat = path.stat()
+            h.update(
+                f"{path.relative_to(data_dir)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+            )
+        h.update(np.asarray(self._meta["episode_ends"], dtype=np.int64).tobytes())
+        h.update(
+            json.dumps(
+                [
+                    CACHE_VERSION,
+                    self.mode,
+                    self.include_goals,
+                    self.include_prev_actions,
+                    self.normalizer.normalize_actions_flag,
+                ]
+            ).encode()
         )
+        return self.cache_dir / f"pusht_{h.hexdigest()}.npz"
 
-    def _collect_actions_for_normalization(
-        self, data: Dict[str, Any], meta: Dict[str, NDArray]
-    ) -> NDArray:
-        """Collect actions for normalization."""
-        all_actions = []
-        start = 0
+    def _load_cached_columns(self) -> Optional[Dict[str, NDArray]]:
+        """Loads the normalized columns and restores the normalizer stats they were built with."""
+        if self.cache_dir is None:
+            return None
+        path = self._cache_path()
+        if not path.exists():
+            return None
+        with np.load(path) as cache:
+            columns = {key: cache[key] for key in cache.files if key != "stats"}
+            stats = json.loads(str(cache["stats"]))
+        self.normalizer.state_stats = stats["state_stats"]
+        self.normalizer.action_stats = stats["action_stats"]
+        self.normalizer.goal_stats = stats["goal_stats"]
+        logger.info(f"Loaded the cached PushT columns from {path}")
+        return columns
 
-        for end in meta["episode_ends"]:
-            if (300 - (end - start)) <= 0:
-                continue
-            all_actions.append(data["action"][start:end])
-            start = end
+    def _save_cached_columns(self, columns: Dict[str, NDArray]) -> None:
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._cache_path()
+        stats = {
+            "state_stats": self.normalizer.state_stats,
+            "action_stats": self.normalizer.action_stats,
+            "goal_stats": self.normalizer.goal_stats,
+        }
+        # written under a unique name and renamed, since rollout workers may build it concurrently
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, stats=np.array(json.dumps(stats)), **columns)
+        os.replace(tmp_path, path)
+        logger.info(f"Cached the PushT columns to {path}")
 
-        return np.concatenate(all_actions, axis=0)
+    def _build_columns(self, data: Dict[str, Any]) -> Dict[str, NDArray]:
+        """Reads every zarr column once, fits the normalizer and normalizes the full columns.
+
+        The trajectories are later built as views into these columns, see `_create_trajectories`.
+        """
+        data = {
+            key: np.asarray(data[key][:])
+            for key in ("action", "state", "keypoint")
+            if key in data
+        }
+        kept = np.concatenate([np.arange(start, end) for _, start, end in self._bounds])
+        actions = data["action"]
+        columns = {}
+        if self.mode == "keypoints":
+            obs = self._extract_keypoints(data)
+            self.normalizer.update_stats(
+                obs[kept],
+                actions[kept],
+                goals=obs[kept] if self.include_goals else None,
+            )
+            obs = self.normalizer.normalize_state(obs)
+            columns["states"] = obs.astype(np.float32)
+            if self.include_goals:
+                # goals are normalized on top of the normalized states
+                columns["goals"] = self.normalizer.normalize_goal(obs)
+        else:
+            self.normalizer.update_stats(states=None, actions=actions[kept], goals=None)
+        if self.include_goals:
+            columns["raw_goals"] = self._extract_block_state(data)
+        actions = self.normalizer.normalize_action(actions).astype(np.float32)
+        columns["actions"] = actions
+        if self.include_prev_actions:
+            prev_actions = np.zeros_like(actions)
+            prev_actions[1:] = actions[:-1]
+            prev_actions[[start for _, start, _ in self._bounds]] = 0
+            columns["prev_actions"] = prev_actions
+        return columns
 
     def _create_trajectories(self) -> List[Trajectory]:
-        """Generate a list of Trajectory instances."""
+        """Generate a list of Trajectory instances, as views into the loaded columns."""
+        columns = self._columns
+        if self.mode == "image":
+            images = np.asarray(self._data["img"][:])
         trajectories = []
-        start = 0
-        raw_goals = None
-        for idx, end in enumerate(self._meta["episode_ends"]):
-            if (300 - (end - start)) <= 0:
-                continue
-
+        for idx, start, end in self._bounds:
             if self.mode == "keypoints":
-                obs = self._extract_keypoints(self._data)[start:end]
-                obs = self.normalizer.normalize_state(obs)
-                goals = obs if self.include_goals else None
-                if goals is not None:
-                    goals = self.normalizer.normalize_goal(goals)
+                obs = columns["states"][start:end]
+                goals = columns["goals"][start:end] if self.include_goals else None
             elif self.mode == "image":
-                obs = self._data["img"][start:end]
+                obs = images[start:end]
                 goals = obs if self.include_goals else None
             elif self.mode == "embeddings":
                 embedding_file = self.embedding_path / f"trajectory_{idx}.npy"
@@ -175,42 +267,31 @@ class PushTTrajectoryDataset(TrajectoryDataset):
                     )
                 obs = np.load(embedding_file)
                 goals = obs if self.include_goals else None
-            raw_goals = (
-                self._extract_block_state(self._data)[start:end]
-                if self.include_goals
-                else None
-            )
-            actions = self.normalizer.normalize_action(self._data["action"][start:end])
-            prev_actions = None
-            if self.include_prev_actions:
-                prev_actions = np.zeros_like(actions)
-                prev_actions[1:] = actions[:-1]
-                prev_actions = prev_actions.astype(np.float32)
             traj = Trajectory(
-                states=obs.astype(np.float32),
-                actions=actions.astype(np.float32),
+                states=obs.astype(np.float32, copy=False),
+                actions=columns["actions"][start:end],
                 goals=goals,
-                raw_goals=raw_goals,
-                prev_actions=prev_actions,
+                raw_goals=columns["raw_goals"][start:end]
+                if self.include_goals
+                else None,
+                prev_actions=columns["prev_actions"][start:end]
+                if self.include_prev_actions
+                else None,
             )
             trajectories.append(traj)
-            start = end
 
         return trajectories
 
     def _extract_keypoints(self, data: Dict[str, NDArray]) -> NDArray:
         """Extract keypoint observations, concatenated with agent position."""
-        agent_pos = np.array(data["state"][:, :2])
+        keypoints = np.asarray(data["keypoint"][:])
+        agent_pos = np.asarray(data["state"][:, :2])
         return np.concatenate(
-            [
-                np.array(data["keypoint"]).reshape(data["keypoint"].shape[0], -1),
-                agent_pos,
-            ],
-            axis=-1,
+            [keypoints.reshape(keypoints.shape[0], -1), agent_pos], axis=-1
         )
 
     def _extract_block_state(self, data: Dict[str, NDArray]):
-        block_state = np.array(data["state"][:, 2:])  # pos x, pos y, orientation
+        block_state = np.asarray(data["state"][:, 2:])  # pos x, pos y, orientation
         return block_state
 
 
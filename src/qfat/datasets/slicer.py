@@ -1,13 +1,61 @@
 import logging
+from typing import List, Sequence, Tuple, Union
 
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 
-from qfat.datasets.dataset import Trajectory, TrajectoryDataset
+from qfat.datasets.dataset import Batch, Trajectory, TrajectoryDataset
 
 logger = logging.getLogger(__name__)
 
 
+def stack_horizon(arr: np.ndarray, horizon: int) -> np.ndarray:
+    """Returns an array whose row t holds arr[t : t + 1 + horizon] flattened, for every t
+    that has a full horizon.
+
+    Args:
+        arr (np.ndarray): The array of shape (T, D).
+        horizon (int): Number of future timesteps to include at each step.
+
+    Returns:
+        np.ndarray: An array of shape (T - horizon, (1 + horizon) * D).
+    """
+    if horizon == 0:
+        return arr
+    windows = np.lib.stride_tricks.sliding_window_view(arr, horizon + 1, axis=0)
+    # (T - horizon, D, horizon + 1) -> (T - horizon, horizon + 1, D)
+    return windows.swapaxes(-1, -2).reshape(windows.shape[0], -1)
+
+
+def gather_windows(
+    arrays: List[np.ndarray],
+    array_idx: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+) -> np.ndarray:
+    """Gathers left-padded windows out of a list of arrays with a single fancy-indexing.
+
+    Args:
+        arrays (List[np.ndarray]): The arrays to gather from, e.g one per trajectory.
+        array_idx (np.ndarray): The index in arrays of every window, of shape (B,).
+        starts (np.ndarray): The (inclusive) start of every window, of shape (B,).
+        ends (np.ndarray): The (exclusive) end of every window, of shape (B,).
+
+    Returns:
+        np.ndarray: The float32 windows of shape (B, max(ends - starts), ...), zero padded on the left.
+    """
+    lengths = np.asarray([len(arr) for arr in arrays], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    L = int((ends - starts).max())
+    t = ends[:, None] - L + np.arange(L)[None, :]  # (B, L)
+    valid = t >= starts[:, None]
+    rows = offsets[array_idx][:, None] + np.where(valid, t, 0)
+    out = np.concatenate(arrays, axis=0)[rows].astype(np.float32, copy=False)
+    out[~valid] = 0
+    return out
+
+
 class SlicedTrajectoryDataset(Dataset):
     """Adapted from https://github.com/jayLEE0301/vq_bet_official"""
 
@@ -19,6 +67,7 @@ class SlicedTrajectoryDataset(Dataset):
         min_future_sep: int = 0,
         future_seq_len: int = 0,
         only_sample_tail: bool = False,
+        batched_fetch: bool = False,
     ) -> None:
         """
         Initializes the SlicedTrajectoryDataset.
@@ -47,6 +96,9 @@ class SlicedTrajectoryDataset(Dataset):
             only_sample_tail (bool):
                 If True, always use the final `future_seq_len` steps of the trajectory
                 as the future goal.
+            batched_fetch (bool):
+                If True, the DataLoader fetches whole batches through `get_batch`, which
+                should be paired with `collate_prebatched`.
         """
 
         self.dataset = dataset
@@ -56,6 +108,7 @@ class SlicedTrajectoryDataset(Dataset):
         self.min_future_sep = min_future_sep
         self.future_seq_len = future_seq_len
         self.only_sample_tail = only_sample_tail
+        self.batched_fetch = batched_fetch
 
         self.slices = []
         self._create_slices()
@@ -99,14 +152,7 @@ class SlicedTrajectoryDataset(Dataset):
         Returns:
             np.ndarray: Sliced and possibly flattened array.
         """
-        if horizon > 0:
-            arr_list = []
-            for t in range(start, end):
-                arr_slice = arr[t : t + 1 + horizon, :].flatten()
-                arr_list.append(arr_slice)
-            return np.stack(arr_list, axis=0)
-        else:
-            return arr[start:end]
+        return stack_horizon(arr[start : end + horizon], horizon)
 
     def __len__(self) -> int:
         return len(self.slices)
@@ -150,3 +196,121 @@ class SlicedTrajectoryDataset(Dataset):
         return Trajectory(
             states=states, actions=actions, prev_actions=prev_actions, goals=goals
         )
+
+    def _sample_goal_bounds(
+        self, ends: np.ndarray, traj_lens: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples the future goal sequence of every window, vectorized like `__getitem__`."""
+        tail = traj_lens - self.future_seq_len
+        if self.only_sample_tail:
+            goal_starts = tail
+        else:
+            low = ends + self.min_future_sep
+            sampled = np.random.randint(low, np.maximum(tail, low + 1))
+            goal_starts = np.where(low < tail, sampled, tail)
+        goal_starts = np.maximum(goal_starts, 0)
+        goal_ends = np.minimum(goal_starts + self.future_seq_len, traj_lens)
+        return goal_starts, goal_ends
+
+    def get_batch(self, indices: Sequence[int], pin_memory: bool = False) -> Batch:
+        """Builds a batch of windows directly, without per-window `Trajectory` objects.
+
+        Every trajectory is fetched once per batch, and every field is left-padded with a single
+        gather into a preallocated array, matching the output of `collate_policy`.
+
+        Args:
+            indices (Sequence[int]): The window indices.
+            pin_memory (bool): Whether to return the batch in pinned memory. Defaults to False.
+
+        Returns:
+            Batch: The batch of windows.
+        """
+        slices = np.asarray([self.slices[idx] for idx in indices], dtype=np.int64)
+        traj_ids, inverse = np.unique(slices[:, 0], return_inverse=True)
+        trajs = [self.dataset[int(i)] for i in traj_ids]
+        starts, ends = slices[:, 1], slices[:, 2]
+        lengths = torch.from_numpy(ends - starts)
+
+        def span(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            """The range of every trajectory covered by its windows in the batch."""
+            lo = np.full(len(trajs), np.iinfo(np.int64).max)
+            hi = np.zeros(len(trajs), dtype=np.int64)
+            np.minimum.at(lo, inverse, starts)
+            np.maximum.at(hi, inverse, ends)
+            return lo, hi
+
+        def gather(
+            arrays: List[np.ndarray],
+            lo: np.ndarray,
+            starts: np.ndarray,
+            ends: np.ndarray,
+        ) -> torch.Tensor:
+            """Gathers the windows out of the arrays sliced from `lo`."""
+            offsets = lo[inverse]
+            return torch.from_numpy(
+                gather_windows(arrays, inverse, starts - offsets, ends - offsets)
+            )
+
+        # only the covered range of every trajectory is converted, not the whole trajectory
+        lo, hi = span(starts, ends)
+        h = self.action_horizon
+        x = gather(
+            [
+                np.asarray(traj.states[int(a) : int(b)])
+                for traj, a, b in zip(trajs, lo, hi)
+            ],
+            lo,
+            starts,
+            ends,
+        )
+        y = gather(
+            [
+                stack_horizon(np.asarray(traj.actions[int(a) : int(b) + h]), h)
+                for traj, a, b in zip(trajs, lo, hi)
+            ],
+            lo,
+            starts,
+            ends,
+        )
+        prev_actions = None
+        if trajs[0].prev_actions is not None:
+            prev_actions = gather(
+                [
+                    stack_horizon(np.asarray(traj.prev_actions[int(a) : int(b) + h]), h)
+                    for traj, a, b in zip(trajs, lo, hi)
+                ],
+                lo,
+                starts,
+                ends,
+            )
+        goals = None
+        if self.dataset.include_goals:
+            traj_lens = np.asarray([len(traj) for traj in trajs], dtype=np.int64)
+            goal_starts, goal_ends = self._sample_goal_bounds(ends, traj_lens[inverse])
+            goal_lo, goal_hi = span(goal_starts, goal_ends)
+            goals = gather(
+                [
+                    np.asarray(traj.goals[int(a) : int(b)])
+                    for traj, a, b in zip(trajs, goal_lo, goal_hi)
+                ],
+                goal_lo,
+                goal_starts,
+                goal_ends,
+            )
+
+        L = x.size(1)
+        validity_mask = torch.arange(L).flip(0)[None, :] < lengths[:, None]
+        batch = Batch(
+            x=x,
+            y=y,
+            prev_actions=prev_actions,
+            validity_mask=validity_mask,
+            conditional_seq=goals,
+        )
+        return batch.pin_memory() if pin_memory else batch
+
+    def __getitems__(self, indices: List[int]) -> Union[Batch, List[Trajectory]]:
+        """Batch-level fetch used by the DataLoader."""
+        if self.batched_fetch:
+            return self.get_batch(indices)
+        return [self[idx] for idx in indices]
@@ -1,13 +1,17 @@
-import random
 from abc import ABC, abstractmethod
 
 import numpy as np
-from PIL import Image, ImageEnhance
+import torch
 
 from qfat.datasets.dataset import Trajectory
+from qfat.runtime_transforms.image_augmentation import BatchedImageAugmentation
 
 
 class TrajectoryTransform(ABC):
+    # whether the transform draws new random parameters at every call, such transforms can't
+    # be applied once ahead of time (e.g by `compile_window_store`)
+    is_random: bool = False
+
     @abstractmethod
     def __call__(self, trajectory: Trajectory) -> Trajectory:
         pass
@@ -37,6 +41,25 @@ class ConcatPrevActionsTransform(TrajectoryTransform):
 
 
 class ImgAugTransform(TrajectoryTransform):
+    is_random = True
+
+    def __init__(self) -> None:
+        """Random color jitter and random crop + resize of the image states of a trajectory,
+        every frame with its own parameters."""
+        self.augmentations = BatchedImageAugmentation(
+            brightness=0.2,
+            contrast=0.2,
+            saturation=0.2,
+            jitter_prob=0.5,
+            # crops of 80% to 100% of the width and of the height
+            crop_scale=(0.64, 1.0),
+            crop_ratio=(0.8, 1.25),
+            crop_prob=0.5,
+            grayscale_prob=0.0,
+            max_value=255.0,
+            interpolation="nearest",
+        )
+
     def __call__(self, trajectory: Trajectory) -> Trajectory:
         """
         Augments the images that are input to a CNN model.
@@ -47,96 +70,12 @@ class ImgAugTransform(TrajectoryTransform):
         Returns:
             Trajectory: A new trajectory with the augmented images.
         """
-        augmented_images = []
-        for (
-            img
-        ) in trajectory.states:  # Assuming states are images (episode_len, W, H, 3)
-            augmented_img = self._augment_image(img)
-            augmented_images.append(augmented_img)
-
-        augmented_images = np.stack(augmented_images)
+        # Assuming states are images (episode_len, W, H, 3)
+        images = torch.from_numpy(np.asarray(trajectory.states).astype("uint8"))
+        augmented_images = self.augmentations(images[None])[0].numpy()
 
         return Trajectory(
             states=augmented_images,
             actions=trajectory.actions,
             goals=trajectory.goals,
         )
-
-    def _augment_image(self, img: np.ndarray) -> np.ndarray:
-        """
-        Apply random color jitter and random cropping + resizing to an image.
-
-        Args:
-            img (np.ndarray): The image to augment, shape (W, H, 3).
-
-        Returns:
-            np.ndarray: The augmented image, shape (W, H, 3).
-        """
-        pil_img = Image.fromarray(img.astype("uint8"))  # Convert to PIL image
-        # Apply color jitter
-        if random.random() < 0.5:
-            pil_img = self._apply_color_jitter(pil_img)
-
-        # Apply random cropping and resizing
-        if random.random() < 0.5:
-            pil_img = self._apply_random_crop_and_resize(
-                pil_img, target_size=pil_img.size
-            )
-
-        return np.array(pil_img)  # Convert back to NumPy array
-
-    def _apply_color_jitter(self, pil_img: Image.Image) -> Image.Image:
-        """
-        Apply random color jitter to the PIL image.
-
-        Args:
-            pil_img (Image.Image): The input PIL image.
-
-        Returns:
-            Image.Image: The color-jittered image.
-        """
-        brightness_factor = random.uniform(0.8, 1.2)
-        contrast_factor = random.uniform(0.8, 1.2)
-        saturation_factor = random.uniform(0.8, 1.2)
-
-        # Apply brightness
-        enhancer = ImageEnhance.Brightness(pil_img)
-        pil_img = enhancer.enhance(brightness_factor)
-
-        # Apply contrast
-        enhancer = ImageEnhance.Contrast(pil_img)
-        pil_img = enhancer.enhance(contrast_factor)
-
-        # Apply saturation
-        enhancer = ImageEnhance.Color(pil_img)
-        pil_img = enhancer.enhance(saturation_factor)
-
-        return pil_img
-
-    def _apply_random_crop_and_resize(
-        self, pil_img: Image.Image, target_size=(224, 224)
-    ) -> Image.Image:
-        """
-        Apply random cropping and resizing to the PIL image.
-
-        Args:
-            pil_img (Image.Image): The input PIL image.
-            target_size (tuple): The target size (width, height) for resizing.
-
-        Returns:
-            Image.Image: The cropped and resized image.
-        """
-        width, height = pil_img.size
-        crop_width = random.randint(int(width * 0.8), width)
-        crop_height = random.randint(int(height * 0.8), height)
-
-        left = random.randint(0, width - crop_width)
-        top = random.randint(0, height - crop_height)
-        right = left + crop_width
-        bottom = top + crop_height
-
-        # Crop and resize
-        pil_img = pil_img.crop((left, top, right, bottom))
-        pil_img = pil_img.resize(target_size, Image.Resampling.NEAREST)
-
-        return pil_img
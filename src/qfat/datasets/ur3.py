@@ -49,6 +49,12 @@ class UR3TrajectoryDataset(TrajectoryDataset):
 
         self._trajectories = self._create_trajectories(states, actions, mask)
 
+    def data_files(self) -> List[Path]:
+        return [
+            self.data_dir / name
+            for name in ["data_act.npy", "data_obs.npy", "data_msk.npy"]
+        ]
+
     def _load_data(self) -> Tuple[NDArray, NDArray, NDArray]:
         """Load data from files."""
         actions = np.load(self.data_dir / "data_act.npy")
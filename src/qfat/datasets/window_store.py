@@ -0,0 +1,364 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from omegaconf import OmegaConf
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from qfat.datasets.dataset import (
+    Batch,
+    SubsetTrajectoryDataset,
+    Trajectory,
+    TrajectoryDataset,
+    data_files_signature,
+)
+from qfat.datasets.slicer import SlicedTrajectoryDataset, stack_horizon
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+WINDOW_ARRAYS = ["states", "actions", "prev_actions", "lengths", "index"]
+
+
+def _root_dataset(dataset: SlicedTrajectoryDataset) -> TrajectoryDataset:
+    base = dataset.dataset
+    if isinstance(base, SubsetTrajectoryDataset):
+        return base.subset.dataset
+    return base
+
+
+def _check_transforms(dataset: SlicedTrajectoryDataset) -> None:
+    """Raises if a trajectory transform is random, since the store would freeze a single draw
+    of it (e.g a single augmentation of every image)."""
+    for ds in {id(d): d for d in [dataset.dataset, _root_dataset(dataset)]}.values():
+        for transform in ds.transforms or []:
+            if getattr(transform, "is_random", True):
+                raise ValueError(
+                    f"The window store can't be compiled with the random transform "
+                    f"{type(transform).__name__}, apply it as a runtime transform instead."
+                )
+
+
+def _fingerprint(
+    dataset: SlicedTrajectoryDataset, dataset_cfg: Optional[Any] = None
+) -> str:
+    """Hashes what determines the content of the windows, including the size and modification
+    time of the data files listed by the root dataset."""
+    h = hashlib.sha1()
+    h.update(np.asarray(dataset.slices, dtype=np.int64).tobytes())
+    base = dataset.dataset
+    if isinstance(base, SubsetTrajectoryDataset):
+        h.update(np.asarray(base.subset.indices, dtype=np.int64).tobytes())
+    root = _root_dataset(dataset)
+    traj: Trajectory = base[0]
+    # the per step shapes and the dtypes of the fields, e.g of the images or of the goals
+    signature = {}
+    for name in ["states", "actions", "prev_actions", "goals"]:
+        value = getattr(traj, name)
+        if value is not None:
+            value = np.asarray(value)
+            signature[name] = [list(value.shape[1:]), str(value.dtype)]
+    h.update(
+        json.dumps(
+            [
+                dataset.window,
+                dataset.action_horizon,
+                dataset.min_future_sep,
+                dataset.future_seq_len,
+                dataset.only_sample_tail,
+                f"{type(root).__module__}.{type(root).__qualname__}",
+                [type(t).__qualname__ for t in root.transforms or []],
+                base.include_goals,
+                signature,
+            ]
+        ).encode()
+    )
+    data_signature = data_files_signature(root)
+    if not data_signature:
+        logger.warning(
+            f"{type(root).__name__} doesn't list its data files, the window store can't detect "
+            f"changes of the raw data: pass overwrite=True after regenerating or editing it."
+        )
+    h.update("\n".join(data_signature).encode())
+    if dataset_cfg is not None:
+        h.update(OmegaConf.to_yaml(OmegaConf.create(dataset_cfg)).encode())
+    return h.hexdigest()
+
+
+def compile_window_store(
+    dataset: SlicedTrajectoryDataset,
+    store_dir: Union[str, Path],
+    overwrite: bool = False,
+    dataset_cfg: Optional[Any] = None,
+) -> Path:
+    """Materializes all the windows of a sliced dataset into memory-mapped arrays.
+
+    Every trajectory goes through the parent dataset (and its transforms) exactly once, random
+    transforms are therefore rejected. The store is recompiled when its fingerprint changes, i.e
+    the slicing, the dataset config or the data files listed by `TrajectoryDataset.data_files`.
+    Datasets that don't list their data files can't be checked for changes of the raw data, the
+    store then has to be recompiled with `overwrite=True` after the data changed. The
+    windows are left-padded to the window length, which matches the padding of `collate_policy`.
+    The goals can't be materialized per window since the future goal start is sampled at every
+    access, so the goals of every trajectory are stored once together with the index needed to
+    sample them at batch time.
+
+    Args:
+        dataset (SlicedTrajectoryDataset): The sliced dataset to compile.
+        store_dir (Union[str, Path]): The directory to write the store to.
+        overwrite (bool): Whether to recompile a store that already matches the dataset.
+            A store that does not match the dataset is always recompiled. Defaults to False.
+        dataset_cfg (Optional[Any]): The config the dataset was instantiated from, which is
+            part of the fingerprint, such that e.g a change of the normalization or of the mode
+            recompiles the store. Defaults to None.
+
+    Returns:
+        Path: The store directory.
+
+    Raises:
+        ValueError: If a transform of the dataset is random.
+        ValueError: If goals are included and a trajectory is shorter than the goal sequence,
+            or its goals are not aligned with its states.
+    """
+    _check_transforms(dataset)
+    store_dir = Path(store_dir)
+    fingerprint = _fingerprint(dataset, dataset_cfg)
+    meta_path = store_dir / META_FILE
+    if meta_path.exists() and not overwrite:
+        with open(meta_path, "r") as f:
+            if json.load(f)["fingerprint"] == fingerprint:
+                logger.info(f"Reusing the window store at {store_dir}")
+                return store_dir
+        logger.info(f"The window store at {store_dir} is stale, recompiling it.")
+    store_dir.mkdir(parents=True, exist_ok=True)
+    if meta_path.exists():
+        meta_path.unlink()  # invalidates the store until it is fully written
+
+    base = dataset.dataset
+    slices = np.asarray(dataset.slices, dtype=np.int64).reshape(-1, 3)
+    W, H = dataset.window, dataset.action_horizon
+    include_goals = base.include_goals
+    n_windows = len(slices)
+    traj_ids, first = np.unique(slices[:, 0], return_index=True)
+    bounds = list(first[1:]) + [n_windows]
+
+    arrays: Dict[str, np.ndarray] = {}
+    goals_list: List[np.ndarray] = []
+    goal_offset = 0
+    for traj_id, lo, hi in tqdm(
+        zip(traj_ids, first, bounds), total=len(traj_ids), desc="Compiling windows"
+    ):
+        traj: Trajectory = base[int(traj_id)]
+        actions = stack_horizon(np.asarray(traj.actions), H)
+        prev_actions = (
+            stack_horizon(np.asarray(traj.prev_actions), H)
+            if traj.prev_actions is not None
+            else None
+        )
+        if not arrays:
+            states_dtype = np.asarray(traj.states).dtype
+            arrays["states"] = open_memmap(
+                store_dir / "states.npy",
+                mode="w+",
+                # integer states (e.g images) are kept as is, the rest is stored as float32
+                dtype=states_dtype
+                if np.issubdtype(states_dtype, np.integer)
+                else np.float32,
+                shape=(n_windows, W, *traj.states.shape[1:]),
+            )
+            arrays["actions"] = open_memmap(
+                store_dir / "actions.npy",
+                mode="w+",
+                dtype=np.float32,
+                shape=(n_windows, W, actions.shape[-1]),
+            )
+            if prev_actions is not None:
+                arrays["prev_actions"] = open_memmap(
+                    store_dir / "prev_actions.npy",
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(n_windows, W, prev_actions.shape[-1]),
+                )
+            arrays["lengths"] = open_memmap(
+                store_dir / "lengths.npy", mode="w+", dtype=np.int64, shape=(n_windows,)
+            )
+            # goal offset of the trajectory, window end, trajectory length
+            arrays["index"] = open_memmap(
+                store_dir / "index.npy", mode="w+", dtype=np.int64, shape=(n_windows, 3)
+            )
+
+        starts, ends = slices[lo:hi, 1], slices[lo:hi, 2]
+        # time index of every padded window position, negative indices are padding
+        t = ends[:, None] - W + np.arange(W)[None, :]
+        valid = t >= starts[:, None]
+        t = np.where(valid, t, 0)
+        pad = ~valid.reshape(*valid.shape, *([1] * (traj.states.ndim - 1)))
+
+        arrays["states"][lo:hi] = np.where(pad, 0, np.asarray(traj.states)[t])
+        arrays["actions"][lo:hi] = np.where(~valid[..., None], 0, actions[t])
+        if "prev_actions" in arrays:
+            arrays["prev_actions"][lo:hi] = np.where(
+                ~valid[..., None], 0, prev_actions[t]
+            )
+        arrays["lengths"][lo:hi] = ends - starts
+        T = len(traj)
+        arrays["index"][lo:hi, 0] = goal_offset
+        arrays["index"][lo:hi, 1] = ends
+        arrays["index"][lo:hi, 2] = T
+        if include_goals:
+            if T < dataset.future_seq_len:
+                raise ValueError(
+                    f"Trajectory {traj_id} is shorter ({T}) than the goal sequence "
+                    f"({dataset.future_seq_len})."
+                )
+            if len(traj.goals) != T:
+                raise ValueError(
+                    f"Trajectory {traj_id} has {len(traj.goals)} goals for {T} states."
+                )
+            goals_list.append(np.asarray(traj.goals))
+            goal_offset += T
+
+    if include_goals:
+        goals = open_memmap(
+            store_dir / "goals.npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=(goal_offset, *goals_list[0].shape[1:]),
+        )
+        goals[:] = np.concatenate(goals_list, axis=0)
+        goals.flush()
+    for arr in arrays.values():
+        arr.flush()
+
+    meta = {
+        "fingerprint": fingerprint,
+        "n_windows": n_windows,
+        "window": W,
+        "action_horizon": H,
+        "min_future_sep": dataset.min_future_sep,
+        "future_seq_len": dataset.future_seq_len,
+        "only_sample_tail": dataset.only_sample_tail,
+        "include_goals": include_goals,
+        "include_prev_actions": "prev_actions" in arrays,
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"Compiled {n_windows} windows into {store_dir}")
+    return store_dir
+
+
+class WindowStoreDataset(Dataset):
+    def __init__(self, store_dir: Union[str, Path], mmap_mode: Optional[str] = "r"):
+        """Serves the windows compiled by `compile_window_store`.
+
+        A whole batch is gathered with a single fancy-indexing per array through `__getitems__`,
+        which the DataLoader calls with the indices of a batch, and is returned as a `Batch` that
+        `collate_prebatched` passes through. The arrays are opened lazily, such that every
+        DataLoader worker maps the files itself instead of receiving a pickled copy.
+
+        Args:
+            store_dir (Union[str, Path]): The directory of the compiled store.
+            mmap_mode (Optional[str]): The numpy memory-map mode, None loads the arrays in memory.
+                Defaults to "r".
+        """
+        self.store_dir = Path(store_dir)
+        self.mmap_mode = mmap_mode
+        with open(self.store_dir / META_FILE, "r") as f:
+            self.meta = json.load(f)
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            names = list(WINDOW_ARRAYS)
+            if self.meta["include_goals"]:
+                names.append("goals")
+            self._arrays = {
+                name: np.load(self.store_dir / f"{name}.npy", mmap_mode=self.mmap_mode)
+                for name in names
+                if (self.store_dir / f"{name}.npy").exists()
+            }
+        return self._arrays
+
+    @property
+    def include_goals(self) -> bool:
+        return self.meta["include_goals"]
+
+    def __len__(self) -> int:
+        return self.meta["n_windows"]
+
+    def _sample_goals(self, idx: np.ndarray) -> np.ndarray:
+        """Samples the future goal sequences of the windows like `SlicedTrajectoryDataset`."""
+        offsets, ends, lengths = self.arrays["index"][idx].T
+        future_seq_len = self.meta["future_seq_len"]
+        low = ends + self.meta["min_future_sep"]
+        high = lengths - future_seq_len
+        tail = lengths - future_seq_len
+        if self.meta["only_sample_tail"]:
+            start = tail
+        else:
+            sampled = np.random.randint(low, np.maximum(high, low + 1))
+            start = np.where(low < high, sampled, tail)
+        rows = offsets[:, None] + start[:, None] + np.arange(future_seq_len)[None, :]
+        return self.arrays["goals"][rows]
+
+    def get_batch(self, indices: Sequence[int]) -> Batch:
+        """Gathers a batch of windows, trimmed to the longest window of the batch.
+
+        Args:
+            indices (Sequence[int]): The window indices.
+
+        Returns:
+            Batch: The batch, padded and masked like `collate_policy` does.
+        """
+        idx = np.asarray(indices, dtype=np.int64)
+        arrays = self.arrays
+        lengths = torch.from_numpy(np.asarray(arrays["lengths"][idx]))
+        L = int(lengths.max())
+
+        def gather(name: str) -> torch.Tensor:
+            return torch.from_numpy(
+                np.ascontiguousarray(arrays[name][idx][:, -L:], dtype=np.float32)
+            )
+
+        validity_mask = torch.arange(L).flip(0)[None, :] < lengths[:, None]
+        return Batch(
+            x=gather("states"),
+            y=gather("actions"),
+            prev_actions=gather("prev_actions") if "prev_actions" in arrays else None,
+            validity_mask=validity_mask,
+            conditional_seq=torch.from_numpy(
+                np.asarray(self._sample_goals(idx), dtype=np.float32)
+            )
+            if self.include_goals
+            else None,
+        )
+
+    def __getitems__(self, indices: List[int]) -> Batch:
+        return self.get_batch(indices)
+
+    def __getitem__(self, idx: int) -> Trajectory:
+        """Returns a single (unpadded) window, e.g for use with `collate_policy`."""
+        arrays = self.arrays
+        length = int(arrays["lengths"][idx])
+        return Trajectory(
+            states=np.asarray(arrays["states"][idx, -length:]),
+            actions=np.asarray(arrays["actions"][idx, -length:]),
+            prev_actions=np.asarray(arrays["prev_actions"][idx, -length:])
+            if "prev_actions" in arrays
+            else None,
+            goals=self._sample_goals(np.array([idx]))[0]
+            if self.include_goals
+            else None,
+        )
@@ -0,0 +1,173 @@
+"""Samples from a QFAT policy exported with `qfat.models.export.export_onnx`.
+
+Only depends on numpy and onnxruntime, such that the policy can be served without importing
+torch, hydra or wandb. onnxruntime is an optional dependency, installed with the `onnx` extra
+(`pip install "qfat[onnx]"`).
+"""
+
+import logging
+from collections import deque
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def sample_gmm_numpy(
+    locs: np.ndarray,
+    mixture_probs: np.ndarray,
+    variances: np.ndarray,
+    temperature: float = 1,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """Samples a component and then a point from it, like `QFAT.sample_gmm`.
+
+    Args:
+        locs (np.ndarray): The locs of shape (B, K, D).
+        mixture_probs (np.ndarray): The mixture probabilities of shape (B, K).
+        variances (np.ndarray): The variances of shape (B, K, D).
+        temperature (float): A scale of the variances. Defaults to 1.
+        rng (Optional[np.random.Generator]): The random generator. Defaults to None, i.e a
+            new generator.
+
+    Returns:
+        np.ndarray: The samples of shape (B, D).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    B, K, _ = locs.shape
+    cdf = np.cumsum(mixture_probs, axis=-1)
+    u = rng.random((B, 1)) * cdf[:, -1:]
+    k = np.minimum((u > cdf).sum(axis=-1), K - 1)
+    batch_idx = np.arange(B)
+    std = np.sqrt(variances[batch_idx, k] * temperature)
+    return locs[batch_idx, k] + rng.standard_normal(std.shape) * std
+
+
+class OnnxPolicy:
+    def __init__(
+        self,
+        path: Union[str, Path],
+        temperature: float = 1,
+        seed: Optional[int] = None,
+        providers: Optional[List[str]] = None,
+        intra_op_num_threads: Optional[int] = None,
+    ) -> None:
+        """Keeps track of the observed context and samples the next action from the GMM predicted
+        by an ONNX graph of a QFAT model, like `AutoRegressiveSampler` with `sample_fn="gmm"`.
+
+        Args:
+            path (Union[str, Path]): The graph written by `export_onnx`.
+            temperature (float): A temperature to scale the variances of the model. Defaults to 1.
+            seed (Optional[int]): The seed of the sampling. Defaults to None.
+            providers (Optional[List[str]]): The ONNX Runtime execution providers. Defaults to
+                None, i.e the CPU.
+            intra_op_num_threads (Optional[int]): The number of threads of the session. Defaults
+                to None, i.e the ONNX Runtime default.
+
+        Raises:
+            ImportError: If onnxruntime is not installed.
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "OnnxPolicy requires onnxruntime, install it with the onnx extra: "
+                '`pip install "qfat[onnx]"` (or `pip install onnxruntime`).'
+            ) from e
+
+        options = ort.SessionOptions()
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        self.session = ort.InferenceSession(
+            str(path),
+            sess_options=options,
+            providers=["CPUExecutionProvider"] if providers is None else providers,
+        )
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.context_len = int(metadata["context_len"])
+        self.out_dim = int(metadata["out_dim"])
+        self.pad_sampling = bool(int(metadata["pad_sampling"]))
+        self.input_names = metadata["inputs"].split(",")
+        self.temperature = temperature
+        self.rng = np.random.default_rng(seed)
+        self.context = deque(maxlen=self.context_len)
+        self.horizon = 0
+
+    def reset(self) -> None:
+        """Clears the context."""
+        self.context.clear()
+
+    def _pad(self, x: np.ndarray) -> np.ndarray:
+        """Pre-pads a context with zeros to the context length, like `QFAT.sampling_preprocessing`."""
+        T = x.shape[1]
+        if not self.pad_sampling or T >= self.context_len:
+            return x
+        padding = np.zeros((x.shape[0], self.context_len - T, *x.shape[2:]), x.dtype)
+        return np.concatenate([padding, x], axis=1)
+
+    def predict(
+        self,
+        x: np.ndarray,
+        prev_actions: Optional[np.ndarray] = None,
+        conditional_seq: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Runs the graph on a batch of contexts.
+
+        Args:
+            x (np.ndarray): The contexts of shape (B, T, ...).
+            prev_actions (Optional[np.ndarray]): The previous actions, aligned with x.
+            conditional_seq (Optional[np.ndarray]): The conditional sequences (e.g goals).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: The locs (B, K, D), the mixture
+                probabilities (B, K) and the variances (B, K, D) of the last token.
+
+        Raises:
+            ValueError: If an input of the graph is missing.
+        """
+        inputs = {
+            "x": self._pad(np.asarray(x, dtype=np.float32)),
+            "prev_actions": self._pad(np.asarray(prev_actions, dtype=np.float32))
+            if prev_actions is not None
+            else None,
+            "conditional_seq": np.asarray(conditional_seq, dtype=np.float32)
+            if conditional_seq is not None
+            else None,
+        }
+        feed = {}
+        for name in self.input_names:
+            if inputs[name] is None:
+                raise ValueError(f"The graph expects the input '{name}'.")
+            feed[name] = inputs[name]
+        locs, mixture_probs, variances = self.session.run(None, feed)
+        return locs, mixture_probs, variances
+
+    def sample(
+        self,
+        x: Union[np.ndarray, Sequence[np.ndarray]],
+        prev_actions: Optional[np.ndarray] = None,
+        conditional_seq: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Adds the new observation(s) to the context and samples the next action.
+
+        Args:
+            x (Union[np.ndarray, Sequence[np.ndarray]]): The new observation, or a list of them.
+            prev_actions (Optional[np.ndarray]): The previous actions of the context, of shape (T, ...).
+            conditional_seq (Optional[np.ndarray]): The conditional sequence of shape (1, T_cond, ...).
+
+        Returns:
+            np.ndarray: The sampled action of shape (out_dim,).
+        """
+        if not isinstance(x, list):
+            x = [x]
+        self.context.extend(np.asarray(_x) for _x in x)
+        locs, mixture_probs, variances = self.predict(
+            np.stack(self.context, axis=0)[None],
+            prev_actions=prev_actions[None] if prev_actions is not None else None,
+            conditional_seq=conditional_seq,
+        )
+        return sample_gmm_numpy(
+            locs, mixture_probs, variances, self.temperature, self.rng
+        )[0]
@@ -0,0 +1,86 @@
+"""Helpers for multi-process data-parallel training with torch.distributed.
+
+The processes are expected to be launched with `torchrun`, which sets the RANK, WORLD_SIZE,
+MASTER_ADDR and MASTER_PORT environment variables. Without a process group every helper
+behaves like a single process of rank 0, such that the training code doesn't branch on
+whether it runs distributed.
+"""
+
+import contextlib
+import datetime
+import logging
+from typing import Any, Iterator
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+# rank 0 alone runs the validation and the rollouts while the others wait for it
+DEFAULT_TIMEOUT = datetime.timedelta(hours=2)
+
+
+def init_distributed(
+    backend: str = "gloo", timeout: datetime.timedelta = DEFAULT_TIMEOUT
+) -> None:
+    """Joins the process group described by the torchrun environment variables."""
+    if dist.is_initialized():
+        return
+    dist.init_process_group(backend=backend, timeout=timeout)
+    logger.info(
+        f"Initialized the '{backend}' process group, rank {get_rank()} of {get_world_size()}"
+    )
+
+
+def cleanup_distributed() -> None:
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first() -> Iterator[None]:
+    """Runs the block on rank 0 before the other ranks, e.g to build a cache they then read."""
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def broadcast_object(obj: Any, src: int = 0) -> Any:
+    """Returns the (picklable) object of rank src on every rank."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """Averages a tensor over the ranks, out of place."""
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / get_world_size()
@@ -5,6 +5,7 @@ from omegaconf import OmegaConf
 
 import wandb
 from qfat.conf.configs import EntrypointCfg
+from qfat.distributed import is_main_process
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +17,8 @@ class Entrypoint(ABC):
         self.run = None
 
     def _on_run_start(self) -> None:
-        """Starts a wandb run and logs the configs to the console."""
+        """Starts a wandb run and logs the configs to the console. In distributed runs, only
+        rank 0 logs to wandb, the run of the other ranks is disabled."""
         logger.info("Training entrypoint started.")
         logger.debug(self.cfg)
         wandb_cfg = self.cfg.wandb_cfg
@@ -29,13 +31,15 @@ class Entrypoint(ABC):
             notes=wandb_cfg.notes,
             config=dict(self.cfg),
             resume="allow",
-            mode=wandb_cfg.mode,
+            mode=wandb_cfg.mode if is_main_process() else "disabled",
             settings={
                 "_service_wait": 600,
                 "init_timeout": 600,
                 "_disable_stats": wandb_cfg.log_system_metrics,
             },
         )
+        if not is_main_process():
+            return
         # Log config file to be able to load it for reproducibility
         path = f"{self.run.dir}/hydra_config.yaml"
         with open(path, "w") as f:
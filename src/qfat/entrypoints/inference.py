@@ -1,21 +1,18 @@
 import logging
-import re
-import tempfile
 from collections import defaultdict
 from typing import Dict, List, Optional
 
 import hydra
 import numpy as np
 import torch
-import yaml
-from omegaconf import OmegaConf
 
-import wandb
 from qfat.callbacks.callbacks import Callback
 from qfat.conf.configs import InferenceEntrypointCfg, TrainingEntrypointCfg
 from qfat.entrypoints.entrypoint import Entrypoint
 from qfat.environments.goal_conditional import GoalAppendingWrapper
 from qfat.models.generative_model import ModelOutput
+from qfat.models.quantization import compare_precision, quantize_qfat
+from qfat.registry import ModelRegistry, RegistryEntry
 
 logger = logging.getLogger(__name__)
 ALLOWED_CALLBACKS = [
@@ -35,10 +32,16 @@ class InferenceEntrypoint(Entrypoint):
         callbacks: Optional[Dict[str, List[Callback]]] = None,
     ) -> None:
         self.cfg = cfg
-        self._api = wandb.Api()
-        self.training_run = self._api.run(cfg.training_run_id)
-        self.trainer_cfg: TrainingEntrypointCfg = self.load_training_config()
+        self.registry = ModelRegistry(cfg.registry_path)
+        self.model_entry: Optional[RegistryEntry] = None
+        self.trainer_cfg: Optional[TrainingEntrypointCfg] = None
         self.model = self.load_model()
+        self.precision_metrics: Dict[str, float] = {}
+        if cfg.precision != "fp32":
+            model = quantize_qfat(self.model, cfg.precision)
+            if cfg.precision_check_dataset_cfg is not None:
+                self.precision_metrics = self.check_precision(model)
+            self.model = model
         self.env = hydra.utils.instantiate(
             cfg.env_cfg, _recursive_=True, _convert_="none"
         )
@@ -62,80 +65,47 @@ class InferenceEntrypoint(Entrypoint):
         self.episode_rewards = []
         self.step = 0
 
-    def load_training_config(self) -> TrainingEntrypointCfg:
-        config_file = self.training_run.file("hydra_config.yaml")
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            config_file.download(
-                root=tmp_dir,
-                replace=True,
-            )
-            with open(f"{tmp_dir}/{config_file.name}", "r") as file:
-                config = yaml.safe_load(file)
-        return OmegaConf.create(config)
-
-    def _load_model_from_checkpoint(self) -> torch.nn.Module:
-        """
-        Loads a *full training checkpoint* (model + optimizer + scheduler + epoch)
-        but only restores the model's weights for inference.
-        """
-        checkpoint_artifact = self._api.artifact(
-            self.cfg.model_afid,
+    def check_precision(self, model: torch.nn.Module) -> Dict[str, float]:
+        """Compares the GMM parameters of the low precision model with the float32 ones on the
+        held-out dataset of 'precision_check_dataset_cfg', sliced like the training data."""
+        data = hydra.utils.instantiate(
+            self.cfg.precision_check_dataset_cfg, _recursive_=True, _convert_="none"
         )
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            artifact_dir = checkpoint_artifact.download(root=tmp_dir)
-            pattern = r"checkpoint_epoch_(\d+)"
-            match = re.search(pattern, self.cfg.model_afid)
-            checkpoint_path = f"{artifact_dir}/{match.group(0)}.pth"
-
-            checkpoint_data = torch.load(
-                checkpoint_path, map_location=torch.device(self.cfg.device)
+        if self.trainer_cfg.slicer_cfg is not None:
+            data = hydra.utils.instantiate(
+                self.trainer_cfg.slicer_cfg,
+                dataset=data,
+                _recursive_=False,
+                _convert_="none",
             )
-
-            model_cfg = self.trainer_cfg.model_cfg
-            model = hydra.utils.instantiate(
-                model_cfg, _recursive_=False, _convert_="none"
-            )
-            model.load_state_dict(checkpoint_data["model"], strict=False)
-
-            model.to(self.cfg.device)
-            model.eval()
-
-        return model
-
-    def _load_model_from_state_dict(self) -> torch.nn.Module:
-        artifact = self._api.artifact(self.cfg.model_afid, type="model")
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            artifact_dir = artifact.download(root=tmp_dir)
-            model = hydra.utils.instantiate(
-                self.trainer_cfg.model_cfg, _recursive_=False, _convert_="none"
-            )
-            pattern = r"model_epoch_(\d+)"
-            match = re.search(pattern, self.cfg.model_afid)
-            model_path = f"{artifact_dir}/{match.group(0)}.pth"
-            model.load_state_dict(
-                torch.load(
-                    model_path,
-                    weights_only=True,
-                    map_location=torch.device(self.cfg.device),
-                ),
-                strict=False,
-            )
-        model.eval()
-        model.to(self.cfg.device)
-        return model
+        metrics = compare_precision(self.model, model, data)
+        for name, value in metrics.items():
+            logger.info(f"{self.cfg.precision} vs fp32 | {name}: {value:.3e}")
+        return metrics
 
     def load_model(self) -> torch.nn.Module:
-        if "model" in self.cfg.model_afid:
-            model = self._load_model_from_state_dict()
-        elif "checkpoint" in self.cfg.model_afid:
-            model = self._load_model_from_checkpoint()
-        else:
-            raise ValueError()
-        return model
+        """Loads the model from the local registry, fetching it from wandb first if it is not
+        registered and 'wandb_fallback' is set."""
+        self.model_entry = self.registry.load(
+            self.cfg.model_afid,
+            training_run_id=self.cfg.training_run_id,
+            wandb_fallback=self.cfg.wandb_fallback,
+        )
+        logger.info(
+            f"Loading '{self.cfg.model_afid}' from the registry entry {self.model_entry.digest[:12]}"
+        )
+        self.trainer_cfg = self.model_entry.load_config()
+        return self.model_entry.load_model(self.cfg.device)
 
     def _on_run_start(self) -> None:
         super()._on_run_start()
+        if self.precision_metrics:
+            self.run.summary.update(
+                {
+                    f"precision/{name}": value
+                    for name, value in self.precision_metrics.items()
+                }
+            )
         if "run_start" in self.callbacks.keys():
             for clb in self.callbacks["run_start"]:
                 clb(self)
@@ -1,21 +1,43 @@
+import contextlib
 import logging
 import tempfile
+import time
 from collections import defaultdict
-from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import Callable, ContextManager, Dict, List, Optional, Tuple
 
 import hydra
 import torch
 import torch.utils
 import torch.utils.data
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, Subset
 from tqdm import tqdm
 
 import wandb
 from qfat.callbacks.callbacks import Callback
+from qfat.checkpointing import AsyncCheckpointWriter
 from qfat.conf.configs import TrainingEntrypointCfg
-from qfat.datasets.dataset import IMPLEMENTED_COLLATE_FNS, Batch
+from qfat.datasets.dataset import IMPLEMENTED_COLLATE_FNS, Batch, collate_prebatched
+from qfat.datasets.device_loader import DeviceResidentLoader
+from qfat.datasets.embedding_cache import EmbeddingStoreDataset, compile_embedding_store
+from qfat.datasets.window_store import WindowStoreDataset, compile_window_store
+from qfat.distributed import (
+    all_reduce_mean,
+    broadcast_object,
+    cleanup_distributed,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_distributed,
+    is_main_process,
+    main_process_first,
+)
 from qfat.entrypoints.entrypoint import Entrypoint
+from qfat.models.encoders import HierarchicalResNet
 from qfat.models.generative_model import ModelOutput
+from qfat.registry import ModelRegistry
+from qfat.runtime_transforms.runtime_transforms import ImageAugmentationTransform
 from qfat.utils import (
     get_latest_model_name,
     load_training_config,
@@ -76,12 +98,19 @@ class TrainingEntrypoint(Entrypoint):
         data = hydra.utils.instantiate(
             cfg.training_dataset_cfg, _recursive_=True, _convert_="none"
         )
+        if cfg.embedding_cache_dir is not None:
+            data = self._get_embedding_dataset(data)
         train_data = data
         val_data = None
         if cfg.train_ratio != 1:
             len_train = int(cfg.train_ratio * len(data))
             len_val = len(data) - len_train
-            train_data, val_data = data.split(lengths=[len_train, len_val])
+            split_kwargs = {}
+            if is_distributed():  # the same split on every rank
+                split_kwargs["generator"] = torch.Generator().manual_seed(cfg.seed)
+            train_data, val_data = data.split(
+                lengths=[len_train, len_val], **split_kwargs
+            )
         if cfg.slicer_cfg is not None:
             train_data = hydra.utils.instantiate(
                 cfg.slicer_cfg, dataset=train_data, _recursive_=False, _convert_="none"
@@ -93,30 +122,142 @@ class TrainingEntrypoint(Entrypoint):
                     _recursive_=False,
                     _convert_="none",
                 )
+            if cfg.window_store_dir is not None:
+                store_dir = Path(cfg.window_store_dir)
+                train_data = WindowStoreDataset(
+                    compile_window_store(
+                        train_data,
+                        store_dir / "train",
+                        dataset_cfg=cfg.training_dataset_cfg,
+                    )
+                )
+                if val_data is not None:
+                    val_data = WindowStoreDataset(
+                        compile_window_store(
+                            val_data,
+                            store_dir / "val",
+                            dataset_cfg=cfg.training_dataset_cfg,
+                        )
+                    )
         return train_data, val_data
 
+    def _get_embedding_dataset(
+        self, data: torch.utils.data.Dataset
+    ) -> EmbeddingStoreDataset:
+        """Caches the backbone features of the frozen encoder and serves them in place of the images."""
+        encoder = self.model.encoder
+        if not isinstance(encoder, HierarchicalResNet) or not encoder.freeze_weights:
+            raise ValueError(
+                "The embedding cache requires a HierarchicalResNet encoder with frozen weights."
+            )
+        if any(
+            isinstance(transform, ImageAugmentationTransform)
+            for transform in self.runtime_transforms
+        ):
+            raise ValueError(
+                "Image augmentations can't be applied on top of the cached embeddings."
+            )
+        store_dir = compile_embedding_store(
+            data,
+            encoder,
+            self.cfg.embedding_cache_dir,
+            num_workers=self.cfg.train_dataloader_cfg.num_workers,
+            device=self.cfg.device,
+            dataset_cfg=self.cfg.training_dataset_cfg,
+        )
+        return EmbeddingStoreDataset(data, store_dir)
+
+    def _get_collate_fn(self, dataset: torch.utils.data.Dataset) -> Callable:
+        """Returns the configured collate function, unless the dataset builds whole batches."""
+        if isinstance(dataset, WindowStoreDataset) or getattr(
+            dataset, "batched_fetch", False
+        ):
+            return collate_prebatched
+        return IMPLEMENTED_COLLATE_FNS[self.cfg.collate_fn_name]
+
     def _get_data_loaders(self) -> Tuple[DataLoader, Optional[DataLoader]]:
         cfg_dlt = self.cfg.train_dataloader_cfg
+        if self.cfg.device_resident_data:
+            return self._get_device_resident_loaders()
+        sampler = None
+        if is_distributed():
+            # every rank draws a disjoint shard of the windows, of the same number of batches
+            sampler = DistributedSampler(
+                self.train_data, shuffle=cfg_dlt.shuffle, seed=self.cfg.seed
+            )
         train_loader = DataLoader(
             self.train_data,
-            shuffle=cfg_dlt.shuffle,
+            shuffle=cfg_dlt.shuffle if sampler is None else False,
+            sampler=sampler,
             pin_memory=cfg_dlt.pin_memory,
             batch_size=cfg_dlt.batch_size,
             num_workers=cfg_dlt.num_workers,
-            collate_fn=IMPLEMENTED_COLLATE_FNS[self.cfg.collate_fn_name],
+            collate_fn=self._get_collate_fn(self.train_data),
             persistent_workers=cfg_dlt.persistent_workers,
         )
         val_loader = None
         if self.val_data is not None:
             cfg_dle = self.cfg.val_dataloader_cfg
             val_loader = DataLoader(
-                self.train_data,
+                self.val_data,
                 shuffle=cfg_dle.shuffle,
                 pin_memory=cfg_dle.pin_memory,
                 batch_size=cfg_dle.batch_size,
                 num_workers=cfg_dle.num_workers,
-                collate_fn=IMPLEMENTED_COLLATE_FNS[self.cfg.collate_fn_name],
+                collate_fn=self._get_collate_fn(self.val_data),
+            )
+        if val_loader is not None and self.cfg.val_subsample is not None:
+            val_loader = self._get_val_subset_batches()
+        logger.info(f"Number of training batches per epoch: {len(train_loader)}")
+        return train_loader, val_loader
+
+    def _get_val_subset_batches(self) -> List[Batch]:
+        """Collates a fixed random subset of 'val_subsample' validation windows once and keeps
+        the batches on the device, such that every validation only runs the forward passes."""
+        cfg_dle = self.cfg.val_dataloader_cfg
+        n_windows = min(self.cfg.val_subsample, len(self.val_data))
+        generator = torch.Generator().manual_seed(self.cfg.seed)
+        idx = torch.randperm(len(self.val_data), generator=generator)[:n_windows]
+        loader = DataLoader(
+            Subset(self.val_data, idx.sort().values.tolist()),
+            batch_size=cfg_dle.batch_size,
+            num_workers=cfg_dle.num_workers,
+            collate_fn=self._get_collate_fn(self.val_data),
+        )
+        batches = []
+        for batch in loader:
+            batch.to(self.cfg.device)
+            batches.append(batch)
+        logger.info(
+            f"Cached {n_windows} of the {len(self.val_data)} validation windows on {self.cfg.device}"
+        )
+        return batches
+
+    def _get_device_resident_loaders(
+        self,
+    ) -> Tuple[DeviceResidentLoader, Optional[DeviceResidentLoader]]:
+        """Uploads the whole datasets to the training device, bypassing the DataLoader."""
+        cfg_dlt = self.cfg.train_dataloader_cfg
+        train_loader = DeviceResidentLoader(
+            self.train_data,
+            batch_size=cfg_dlt.batch_size,
+            shuffle=cfg_dlt.shuffle,
+            device=self.cfg.device,
+            num_replicas=get_world_size(),
+            rank=get_rank(),
+            seed=self.cfg.seed,
+        )
+        val_loader = None
+        if self.val_data is not None:
+            cfg_dle = self.cfg.val_dataloader_cfg
+            val_loader = DeviceResidentLoader(
+                self.val_data,
+                batch_size=cfg_dle.batch_size,
+                shuffle=cfg_dle.shuffle,
+                device=self.cfg.device,
             )
+        if val_loader is not None and self.cfg.val_subsample is not None:
+            val_loader = self._get_val_subset_batches()
         logger.info(f"Number of training batches per epoch: {len(train_loader)}")
         return train_loader, val_loader
 
@@ -131,39 +272,22 @@ class TrainingEntrypoint(Entrypoint):
             for clb in self.callbacks["epoch_end"]:
                 clb(self)
 
-        if self.val_data is not None:
+        if self.val_data is not None and is_main_process():
             if (self.epoch % cfg.n_eval) == 0 and self.epoch != 0:
                 logger.info(f"Starting model evaluation at epoch {self.epoch}")
                 self.val_loss = self._compute_val_loss()
-                self.run.log({"val/loss": self.val_loss})
+                self.run.log({"val/loss": self.val_loss, **self.val_metrics})
                 if self.val_loss < self.best_loss and self.cfg.log_best_model:
-                    model_path = f"{self.run.dir}/model.pth"
-                    torch.save(self.model.state_dict(), model_path)
-                    self.run.log_model(
-                        name=f"best_model_{self.run.id}",
-                        path=model_path,
-                        aliases=[f"epoch_{self.epoch}"],
-                    )
+                    self._save_best_model()
                     self.best_loss = self.val_loss
 
-        if (self.epoch % cfg.n_save_model) == 0 and self.epoch != 0:
+        save_model = (self.epoch % cfg.n_save_model) == 0 and self.epoch != 0
+        if save_model and is_main_process():
             logger.info(f"Logging checkpoint to wandb at epoch {self.epoch}")
-            checkpoint_path = f"{self.run.dir}/checkpoint_epoch_{self.epoch}.pth"
-
-            checkpoint = {
-                "epoch": self.epoch,
-                "model": self.model.state_dict(),
-                "optimizer": self.optimizer.state_dict()
-                if self.optimizer is not None
-                else None,
-                "scheduler": self.scheduler.state_dict()
-                if self.scheduler is not None
-                else None,
-            }
-            torch.save(checkpoint, checkpoint_path)
-            self.run.log_artifact(
-                checkpoint_path,
-                name=f"checkpoint_epoch_{self.epoch}_{self.run.id}",
+            self._save_checkpoint(
+                f"checkpoint_epoch_{self.epoch}.pth",
+                f"checkpoint_epoch_{self.epoch}_{self.run.id}",
+                rotate=True,
             )
 
         if self.model.optimizer_cfg.use_cosine_schedule:
@@ -178,21 +302,155 @@ class TrainingEntrypoint(Entrypoint):
 
         self.epoch += 1
 
-    def _compute_loss(self, batch: Batch) -> torch.Tensor:
-        output: ModelOutput = self.model(batch)
+    def _checkpoint_state(self) -> Dict:
+        return {
+            "epoch": self.epoch,
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict()
+            if self.optimizer is not None
+            else None,
+            "scheduler": self.scheduler.state_dict()
+            if self.scheduler is not None
+            else None,
+            "grad_scaler": self.grad_scaler.state_dict(),
+        }
+
+    def _save_checkpoint(
+        self, filename: str, artifact_name: str, rotate: bool = False
+    ) -> None:
+        """Writes a training checkpoint in the background, and logs it to wandb once written."""
+        epoch = self.epoch
+
+        def on_saved(path: Path, checkpoint: Dict) -> None:
+            artifact = self.run.log_artifact(str(path), name=artifact_name)
+            self._register_model(artifact_name, checkpoint["model"], epoch, artifact)
+
+        self.checkpoint_writer.save(
+            self._checkpoint_state(), filename, on_saved=on_saved, rotate=rotate
+        )
+
+    def _save_best_model(self) -> None:
+        """Writes the model weights in the background, and logs them to wandb once written."""
+        name, epoch = f"best_model_{self.run.id}", self.epoch
+
+        def on_saved(path: Path, state_dict: Dict) -> None:
+            # logged like `run.log_model`, which doesn't return the artifact
+            artifact = wandb.Artifact(name, type="model")
+            artifact.add_file(str(path))
+            artifact = self.run.log_artifact(artifact, aliases=[f"epoch_{epoch}"])
+            self._register_model(name, state_dict, epoch, artifact)
+
+        self.checkpoint_writer.save(
+            self.model.state_dict(), "model.pth", on_saved=on_saved
+        )
+
+    def _register_model(
+        self,
+        name: str,
+        state_dict: Dict[str, torch.Tensor],
+        epoch: int,
+        artifact: Optional[wandb.Artifact] = None,
+    ) -> None:
+        """Stores a model in the local model registry if 'registry_path' is set, such that it
+        can be loaded without network access.
+
+        The entry is tagged with the name of its wandb artifact, which always points to the
+        latest registered model, and with the logged version of the artifact (e.g 'name:v3').
+        """
+        if self.cfg.registry_path is None:
+            return
+        registry = ModelRegistry(self.cfg.registry_path)
+        entry = registry.put(
+            self.cfg,
+            state_dict,
+            stats_path=getattr(self.cfg.training_dataset_cfg, "stats_path", None),
+            name=name,
+            metadata={"training_run_id": self.run.path, "epoch": epoch},
+        )
+        if artifact is None:
+            return
+        try:
+            # blocks until the upload is committed, which assigns the version
+            version = artifact.wait().version
+        except ValueError as e:  # e.g offline runs, whose artifacts have no version
+            logger.warning(f"Registered '{name}' without its wandb version: {e}")
+            return
+        registry.tag(f"{name}:{version}", entry.digest)
+
+    def _configure_precision(self) -> None:
+        """Sets the autocast dtype of the training forward, and the gradient scaler that keeps the
+        float16 gradients from underflowing (a no-op for the other precisions)."""
+        device_type = torch.device(self.cfg.device).type
+        dtypes = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+        if self.cfg.precision not in dtypes:
+            raise ValueError(
+                f"Unknown precision '{self.cfg.precision}', choose one of {list(dtypes)}."
+            )
+        if self.cfg.precision == "fp16" and device_type == "cpu":
+            raise ValueError("float16 training is not supported on cpu, use 'bf16'.")
+        if self.cfg.grad_accumulation_steps < 1:
+            raise ValueError("grad_accumulation_steps must be at least 1.")
+        self.autocast_dtype = dtypes[self.cfg.precision]
+        self.grad_scaler = torch.amp.GradScaler(
+            device_type, enabled=self.cfg.precision == "fp16"
+        )
+
+    def _autocast(self) -> ContextManager:
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(
+            device_type=torch.device(self.cfg.device).type, dtype=self.autocast_dtype
+        )
+
+    def _optimizer_step(self) -> None:
+        """Steps the optimizer on the accumulated gradients and clears them."""
+        self.grad_scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(
+            self.model.parameters(), self.model.optimizer_cfg.grad_norm_clip
+        )
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+        self.model.zero_grad(set_to_none=True)
+
+    def _compute_loss(
+        self, batch: Batch, model: Optional[torch.nn.Module] = None
+    ) -> torch.Tensor:
+        output: ModelOutput = (self.model if model is None else model)(batch)
         loss = output.loss
         loss = loss * self.loss_scaling
         return loss
 
     @torch.inference_mode()
-    def _compute_val_loss(self) -> torch.Tensor:
-        val_loss = 0
+    def _compute_val_loss(self) -> float:
+        """Computes the negative log likelihood of the validation targets, averaged over all the
+        valid tokens (rather than over the batches, which hold different numbers of valid tokens)
+        and scaled like the training loss. The sums stay on the device until the end of the pass.
+        The throughput of the pass is stored in 'val_metrics'."""
         self.model.eval()
+        nll_sums, token_counts = [], []
+        n_windows = 0
+        start = time.perf_counter()
         for batch in tqdm(self.val_loader, desc="Evaluating Model"):
             batch.to(self.cfg.device)
-            val_loss += self._compute_loss(batch=batch)
-        val_loss = val_loss / len(self.val_loader)
-        return val_loss
+            with self._autocast():
+                nll = self.model.token_nll(batch)
+            mask = (
+                batch.validity_mask
+                if batch.validity_mask is not None
+                else torch.ones_like(nll)
+            )
+            nll_sums.append((nll * mask).sum())
+            token_counts.append(mask.sum())
+            n_windows += nll.size(0)
+        nll_sum = torch.stack(nll_sums).cpu().double().sum().item()
+        n_tokens = torch.stack(token_counts).cpu().double().sum().item()
+        elapsed = time.perf_counter() - start
+        self.val_metrics = {
+            "val/n_tokens": n_tokens,
+            "val/windows_per_second": n_windows / elapsed,
+            "val/tokens_per_second": n_tokens / elapsed,
+        }
+        return nll_sum / n_tokens * self.loss_scaling
 
     def _on_iteration_start(self) -> None:
         if "iteration_start" in self.callbacks.keys():
@@ -205,42 +463,73 @@ class TrainingEntrypoint(Entrypoint):
                 clb(self)
         if self.batch_counter % self.cfg.n_train_loss == 0:
             self.run.log(
-                {"train/loss": self.train_loss.detach()},
+                {"train/loss": all_reduce_mean(self.train_loss.detach())},
             )
         self.train_loss = None
 
-    def load_checkpoint_from_wandb(self) -> None:
-        """Loads a model, optimizer and scheduler from the given run"""
+    def _download_checkpoint(self) -> Tuple[Dict, TrainingEntrypointCfg]:
+        """Downloads the latest checkpoint and the trainer config of the run."""
         artifact = self.run.use_artifact(
             get_latest_model_name(self.run.path, checkpoint=True)
         )
         trainer_cfg = load_training_config(self.run.path)
         with tempfile.TemporaryDirectory() as tmp_dir:
             artifact_dir = artifact.download(root=tmp_dir)
-            self.model = hydra.utils.instantiate(
-                trainer_cfg.model_cfg, _recursive_=False, _convert_="none"
-            )
             checkpoint_path = f"{artifact_dir}/checkpoint.pth"
-            checkpoint = torch.load(checkpoint_path)
-            self.model.load_state_dict(checkpoint["model"], strict=False)
-            self.model.to(self.cfg.device)
-            self.optimizer = self.model._configure_optimizer()
-            self.optimizer.load_state_dict(checkpoint["optimizer"])
-            if checkpoint["scheduler"] is not None:
-                self._configure_scheduler()
-                self.scheduler.load_state_dict(checkpoint["scheduler"])
-            if not self.cfg.reset_epoch:
-                self.epoch = checkpoint["epoch"]
-            if not self.cfg.reset_cfg:
-                logger.info("Using the trainer config logged in the data")
-                self.cfg = trainer_cfg
+            checkpoint = torch.load(checkpoint_path, map_location="cpu")
+        return checkpoint, trainer_cfg
+
+    def load_checkpoint_from_wandb(self) -> None:
+        """Loads a model, optimizer and scheduler from the given run. In distributed runs, rank 0
+        downloads the checkpoint and broadcasts it to the other ranks."""
+        checkpoint, trainer_cfg, error = None, None, None
+        if is_main_process():
+            try:
+                checkpoint, trainer_cfg = self._download_checkpoint()
+            except Exception as e:
+                error = str(e)
+        checkpoint, trainer_cfg, error = broadcast_object(
+            (checkpoint, trainer_cfg, error)
+        )
+        if error is not None:
+            raise RuntimeError(error)
+        self.model = hydra.utils.instantiate(
+            trainer_cfg.model_cfg, _recursive_=False, _convert_="none"
+        )
+        self.model.load_state_dict(checkpoint["model"], strict=False)
+        self.model.to(self.cfg.device)
+        self.optimizer = self.model._configure_optimizer()
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        if checkpoint["scheduler"] is not None:
+            self._configure_scheduler()
+            self.scheduler.load_state_dict(checkpoint["scheduler"])
+        if checkpoint.get("grad_scaler"):
+            self.grad_scaler.load_state_dict(checkpoint["grad_scaler"])
+        if not self.cfg.reset_epoch:
+            self.epoch = checkpoint["epoch"]
+        if not self.cfg.reset_cfg:
+            logger.info("Using the trainer config logged in the data")
+            self.cfg = trainer_cfg
 
     def _on_run_start(self) -> None:
+        if self.cfg.distributed_backend is not None:
+            init_distributed(self.cfg.distributed_backend)
         super()._on_run_start()
+        self.checkpoint_writer = None
+        if is_main_process():
+            self.checkpoint_writer = AsyncCheckpointWriter(
+                self.cfg.checkpoint_dir or self.run.dir,
+                max_checkpoints=self.cfg.max_local_checkpoints,
+                blocking=not self.cfg.async_checkpointing,
+            )
+        else:
+            # the callbacks (e.g the rollouts) only run on rank 0
+            self.callbacks = {}
 
         self.optimizer = None  # set inside _run function
         self.scheduler = None  # set inside _run function
         self.epoch = 0
+        self._configure_precision()
         try:
             logger.info("Attempting to load the latest checkpoint from wandb...")
             self.load_checkpoint_from_wandb()
@@ -270,6 +559,7 @@ class TrainingEntrypoint(Entrypoint):
 
         self.train_loss = None
         self.val_loss = None
+        self.val_metrics: Dict[str, float] = {}
         self.best_loss = float("inf")
         self.batch_counter = 0
         self.global_batch_counter = 0
@@ -284,55 +574,74 @@ class TrainingEntrypoint(Entrypoint):
         for _, key_callbacks in self.callbacks.items():
             for callback in key_callbacks:
                 callback.finalize()
-        logger.info("Logging checkpoint")
-        checkpoint_path = f"{self.run.dir}/checkpoint.pth"
-        checkpoint = {
-            "epoch": self.epoch,
-            "model": self.model.state_dict(),
-            "optimizer": self.optimizer.state_dict()
-            if self.optimizer is not None
-            else None,
-            "scheduler": self.scheduler.state_dict()
-            if self.scheduler is not None
-            else None,
-        }
-        torch.save(checkpoint, checkpoint_path)
-        self.run.log_artifact(
-            checkpoint_path,
-            name=f"checkpoint_{self.run.id}",
-        )
-        return super()._on_run_end()
+        if is_main_process():
+            logger.info("Logging checkpoint")
+            self._save_checkpoint("checkpoint.pth", f"checkpoint_{self.run.id}")
+            # the run can only finish once the checkpoints are logged
+            self.checkpoint_writer.close()
+        run_id = super()._on_run_end()
+        cleanup_distributed()
+        return run_id
 
     def _run(self) -> None:
         """Runs a training loop on the passed model."""
         cfg: TrainingEntrypointCfg = self.cfg
-        self.train_data, self.val_data = self._get_datasets()
+        with main_process_first():  # the window and embedding stores are built once
+            self.train_data, self.val_data = self._get_datasets()
         self.train_loader, self.val_loader = self._get_data_loaders()
         self.model.to(cfg.device)
+        self.parallel_model = self.model
+        if is_distributed():
+            self.parallel_model = DistributedDataParallel(
+                self.model,
+                broadcast_buffers=False,
+                find_unused_parameters=cfg.find_unused_parameters,
+            )
         if self.optimizer is None:
             self.optimizer = self.model._configure_optimizer()
         if self.scheduler is None:
             if self.model.optimizer_cfg.use_cosine_schedule:
                 self._configure_scheduler()
+        self.model.zero_grad(set_to_none=True)
 
         epochs = tqdm(
             range(self.epoch, self.model.optimizer_cfg.n_epochs), desc="Training epochs"
         )
         for _ in epochs:
             self._on_epoch_start()
+            if hasattr(self.train_loader, "set_epoch"):
+                self.train_loader.set_epoch(self.epoch)
+            elif isinstance(self.train_loader.sampler, DistributedSampler):
+                self.train_loader.sampler.set_epoch(self.epoch)
             self.model.train()
             for self.batch_counter, batch in enumerate(self.train_loader):
                 self._on_iteration_start()
                 batch.to(self.cfg.device)
                 for transform in self.runtime_transforms:
                     batch = transform(batch, self.epoch)
-                train_loss = self._compute_loss(batch)
-                self.model.zero_grad(set_to_none=True)
-                train_loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    self.model.parameters(), self.model.optimizer_cfg.grad_norm_clip
+                n_batches = self.batch_counter + 1
+                is_last_batch = n_batches == len(self.train_loader)
+                step = n_batches % cfg.grad_accumulation_steps == 0 or is_last_batch
+                # the last group of an epoch can hold fewer batches, its mean is over those
+                group_start = (
+                    self.batch_counter
+                    - self.batch_counter % cfg.grad_accumulation_steps
+                )
+                group_size = min(
+                    cfg.grad_accumulation_steps, len(self.train_loader) - group_start
+                )
+                # the gradients are only averaged over the ranks on the optimizer steps
+                sync = (
+                    contextlib.nullcontext()
+                    if step or not is_distributed()
+                    else self.parallel_model.no_sync()
                 )
-                self.optimizer.step()
+                with sync:
+                    with self._autocast():
+                        train_loss = self._compute_loss(batch, self.parallel_model)
+                    self.grad_scaler.scale(train_loss / group_size).backward()
+                if step:
+                    self._optimizer_step()
                 self.train_loss = train_loss.detach()
                 self._on_iteration_end()
             self._on_epoch_end()
@@ -1,14 +1,191 @@
 import logging
-from typing import Any, Dict
+from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from qfat.conf.configs import DecoderBlockCfg
 
 logger = logging.getLogger(__name__)
 
 
+class SelfAttention(nn.Module):
+    def __init__(
+        self,
+        embed_dim: int,
+        num_heads: int,
+        dropout: float = 0.0,
+        bias: bool = True,
+        add_bias_kv: bool = False,
+        add_zero_attn: bool = False,
+        device: Optional[str] = None,
+    ) -> None:
+        """A multi-head self attention built on `F.scaled_dot_product_attention`.
+
+        The query, key and value projections are fused into a single matmul. The parameters are
+        named and initialized like the ones of `nn.MultiheadAttention` (`in_proj_weight`,
+        `in_proj_bias`, `out_proj`, `bias_k` and `bias_v`), such that existing state dicts load as is.
+
+        Args:
+            embed_dim (int): Total dimension of the model.
+            num_heads (int): Number of parallel attention heads.
+            dropout (float): Dropout probability on the attention weights. Defaults to 0.
+            bias (bool): Adds bias to input/output projection layers. Defaults to True.
+            add_bias_kv (bool): Adds bias to the key and value sequences. Defaults to False.
+            add_zero_attn (bool): Adds zeros to the key and value sequences. Defaults to False.
+            device (Optional[str]): The device of the parameters. Defaults to None.
+        """
+        super().__init__()
+        if embed_dim % num_heads != 0:
+            raise ValueError("embed_dim must be divisible by num_heads.")
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.dropout = dropout
+        self.add_zero_attn = add_zero_attn
+        self.in_proj_weight = nn.Parameter(
+            torch.empty(3 * embed_dim, embed_dim, device=device)
+        )
+        self.in_proj_bias = (
+            nn.Parameter(torch.empty(3 * embed_dim, device=device)) if bias else None
+        )
+        # replaces the fused projection by a module, e.g a quantized linear for inference
+        self.in_proj: Optional[nn.Module] = None
+        self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias, device=device)
+        if add_bias_kv:
+            self.bias_k = nn.Parameter(torch.empty(1, 1, embed_dim, device=device))
+            self.bias_v = nn.Parameter(torch.empty(1, 1, embed_dim, device=device))
+        else:
+            self.bias_k = self.bias_v = None
+        self._reset_parameters()
+
+    def _reset_parameters(self) -> None:
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        if self.in_proj_bias is not None:
+            nn.init.zeros_(self.in_proj_bias)
+            nn.init.zeros_(self.out_proj.bias)
+        if self.bias_k is not None:
+            nn.init.xavier_normal_(self.bias_k)
+            nn.init.xavier_normal_(self.bias_v)
+
+    def project_qkv(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Projects the input to the queries, keys and values with a single matmul.
+
+        Args:
+            x (torch.Tensor): The input of shape (batch_size, sequence_length, embed_dim).
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: The queries, keys and values, each of shape
+                (batch_size, num_heads, sequence_length, head_dim).
+        """
+        B, T, _ = x.shape
+        if self.in_proj is not None:
+            qkv = self.in_proj(x)
+        else:
+            qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        qkv = qkv.view(B, T, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        return qkv[0], qkv[1], qkv[2]
+
+    def attend(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+        is_causal: bool = False,
+        key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Computes the attention of the queries over the keys and values, and projects it back.
+
+        Args:
+            q (torch.Tensor): Queries of shape (batch_size, num_heads, query_length, head_dim).
+            k (torch.Tensor): Keys of shape (batch_size, num_heads, key_length, head_dim).
+            v (torch.Tensor): Values of shape (batch_size, num_heads, key_length, head_dim).
+            attn_mask (Optional[torch.Tensor]): A boolean mask of shape (query_length, key_length),
+                where True marks the positions that are allowed to be attended to.
+            is_causal (bool): Whether to apply a causal mask instead of attn_mask. Defaults to False.
+            key_padding_mask (Optional[torch.Tensor]): A boolean mask of shape (batch_size, key_length),
+                where True marks the keys to ignore, like in nn.MultiheadAttention. Defaults to None.
+
+        Returns:
+            torch.Tensor: The attention output of shape (batch_size, query_length, embed_dim).
+        """
+        B, _, T, _ = q.shape
+        if key_padding_mask is not None:
+            if is_causal:
+                attn_mask = torch.ones(
+                    T, k.size(2), dtype=torch.bool, device=q.device
+                ).tril()
+                is_causal = False
+            keep = ~key_padding_mask.bool()[:, None, None, :]  # (B, 1, 1, key_length)
+            attn_mask = keep if attn_mask is None else attn_mask & keep
+        extra = []
+        if self.bias_k is not None:
+            extra.append(
+                (
+                    self.bias_k.view(1, self.num_heads, 1, self.head_dim),
+                    self.bias_v.view(1, self.num_heads, 1, self.head_dim),
+                )
+            )
+        if self.add_zero_attn:
+            zeros = k.new_zeros(1, self.num_heads, 1, self.head_dim)
+            extra.append((zeros, zeros))
+        if extra:
+            # the extra keys and values can always be attended to, like in nn.MultiheadAttention
+            if is_causal:
+                attn_mask = torch.ones(
+                    T, k.size(2), dtype=torch.bool, device=q.device
+                ).tril()
+                is_causal = False
+            k = torch.cat([k, *(ek.expand(B, -1, -1, -1) for ek, _ in extra)], dim=2)
+            v = torch.cat([v, *(ev.expand(B, -1, -1, -1) for _, ev in extra)], dim=2)
+            if attn_mask is not None:
+                attn_mask = F.pad(attn_mask, (0, len(extra)), value=True)
+
+        out = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            is_causal=is_causal,
+        )
+        return self.out_proj(out.transpose(1, 2).reshape(B, T, self.embed_dim))
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+        is_causal: bool = False,
+        key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Self attention over the input sequence.
+
+        Args:
+            x (torch.Tensor): The input of shape (batch_size, sequence_length, embed_dim).
+            attn_mask (Optional[torch.Tensor]): A boolean mask of shape (sequence_length, sequence_length),
+                where True marks the positions that are allowed to be attended to.
+            is_causal (bool): Whether to apply a causal mask instead of attn_mask. Defaults to False.
+            key_padding_mask (Optional[torch.Tensor]): A boolean mask of shape (batch_size, sequence_length),
+                where True marks the tokens to ignore, like in nn.MultiheadAttention. Defaults to None.
+
+        Returns:
+            torch.Tensor: The attention output of shape (batch_size, sequence_length, embed_dim).
+        """
+        q, k, v = self.project_qkv(x)
+        return self.attend(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            is_causal=is_causal,
+            key_padding_mask=key_padding_mask,
+        )
+
+
 class DecoderBlock(nn.Module):
     """A Transformer decoder block.
 
@@ -19,7 +196,7 @@ class DecoderBlock(nn.Module):
         super().__init__()
         mha_cfg = cfg.mha_cfg
         self.ln_1 = nn.LayerNorm(mha_cfg.embed_dim)
-        self.attn = nn.MultiheadAttention(**mha_cfg, batch_first=True)
+        self.attn = SelfAttention(**mha_cfg)
         self.ln_2 = nn.LayerNorm(mha_cfg.embed_dim)
         self.mlp = nn.ModuleDict(
             dict(
@@ -33,10 +210,18 @@ class DecoderBlock(nn.Module):
                 dropout=nn.Dropout(cfg.residual_dropout),
             )
         )
+
+    def mlpf(self, x: torch.Tensor) -> torch.Tensor:
         m = self.mlp
-        self.mlpf = lambda x: m.dropout(m.c_proj(m.act(m.c_fc(x))))
+        return m.dropout(m.c_proj(m.act(m.c_fc(x))))
 
-    def forward(self, x: torch.Tensor, **mha_kwargs: Dict[str, Any]) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+        is_causal: bool = False,
+        key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         """Runs the input through a decoder block.
 
         The input is assumed to be of shape (batch_size, sequence_length, embedding_dim)
@@ -51,16 +236,59 @@ class DecoderBlock(nn.Module):
 
         Args:
             x (torch.tensor): The input sequence of shape (batch_size, sequence_length, embedding_dim).
-            mha_kwargs (Dict[str, Any]): kwargs to the multi-headed-attention forward pass, e.g a mask.
+            attn_mask (Optional[torch.Tensor]): A boolean mask of shape (sequence_length, sequence_length)
+                where True marks the positions that are allowed to be attended to.
+            is_causal (bool): Whether to apply a causal mask instead of attn_mask, which lets
+                scaled_dot_product_attention dispatch to its fused causal kernels. Defaults to False.
+            key_padding_mask (Optional[torch.Tensor]): A boolean mask of shape (batch_size, sequence_length)
+                where True marks the tokens to ignore. Defaults to None.
         Returns:
             torch.Tensor: A contextualized sequence of shape (batch_size, sequence_length, embedding_dim).
         """
-        if mha_kwargs == {}:
-            logger.debug(
-                "No arguments passed to the MultiHeadAttention layer forward pass."
-            )
         x = self.ln_1(x)
-        attn_out, _ = self.attn(query=x, key=x, value=x, **mha_kwargs)
-        x = x + attn_out
+        x = x + self.attn(
+            x,
+            attn_mask=attn_mask,
+            is_causal=is_causal,
+            key_padding_mask=key_padding_mask,
+        )
         x = x + self.mlpf(self.ln_2(x))
         return x
+
+    def forward_with_cache(
+        self,
+        x: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """Runs the decoder block on new tokens only, attending to cached keys and values.
+
+        Numerically equivalent to `forward` for the new tokens, as long as the cached
+        keys and values were computed for the same prefix.
+
+        Args:
+            x (torch.Tensor): The new tokens of shape (batch_size, new_sequence_length, embedding_dim).
+            attn_mask (Optional[torch.Tensor]): A boolean mask of shape (new_sequence_length, total_sequence_length)
+                where True marks the positions that are allowed to be attended to.
+            past_key_value (Optional[Tuple[torch.Tensor, torch.Tensor]]): Cached keys and values, each of shape
+                (batch_size, num_heads, past_sequence_length, head_dim). Defaults to None.
+
+        Returns:
+            Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]: The contextualized new tokens and
+                the updated keys and values (past and new tokens concatenated).
+        """
+        attn = self.attn
+        if attn.bias_k is not None or attn.add_zero_attn:
+            raise NotImplementedError(
+                "Cached decoding does not support 'add_bias_kv' or 'add_zero_attn'."
+            )
+        x = self.ln_1(x)
+        q, k, v = attn.project_qkv(x)
+        if past_key_value is not None:
+            past_k, past_v = past_key_value
+            k = torch.cat([past_k, k], dim=2)
+            v = torch.cat([past_v, v], dim=2)
+
+        x = x + attn.attend(q, k, v, attn_mask=attn_mask)
+        x = x + self.mlpf(self.ln_2(x))
+        return x, (k, v)
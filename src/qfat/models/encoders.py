@@ -1,3 +1,8 @@
+import contextlib
+import hashlib
+import json
+from typing import Optional
+
 import einops
 import torch
 import torch.nn as nn
@@ -42,17 +47,35 @@ class IdentityEncoder(nn.Module):
 
 
 class HierarchicalResNet(nn.Module):
-    def __init__(self, freeze_weights: bool = True):
+    def __init__(
+        self,
+        freeze_weights: bool = True,
+        input_resolution: Optional[int] = 224,
+        channels_last: bool = False,
+        use_bfloat16: bool = False,
+    ):
         """
         ResNet-based hierarchical encoder for image embeddings.
 
         Args:
             freeze_weights (bool): Whether to freeze ResNet weights.
+            input_resolution (Optional[int]): The resolution the images are resized to before the
+                ResNet, None keeps the native resolution (e.g 96 for PushT). Defaults to 224.
+            channels_last (bool): Whether to run the convolutions in channels-last memory format.
+            use_bfloat16 (bool): Whether to run the ResNet layers in bfloat16 autocast.
         """
         super().__init__()
         self.transform = transforms.Normalize(
             mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
         )
+        self.input_resolution = input_resolution
+        self.channels_last = channels_last
+        self.use_bfloat16 = use_bfloat16
+        # (img / 255 - mean) / std folded into a single affine map, not part of the state dict
+        std = torch.tensor(self.transform.std).view(1, 3, 1, 1)
+        mean = torch.tensor(self.transform.mean).view(1, 3, 1, 1)
+        self.register_buffer("pixel_scale", 1 / (255.0 * std), persistent=False)
+        self.register_buffer("pixel_shift", mean / std, persistent=False)
         resnet = resnet18(weights=ResNet18_Weights.IMAGENET1K_V1)
         self.freeze_weights = freeze_weights
 
@@ -77,6 +100,9 @@ class HierarchicalResNet(nn.Module):
             nn.Linear(64 + 128 + 256 + 512, 1024),  # Combined channels
             nn.ReLU(),
         )
+        if channels_last:
+            for layer in (self.layer1, self.layer2, self.layer3, self.layer4):
+                layer.to(memory_format=torch.channels_last)
 
     def preprocess(self, img: torch.Tensor) -> torch.Tensor:
         """
@@ -89,7 +115,8 @@ class HierarchicalResNet(nn.Module):
                                 - (B, T, H, W, C)
 
         Returns:
-            torch.Tensor: Preprocessed tensor of shape (B*T, C, 224, 224).
+            torch.Tensor: Preprocessed tensor of shape (B*T, C, R, R), with R the input resolution
+                (or the native resolution if it is None).
         """
         if img.ndim == 3:  # (H, W, C)
             img = img.unsqueeze(0).unsqueeze(1)
@@ -103,45 +130,115 @@ class HierarchicalResNet(nn.Module):
 
         img = einops.rearrange(
             img, "b t h w c -> (b t) c h w"
-        )  # flatten sequence into batch dimension
-        img = img / 255.0
-        if img.shape[-2:] != (224, 224):
-            img = F.interpolate(img, size=224, mode="bilinear", align_corners=False)
-        img_norm = self.transform(img)
-        return img_norm
+        )  # flatten sequence into batch dimension, a channels-last view of the input
+        # a single float copy at the input resolution, e.g of uint8 frames
+        img = img.to(torch.float32, copy=True)
+        size = self.input_resolution
+        if size is not None and img.shape[-2:] != (size, size):
+            # normalizing commutes with the (convex) bilinear interpolation
+            img = F.interpolate(img, size=size, mode="bilinear", align_corners=False)
+        img = img.mul_(self.pixel_scale).sub_(self.pixel_shift)
+        if self.channels_last:
+            img = img.contiguous(memory_format=torch.channels_last)
+        return img
+
+    @property
+    def feature_dim(self) -> int:
+        """The dimension of the pooled backbone features that are fed to the head."""
+        return self.head[0].in_features
+
+    def train(self, mode: bool = True) -> "HierarchicalResNet":
+        """Sets the training mode, keeping the frozen ResNet layers in evaluation mode such
+        that their batch norm statistics stay fixed and their features deterministic."""
+        super().train(mode)
+        if self.freeze_weights:
+            for layer in (self.layer1, self.layer2, self.layer3, self.layer4):
+                layer.eval()
+        return self
+
+    def fingerprint(self) -> str:
+        """Hashes the ResNet weights and the preprocessing, which fully determine the
+        backbone features of an image when the weights are frozen."""
+        h = hashlib.sha1()
+        for layer in (self.layer1, self.layer2, self.layer3, self.layer4):
+            for name, tensor in layer.state_dict().items():
+                h.update(name.encode())
+                h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        h.update(
+            json.dumps(
+                {
+                    "mean": list(self.transform.mean),
+                    "std": list(self.transform.std),
+                    "scale": 255.0,
+                    "size": self.input_resolution,
+                    "interpolation": "bilinear",
+                    "bfloat16": self.use_bfloat16,
+                }
+            ).encode()
+        )
+        return h.hexdigest()
 
-    def forward(self, img: torch.Tensor) -> torch.Tensor:
+    def extract_features(self, img: torch.Tensor) -> torch.Tensor:
         """
-        Compute ResNet hierarchical embeddings for the input images.
+        Compute the pooled hierarchical ResNet features, before the head.
 
         Args:
             img (torch.Tensor): Input tensor. Shape can be:
                                 - (H, W, C)
-                                - (B, H, W, C)
+                                - (T, H, W, C)
                                 - (B, T, H, W, C)
 
         Returns:
-            torch.Tensor: ResNet embeddings of shape (B, T, 512).
+            torch.Tensor: Features of shape (B*T, 960).
         """
         img_preprocessed = self.preprocess(img)
+        autocast = (
+            torch.autocast(device_type=img.device.type, dtype=torch.bfloat16)
+            if self.use_bfloat16
+            else contextlib.nullcontext()
+        )
 
-        # Extract intermediate features
-        x1 = self.layer1(img_preprocessed)  # (B*T, 64, H1, W1)
-        x2 = self.layer2(x1)  # (B*T, 128, H2, W2)
-        x3 = self.layer3(x2)  # (B*T, 256, H3, W3)
-        x4 = self.layer4(x3)  # (B*T, 512, H4, W4)
+        with autocast:
+            # Extract intermediate features
+            x1 = self.layer1(img_preprocessed)  # (B*T, 64, H1, W1)
+            x2 = self.layer2(x1)  # (B*T, 128, H2, W2)
+            x3 = self.layer3(x2)  # (B*T, 256, H3, W3)
+            x4 = self.layer4(x3)  # (B*T, 512, H4, W4)
 
-        # Perform global pooling and flatten
-        x1 = nn.functional.adaptive_avg_pool2d(x1, (1, 1)).flatten(1)
-        x2 = nn.functional.adaptive_avg_pool2d(x2, (1, 1)).flatten(1)
-        x3 = nn.functional.adaptive_avg_pool2d(x3, (1, 1)).flatten(1)
-        x4 = nn.functional.adaptive_avg_pool2d(x4, (1, 1)).flatten(1)
+            # Perform global pooling and flatten
+            x1 = nn.functional.adaptive_avg_pool2d(x1, (1, 1)).flatten(1)
+            x2 = nn.functional.adaptive_avg_pool2d(x2, (1, 1)).flatten(1)
+            x3 = nn.functional.adaptive_avg_pool2d(x3, (1, 1)).flatten(1)
+            x4 = nn.functional.adaptive_avg_pool2d(x4, (1, 1)).flatten(1)
 
         # Concatenate all features
-        combined_features = torch.cat([x1, x2, x3, x4], dim=1)  # (B*T, 960)
+        return torch.cat([x1, x2, x3, x4], dim=1).float()  # (B*T, 960)
+
+    def forward(self, img: torch.Tensor) -> torch.Tensor:
+        """
+        Compute ResNet hierarchical embeddings for the input images.
+
+        When the weights are frozen, precomputed backbone features (see `extract_features`)
+        of shape (..., 960) are accepted in place of the images and only go through the head.
+
+        Args:
+            img (torch.Tensor): Input tensor. Shape can be:
+                                - (H, W, C)
+                                - (B, H, W, C)
+                                - (B, T, H, W, C)
+                                - (B, T, 960), if the weights are frozen
+
+        Returns:
+            torch.Tensor: ResNet embeddings of shape (B, T, 512).
+        """
+        if self.freeze_weights and img.shape[-1] == self.feature_dim:
+            features = img
+            while features.ndim < 3:
+                features = features.unsqueeze(0)
+            return self.head(features)
 
         # Reduce dimensionality
-        embeddings = self.head(combined_features)  # (B*T, 512)
+        embeddings = self.head(self.extract_features(img))  # (B*T, 512)
 
         if embeddings.ndim == 1:
             embeddings = embeddings.unsqueeze(0)
@@ -0,0 +1,300 @@
+import logging
+from pathlib import Path
+from typing import Callable, Dict, Literal, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+
+from qfat.models.mode_search import find_gmm_modes
+from qfat.models.qfat import QFAT
+
+logger = logging.getLogger(__name__)
+
+GMMTensors = Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+ExportMethod = Literal["compile", "torchscript", "export"]
+
+
+class QFATInferenceModule(nn.Module):
+    def __init__(self, model: QFAT) -> None:
+        """Wraps a QFAT model into a tensor-only forward that returns the raw GMM parameters
+        of the last token, without any of the dataclasses of the training forward.
+
+        Args:
+            model (QFAT): The model, with a diagonal covariance.
+
+        Raises:
+            NotImplementedError: If the model uses a full covariance.
+        """
+        if model.full_covariance:
+            raise NotImplementedError(
+                "Only models with a diagonal covariance can be exported."
+            )
+        super().__init__()
+        self.model = model
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        prev_actions: Optional[torch.Tensor] = None,
+        conditional_seq: Optional[torch.Tensor] = None,
+    ) -> GMMTensors:
+        """Predicts the GMM of the next output given a context.
+
+        Args:
+            x (torch.Tensor): The context of shape (B, T, ...).
+            prev_actions (Optional[torch.Tensor]): The previous actions, aligned with x.
+            conditional_seq (Optional[torch.Tensor]): The conditional sequence (e.g goals).
+
+        Returns:
+            GMMTensors: The locs (B, K, D), the mixture probabilities (B, K) and the
+                variances (B, K, D) of the last token.
+        """
+        h = self.model._decode(x, prev_actions, conditional_seq)
+        gmm_params = self.model.parse_gmm_params(self.model.fc_out(h[:, -1:]))
+        return (
+            gmm_params.locs[:, 0],
+            gmm_params.mixture_probs[:, 0],
+            gmm_params.variances[:, 0],
+        )
+
+
+def export_qfat(
+    model: QFAT,
+    x: torch.Tensor,
+    prev_actions: Optional[torch.Tensor] = None,
+    conditional_seq: Optional[torch.Tensor] = None,
+    method: ExportMethod = "compile",
+    path: Optional[Union[str, Path]] = None,
+) -> Callable[..., GMMTensors]:
+    """Exports the inference forward of a QFAT model, specialized to the shapes of the example inputs.
+
+    The returned callable takes the same inputs as keyword arguments (x, and prev_actions and
+    conditional_seq if they were passed as examples) and returns the raw GMM parameters of
+    `QFATInferenceModule`, which the functions of this module sample from.
+
+    - "compile": `torch.compile` with static shapes, every new input shape recompiles.
+    - "torchscript": a frozen `torch.jit.trace`, saved with `torch.jit.save` if a path is passed.
+    - "export": a `torch.export` program, saved with `torch.export.save` if a path is passed.
+
+    Args:
+        model (QFAT): The model to export, it is set to eval mode.
+        x (torch.Tensor): An example context of shape (B, T, ...).
+        prev_actions (Optional[torch.Tensor]): Example previous actions. Defaults to None.
+        conditional_seq (Optional[torch.Tensor]): An example conditional sequence. Defaults to None.
+        method (ExportMethod): The export method. Defaults to "compile".
+        path (Optional[Union[str, Path]]): Where to save the artifact. Defaults to None.
+
+    Returns:
+        Callable[..., GMMTensors]: The exported forward.
+
+    Raises:
+        ValueError: If the method is unknown, or a path is passed for a compiled forward.
+    """
+    model.eval()
+    module = QFATInferenceModule(model).eval()
+    inputs = _inputs(x, prev_actions, conditional_seq)
+    if method == "compile":
+        if path is not None:
+            raise ValueError("Compiled forwards can't be saved, use 'export' instead.")
+        fn = torch.compile(module, dynamic=False, fullgraph=True)
+        with torch.inference_mode():
+            fn(**inputs)  # compiles for the example shapes
+        return fn
+    if method == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(module, example_kwarg_inputs=inputs)
+        traced = torch.jit.freeze(traced)
+        if path is not None:
+            torch.jit.save(traced, str(path))
+            logger.info(f"Saved the TorchScript forward to {path}")
+        return traced
+    if method == "export":
+        with torch.no_grad():
+            program = torch.export.export(module, args=(), kwargs=inputs)
+        # the masks built while exporting are not real tensors and can't be reused
+        model._attn_masks.clear()
+        if path is not None:
+            torch.export.save(program, str(path))
+            logger.info(f"Saved the exported program to {path}")
+        return program.module()
+    raise ValueError(f"Unknown export method '{method}'.")
+
+
+def export_onnx(
+    model: QFAT,
+    path: Union[str, Path],
+    x: torch.Tensor,
+    prev_actions: Optional[torch.Tensor] = None,
+    conditional_seq: Optional[torch.Tensor] = None,
+    opset_version: int = 17,
+    dynamic_seq_len: bool = True,
+) -> Path:
+    """Exports the inference forward of a QFAT model to an ONNX graph, which outputs the raw
+    GMM parameters ("locs", "mixture_probs" and "variances") of the last token.
+
+    The graph takes the inputs that were passed as examples, under the same names. Their batch
+    size is always dynamic, and so are the sequence lengths if `dynamic_seq_len`. The model
+    hyperparameters needed to sample from the graph (see `qfat.deploy.onnx_policy`) are stored
+    in the metadata of the graph.
+
+    Args:
+        model (QFAT): The model to export, it is set to eval mode.
+        path (Union[str, Path]): Where to save the graph.
+        x (torch.Tensor): An example context of shape (B, T, ...).
+        prev_actions (Optional[torch.Tensor]): Example previous actions. Defaults to None.
+        conditional_seq (Optional[torch.Tensor]): An example conditional sequence. Defaults to None.
+        opset_version (int): The ONNX opset. Defaults to 17.
+        dynamic_seq_len (bool): Whether the sequence lengths are dynamic. Defaults to True.
+
+    Returns:
+        Path: The path of the graph.
+
+    Raises:
+        ImportError: If onnx is not installed.
+    """
+    try:
+        import onnx
+    except ImportError as e:
+        raise ImportError(
+            "export_onnx requires onnx, install it with the onnx extra: "
+            '`pip install "qfat[onnx]"` (or `pip install onnx`).'
+        ) from e
+
+    model.eval()
+    module = QFATInferenceModule(model).eval()
+    inputs = _inputs(x, prev_actions, conditional_seq)
+    dynamic_axes = {name: {0: "batch"} for name in inputs}
+    if dynamic_seq_len:
+        for name in inputs:
+            dynamic_axes[name][1] = (
+                "cond_seq_len" if name == "conditional_seq" else "seq_len"
+            )
+    output_names = ["locs", "mixture_probs", "variances"]
+    dynamic_axes.update({name: {0: "batch"} for name in output_names})
+    path = Path(path)
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            # a trailing dict is passed as keyword arguments
+            (x, {name: value for name, value in inputs.items() if name != "x"}),
+            str(path),
+            input_names=list(inputs),
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+    graph = onnx.load(str(path))
+    metadata = {
+        "context_len": model.context_len,
+        "out_dim": model.out_dim,
+        "mixture_size": model.mixture_size,
+        "pad_sampling": int(model.pad_sampling),
+        "dynamic_seq_len": int(dynamic_seq_len),
+        "inputs": ",".join(inputs),
+    }
+    for key, value in metadata.items():
+        entry = graph.metadata_props.add()
+        entry.key, entry.value = key, str(value)
+    onnx.save(graph, str(path))
+    logger.info(f"Exported the model to {path}")
+    return path
+
+
+def load_exported_qfat(path: Union[str, Path]) -> Callable[..., GMMTensors]:
+    """Loads a forward saved by `export_qfat`, from a `torch.export` program if the file has
+    a '.pt2' suffix and from TorchScript otherwise."""
+    if Path(path).suffix == ".pt2":
+        return torch.export.load(str(path)).module()
+    return torch.jit.load(str(path))
+
+
+def _inputs(
+    x: torch.Tensor,
+    prev_actions: Optional[torch.Tensor] = None,
+    conditional_seq: Optional[torch.Tensor] = None,
+) -> Dict[str, torch.Tensor]:
+    inputs = {"x": x, "prev_actions": prev_actions, "conditional_seq": conditional_seq}
+    return {name: value for name, value in inputs.items() if value is not None}
+
+
+def sample_gmm_tensors(
+    locs: torch.Tensor,
+    mixture_probs: torch.Tensor,
+    variances: torch.Tensor,
+    temperature: float = 1,
+) -> torch.Tensor:
+    """Samples a component and then a point from it, like `QFAT.sample_gmm`.
+
+    Args:
+        locs (torch.Tensor): The locs of shape (B, K, D).
+        mixture_probs (torch.Tensor): The mixture probabilities of shape (B, K).
+        variances (torch.Tensor): The variances of shape (B, K, D).
+        temperature (float): A scale of the variances. Defaults to 1.
+
+    Returns:
+        torch.Tensor: The samples of shape (B, D).
+    """
+    batch_idx = torch.arange(locs.size(0), device=locs.device)
+    k = torch.multinomial(mixture_probs, 1).squeeze(-1)
+    std = (variances[batch_idx, k] * temperature).sqrt()
+    return locs[batch_idx, k] + torch.randn_like(std) * std
+
+
+def most_likely_mean(locs: torch.Tensor, mixture_probs: torch.Tensor) -> torch.Tensor:
+    """Returns the mean of the most likely component of every mixture, of shape (B, D)."""
+    batch_idx = torch.arange(locs.size(0), device=locs.device)
+    return locs[batch_idx, mixture_probs.argmax(dim=-1)]
+
+
+def sample_modes_tensors(
+    locs: torch.Tensor,
+    mixture_probs: torch.Tensor,
+    variances: torch.Tensor,
+    temperature: float = 1,
+    probs_tol: float = 1e-2,
+    **mode_search_kwargs,
+) -> torch.Tensor:
+    """Samples around the modes of the mixtures, like `QFAT.sample_modes`.
+
+    A mode is drawn with its Laplace-approximated mass and a point is sampled from the local
+    Gaussian around it. Rows without a valid mode fall back to `sample_gmm_tensors`.
+
+    Args:
+        locs (torch.Tensor): The locs of shape (B, K, D).
+        mixture_probs (torch.Tensor): The mixture probabilities of shape (B, K).
+        variances (torch.Tensor): The variances of shape (B, K, D).
+        temperature (float): A scale of the covariances. Defaults to 1.
+        probs_tol (float): Components with a probability below probs_tol times the largest
+            probability are dropped before the mode search. Defaults to 1e-2.
+        **mode_search_kwargs: Passed to `find_gmm_modes`.
+
+    Returns:
+        torch.Tensor: The samples of shape (B, D).
+    """
+    B, K, D = locs.shape
+    batch_idx = torch.arange(B, device=locs.device)
+    valid = (mixture_probs / mixture_probs.max(dim=-1, keepdim=True).values) > probs_tol
+    probs = mixture_probs * valid
+    probs = probs / probs.sum(dim=-1, keepdim=True)
+
+    gmm_modes = find_gmm_modes(probs, locs, variances, **mode_search_kwargs)
+    selected = gmm_modes.valid
+    eye = torch.eye(D, device=locs.device, dtype=gmm_modes.hessians.dtype)
+    negH = torch.where(selected[..., None, None], -gmm_modes.hessians, eye)
+    negH_inv = torch.linalg.inv(negH)
+    negH_inv = 0.5 * (negH_inv + negH_inv.transpose(-1, -2))
+
+    has_modes = selected.any(dim=-1)
+    weights = gmm_modes.log_likelihoods - 0.5 * torch.logdet(negH)
+    weights = weights.masked_fill(~selected, -torch.inf)
+    weights = weights.masked_fill(~has_modes[:, None], 0.0)
+    m = torch.distributions.Categorical(logits=weights).sample()
+    sample = torch.distributions.MultivariateNormal(
+        loc=gmm_modes.modes[batch_idx, m],
+        covariance_matrix=negH_inv[batch_idx, m] * temperature,
+    ).sample()
+    if not torch.all(has_modes):
+        fallback = sample_gmm_tensors(locs, probs, variances, temperature)
+        sample = torch.where(has_modes[:, None], sample, fallback)
+    return sample
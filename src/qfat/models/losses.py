@@ -0,0 +1,101 @@
+import math
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def gmm_nll_loss(
+    gmm_out: torch.Tensor,
+    y: torch.Tensor,
+    validity_mask: Optional[torch.Tensor],
+    mixture_size: int,
+    out_dim: int,
+    variance_tol: float = 1e-6,
+    lambda_mixtures: float = 0,
+) -> torch.Tensor:
+    """Computes the negative log likelihood of the targets under a diagonal GMM directly from
+    the raw output of the GMM head, without building intermediate parameter containers or
+    distribution objects.
+
+    The output is parsed like `QFAT.get_gmm_params` (means, mixture logits and softplus variances,
+    in that order), the component log likelihoods are reduced with a single log-sum-exp, and the
+    entropy regularizer of the mixture probabilities is added in the same pass. The function only
+    uses tensor operations, such that it can be wrapped in `torch.compile`.
+
+    Args:
+        gmm_out (torch.Tensor): The output of the GMM head of shape (batch_size, sequence_length,
+            mixture_size * (2 * out_dim + 1)).
+        y (torch.Tensor): The targets of shape (batch_size, sequence_length, out_dim).
+        validity_mask (Optional[torch.Tensor]): A mask denoting the validity of the sequence of
+            shape (batch_size, sequence_length).
+        mixture_size (int): The number of mixture components.
+        out_dim (int): The output dimension.
+        variance_tol (float): Lower bound on the variances. Defaults to 1e-6.
+        lambda_mixtures (float): The entropy regularization weight on the mixture probabilities.
+            Defaults to 0.
+
+    Returns:
+        torch.Tensor: The loss value.
+    """
+    neglog_prob, log_mixtures = _gmm_token_nll(
+        gmm_out, y, mixture_size, out_dim, variance_tol
+    )
+    if validity_mask is not None:
+        loss = (neglog_prob * validity_mask).sum() / validity_mask.sum()
+    else:
+        loss = neglog_prob.mean()
+    if lambda_mixtures != 0:
+        entropy = -(log_mixtures.exp() * log_mixtures).sum(dim=-1)
+        loss = loss + lambda_mixtures * entropy.mean()
+    return loss
+
+
+def gmm_token_nll(
+    gmm_out: torch.Tensor,
+    y: torch.Tensor,
+    mixture_size: int,
+    out_dim: int,
+    variance_tol: float = 1e-6,
+) -> torch.Tensor:
+    """Computes the negative log likelihood of every target token under a diagonal GMM, parsed
+    from the raw output of the GMM head like `gmm_nll_loss`, without any reduction or
+    regularization.
+
+    Args:
+        gmm_out (torch.Tensor): The output of the GMM head of shape (batch_size, sequence_length,
+            mixture_size * (2 * out_dim + 1)).
+        y (torch.Tensor): The targets of shape (batch_size, sequence_length, out_dim).
+        mixture_size (int): The number of mixture components.
+        out_dim (int): The output dimension.
+        variance_tol (float): Lower bound on the variances. Defaults to 1e-6.
+
+    Returns:
+        torch.Tensor: The negative log likelihoods of shape (batch_size, sequence_length).
+    """
+    neglog_prob, _ = _gmm_token_nll(gmm_out, y, mixture_size, out_dim, variance_tol)
+    return neglog_prob
+
+
+def _gmm_token_nll(
+    gmm_out: torch.Tensor,
+    y: torch.Tensor,
+    mixture_size: int,
+    out_dim: int,
+    variance_tol: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Returns the per token negative log likelihoods and the log mixture probabilities."""
+    K, D = mixture_size, out_dim
+    locs = gmm_out[..., : K * D].unflatten(-1, (K, D))
+    log_mixtures = F.log_softmax(gmm_out[..., K * D : K * D + K], dim=-1)
+    variances = F.softplus(gmm_out[..., K * D + K :]).clamp_min(variance_tol)
+    variances = variances.unflatten(-1, (K, D))
+
+    diff = y.unsqueeze(-2) - locs  # (batch_size, sequence_length, K, D)
+    component_log_probs = -0.5 * (
+        D * math.log(2 * math.pi)
+        + (diff.square() / variances).sum(dim=-1)
+        + variances.log().sum(dim=-1)
+    )
+    neglog_prob = -torch.logsumexp(component_log_probs + log_mixtures, dim=-1)
+    return neglog_prob, log_mixtures
@@ -0,0 +1,252 @@
+import logging
+import math
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import torch
+from line_profiler import profile
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GMMModes:
+    """The modes found by `find_gmm_modes`, padded to a fixed number of candidates per mixture."""
+
+    modes: torch.Tensor  # (batch_size, n_candidates, out_dim)
+    log_likelihoods: torch.Tensor  # log p(mode) (batch_size, n_candidates)
+    hessians: (
+        torch.Tensor
+    )  # Hessian of log p (batch_size, n_candidates, out_dim, out_dim)
+    valid: torch.Tensor  # local maxima kept after merging (batch_size, n_candidates)
+    n_iter: int  # the number of fixed-point iterations that were run
+
+
+def gmm_grad_and_hessian_logp(
+    x: torch.Tensor,
+    probs: torch.Tensor,
+    means: torch.Tensor,
+    variances: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Computes the gradient and the Hessian of log p(x) of a batch of diagonal Gaussian
+    mixtures, evaluated at a set of points per mixture.
+
+    Args:
+        x (torch.Tensor): The evaluation points of shape (B, M, D).
+        probs (torch.Tensor): The mixture probabilities of shape (B, K).
+        means (torch.Tensor): The component means of shape (B, K, D).
+        variances (torch.Tensor): The component variance diagonals of shape (B, K, D).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The gradients of shape (B, M, D) and the
+            Hessians of shape (B, M, D, D).
+    """
+    D = means.shape[-1]
+    diff = x.unsqueeze(2) - means.unsqueeze(1)  # [B, M, K, D]
+    inv_var = 1.0 / variances.clamp(min=1e-12)  # [B, K, D]
+    inv_var_expanded = inv_var.unsqueeze(1)  # [B, 1, K, D]
+
+    # log f_i(x): [B, M, K]
+    log_fi = (
+        -0.5 * (diff**2 * inv_var_expanded).sum(dim=-1)
+        - 0.5 * D * math.log(2.0 * math.pi)
+        - 0.5 * torch.log(variances).sum(dim=-1).unsqueeze(1)
+    )
+    # alpha_i(x) = pi_i f_i(x) / p(x), components with pi_i = 0 get alpha_i = 0
+    alpha = torch.softmax(probs.log().unsqueeze(1) + log_fi, dim=-1)  # [B, M, K]
+
+    # grad and Hess log f_i(x)
+    grads_fi = -(diff * inv_var_expanded)  # [B, M, K, D]
+    hess_fi = -inv_var_expanded  # [B, 1, K, D] => broadcast => [B, M, K, D]
+
+    # grad log p(x) = sum_i alpha_i * grad log f_i(x)
+    grad_logp = torch.sum(alpha.unsqueeze(-1) * grads_fi, dim=2)  # [B, M, D]
+
+    # Hess log p(x) = sum_i alpha_i * Hess_fi + sum_i [ grad_alpha_i ⊗ grad log f_i(x) ]
+    termA = torch.diag_embed(torch.sum(alpha.unsqueeze(-1) * hess_fi, dim=2))
+    grad_alpha = alpha.unsqueeze(-1) * (
+        grads_fi - grad_logp.unsqueeze(2)
+    )  # [B, M, K, D]
+    termB = torch.einsum("bmkd,bmke->bmde", grad_alpha, grads_fi)  # [B, M, D, D]
+    return grad_logp, termA + termB
+
+
+def gmm_log_prob(
+    x: torch.Tensor,
+    probs: torch.Tensor,
+    means: torch.Tensor,
+    variances: torch.Tensor,
+) -> torch.Tensor:
+    """Computes log p(x) of a batch of diagonal Gaussian mixtures at a set of points per mixture.
+
+    Args:
+        x (torch.Tensor): The evaluation points of shape (B, M, D).
+        probs (torch.Tensor): The mixture probabilities of shape (B, K).
+        means (torch.Tensor): The component means of shape (B, K, D).
+        variances (torch.Tensor): The component variance diagonals of shape (B, K, D).
+
+    Returns:
+        torch.Tensor: The log likelihoods of shape (B, M).
+    """
+    D = means.shape[-1]
+    diff = x.unsqueeze(2) - means.unsqueeze(1)  # [B, M, K, D]
+    log_fi = -0.5 * (
+        D * math.log(2 * math.pi)
+        + torch.sum(diff**2 / variances.unsqueeze(1), dim=-1)
+        + variances.log().sum(dim=-1).unsqueeze(1)
+    )  # [B, M, K]
+    return torch.logsumexp(probs.log().unsqueeze(1) + log_fi, dim=-1)
+
+
+def merge_close_modes(
+    modes: torch.Tensor,
+    log_likelihoods: torch.Tensor,
+    candidates: torch.Tensor,
+    min_diff: float,
+) -> torch.Tensor:
+    """Greedily keeps the most likely candidates, dropping the ones that are closer than
+    min_diff (squared distance) to an already kept candidate of the same mixture.
+
+    The pairwise distances are computed once with `torch.cdist`, the greedy pass then runs over
+    the (fixed) number of candidates for all the mixtures at once.
+
+    Args:
+        modes (torch.Tensor): The candidate modes of shape (B, M, D).
+        log_likelihoods (torch.Tensor): The candidates' log likelihoods of shape (B, M).
+        candidates (torch.Tensor): A boolean mask of the candidates to consider of shape (B, M).
+        min_diff (float): The squared distance below which two modes are merged.
+
+    Returns:
+        torch.Tensor: A boolean mask of the kept candidates of shape (B, M).
+    """
+    B, M = candidates.shape
+    order = torch.argsort(
+        log_likelihoods.masked_fill(~candidates, -torch.inf), dim=-1, descending=True
+    )
+    batch_idx = torch.arange(B, device=modes.device)[:, None]
+    sorted_modes = modes[batch_idx, order]
+    sorted_candidates = candidates[batch_idx, order]
+    too_close = torch.cdist(sorted_modes, sorted_modes) ** 2 < min_diff  # [B, M, M]
+
+    kept = torch.zeros_like(sorted_candidates)
+    for i in range(M):
+        kept[:, i] = sorted_candidates[:, i] & ~(too_close[:, i, :i] & kept[:, :i]).any(
+            dim=-1
+        )
+    return torch.zeros_like(kept).scatter(1, order, kept)
+
+
+@profile
+def find_gmm_modes(
+    probs: torch.Tensor,
+    means: torch.Tensor,
+    variances: torch.Tensor,
+    active: Optional[torch.Tensor] = None,
+    init: Optional[torch.Tensor] = None,
+    max_iter: int = 1000,
+    mode_tol: float = 1e-6,
+    norm_tol: float = 1e-12,
+    min_diff: float = 1e-8,
+    n_newton_steps: int = 0,
+    check_every: int = 10,
+) -> GMMModes:
+    """Finds the modes of a batch of diagonal Gaussian mixtures with the fixed-point
+    (mean-shift) iteration, started from a fixed number of candidates per mixture.
+
+    Every iteration updates all the candidates of all the mixtures at once, converged candidates
+    are frozen through a mask rather than gathered out, and the convergence is only checked every
+    `check_every` iterations to avoid synchronizing with the device at every step. Candidates at
+    which the Hessian of log p is not negative-definite are discarded, and the remaining ones are
+    merged when closer than `min_diff`.
+
+    Args:
+        probs (torch.Tensor): The mixture probabilities of shape (B, K). Components with a zero
+            probability are ignored, such that mixtures with fewer components can be padded.
+        means (torch.Tensor): The component means of shape (B, K, D).
+        variances (torch.Tensor): The component variance diagonals of shape (B, K, D).
+        active (Optional[torch.Tensor]): A boolean mask of the candidates to search from of
+            shape (B, M). Defaults to None, in which case all the candidates are used.
+        init (Optional[torch.Tensor]): The initial candidates of shape (B, M, D). Defaults to None,
+            which uses K random convex combinations of the (non-zero probability) means followed by
+            the means themselves.
+        max_iter (int): The maximum number of fixed-point iterations.
+        mode_tol (float): The movement below which a candidate is considered converged.
+        norm_tol (float): Lower bound of the normalization constants and denominators.
+        min_diff (float): Modes closer than this squared distance are merged.
+        n_newton_steps (int): The number of Newton steps refining the converged candidates, using
+            the Hessian of log p. Defaults to 0.
+        check_every (int): The number of iterations between two convergence checks.
+
+    Returns:
+        GMMModes: The candidates, their log likelihoods, Hessians and validity mask.
+    """
+    B, K, D = means.shape
+    valid_components = probs > 0
+    if init is None:
+        n_valid = valid_components.sum(dim=-1)
+        w = torch.rand(B, K, K, device=means.device) * valid_components.unsqueeze(1)
+        w = w / w.sum(dim=-1, keepdim=True)
+        init = torch.cat([w @ means, means], dim=1)  # [B, 2K, D]
+        if active is None:
+            active = torch.cat(
+                [
+                    torch.arange(K, device=means.device)[None, :] < n_valid[:, None],
+                    valid_components,
+                ],
+                dim=1,
+            )
+    if active is None:
+        active = torch.ones(init.shape[:2], dtype=torch.bool, device=init.device)
+
+    modes = init.clone()
+    converged = ~active
+    normalization = math.sqrt((2 * math.pi) ** D) * torch.exp(
+        0.5 * variances.log().sum(dim=-1)
+    )  # [B, K]
+    normalization = torch.clamp(normalization, min=norm_tol)
+    weighted_probs = (probs / normalization).unsqueeze(1)  # [B, 1, K]
+    inv_var = 1.0 / variances
+    means_inv_var = means * inv_var
+
+    n_iter = max_iter
+    for it in range(max_iter):
+        if it % check_every == 0 and torch.all(converged):
+            n_iter = it
+            break
+        diff = modes.unsqueeze(2) - means.unsqueeze(1)  # [B, M, K, D]
+        dist = torch.sum(diff**2 * inv_var.unsqueeze(1), dim=-1)  # [B, M, K]
+        responsibilities = weighted_probs * torch.exp(-0.5 * dist)  # [B, M, K]
+
+        numerator = torch.einsum("bmk,bkd->bmd", responsibilities, means_inv_var)
+        denominator = torch.einsum("bmk,bkd->bmd", responsibilities, inv_var)
+        updated_modes = numerator / torch.clamp(denominator, min=norm_tol)
+
+        movement = (updated_modes - modes).norm(dim=-1)  # [B, M]
+        modes = torch.where(converged.unsqueeze(-1), modes, updated_modes)
+        converged = converged | (movement < mode_tol)
+    logger.debug(f"Mode search stopped after {n_iter} iterations.")
+
+    grads, hessians = gmm_grad_and_hessian_logp(modes, probs, means, variances)
+    eye = torch.eye(D, device=modes.device, dtype=hessians.dtype)
+    for _ in range(n_newton_steps):
+        # only step where the Hessian is negative-definite, i.e where the step is an ascent
+        concave = torch.linalg.eigvalsh(hessians).max(dim=-1).values < 0
+        step = torch.linalg.solve(
+            torch.where(concave[..., None, None], hessians, -eye), grads
+        )
+        modes = torch.where((active & concave).unsqueeze(-1), modes - step, modes)
+        grads, hessians = gmm_grad_and_hessian_logp(modes, probs, means, variances)
+
+    log_likelihoods = gmm_log_prob(modes, probs, means, variances)
+
+    # A local maximum => H is negative-definite => all eigenvalues < 0
+    max_eigvals = torch.linalg.eigvalsh(hessians).max(dim=-1).values  # [B, M]
+    valid = active & (max_eigvals < 0)
+    valid = merge_close_modes(modes, log_likelihoods, valid, min_diff=min_diff)
+    return GMMModes(
+        modes=modes,
+        log_likelihoods=log_likelihoods,
+        hessians=hessians,
+        valid=valid,
+        n_iter=n_iter,
+    )
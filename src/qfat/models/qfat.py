@@ -1,8 +1,9 @@
+import contextlib
 import itertools
 import logging
 import math
-from dataclasses import dataclass, fields
-from typing import Any, Dict, Literal, Optional, Tuple, Union
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 import hydra
 import numpy as np
@@ -10,15 +11,22 @@ import torch
 import torch.nn as nn
 from line_profiler import profile
 from numpy.typing import NDArray
-from torch.distributions import MixtureSameFamily, MultivariateNormal
+from torch.distributions import (
+    Categorical,
+    Distribution,
+    MixtureSameFamily,
+    constraints,
+)
 
 from qfat.conf.configs import DecoderBlockCfg, EncoderCfg, OptimizerCfg
 from qfat.datasets.dataset import Batch
-from qfat.models.decoder_block import DecoderBlock
+from qfat.models.decoder_block import DecoderBlock, SelfAttention
 from qfat.models.generative_model import (
     GenerativeModel,
     ModelOutput,
 )
+from qfat.models.losses import gmm_nll_loss, gmm_token_nll
+from qfat.models.mode_search import find_gmm_modes
 
 logger = logging.getLogger(__name__)
 
@@ -50,24 +58,199 @@ class BatchSequenceGMMParams:
             variances=new_variances, locs=new_locs, mixture_probs=new_mixture_probs
         )
 
+    def float(self) -> "BatchSequenceGMMParams":
+        """Returns a new BatchSequenceGMMParams with every field cast to float32."""
+        return BatchSequenceGMMParams(
+            **{f.name: getattr(self, f.name).float() for f in fields(self)}
+        )
+
+
+@dataclass
+class KVCache:
+    """Holds the keys and values of every decoder block between incremental sampling steps.
+
+    The positional embedding is indexed by the position inside the context window, so the
+    cached keys and values are only valid until the window slides. Decoding is therefore only
+    incremental for the first context_len steps of an episode, after which every step recomputes
+    the keys and values of the whole window. The token embeddings (before the positional
+    embedding) are kept as well, such that this rebuild doesn't re-encode the whole context.
+    """
+
+    keys: List[torch.Tensor] = field(
+        default_factory=list
+    )  # per layer (batch_size, num_heads, cond_len + seq_len, head_dim)
+    values: List[torch.Tensor] = field(
+        default_factory=list
+    )  # per layer (batch_size, num_heads, cond_len + seq_len, head_dim)
+    token_embeds: Optional[torch.Tensor] = None  # (batch_size, seq_len, embed_dim)
+    conditional_seq: Optional[torch.Tensor] = None  # the raw conditional sequence
+    cond_len: int = 0
+
+    @property
+    def seq_len(self) -> int:
+        """The number of cached state tokens."""
+        return 0 if self.token_embeds is None else self.token_embeds.size(1)
+
+    def reset(self) -> None:
+        """Clears the cache, e.g at the start of a new episode."""
+        self.keys = []
+        self.values = []
+        self.token_embeds = None
+        self.conditional_seq = None
+        self.cond_len = 0
+
+    def is_stale(self, conditional_seq: Optional[torch.Tensor]) -> bool:
+        """Whether the cached keys and values were computed with a different conditional sequence."""
+        if conditional_seq is None or self.conditional_seq is None:
+            return conditional_seq is not self.conditional_seq
+        return conditional_seq.shape != self.conditional_seq.shape or not torch.equal(
+            conditional_seq, self.conditional_seq
+        )
+
+
+class MultivariateNormalDiag(Distribution):
+    """A multivariate normal with diagonal covariances, parameterized by the variance diagonals.
+
+    Unlike `MultivariateNormal`, no (D, D) scale matrix is built, the scale_tril is only
+    materialized when explicitly requested (e.g for plotting).
+    """
 
-class MultivariateNormalDiag(MultivariateNormal):
-    """A faster implementation of log prob of multivariate normal with diagonal covariances"""
+    arg_constraints = {
+        "loc": constraints.real_vector,
+        "variances": constraints.independent(constraints.positive, 1),
+    }
+    support = constraints.real_vector
+    has_rsample = True
 
     def __init__(self, loc, variances, validate_args=None):
-        self.variances = variances
+        self.loc, self.variances = torch.broadcast_tensors(loc, variances)
         super(MultivariateNormalDiag, self).__init__(
-            loc,
-            scale_tril=torch.diag_embed(variances**0.5),
+            batch_shape=self.loc.shape[:-1],
+            event_shape=self.loc.shape[-1:],
             validate_args=validate_args,
         )
 
+    @property
+    def mean(self) -> torch.Tensor:
+        return self.loc
+
+    @property
+    def variance(self) -> torch.Tensor:
+        return self.variances
+
+    @property
+    def scale(self) -> torch.Tensor:
+        return self.variances.sqrt()
+
+    @property
+    def scale_tril(self) -> torch.Tensor:
+        return torch.diag_embed(self.scale)
+
+    def rsample(self, sample_shape=torch.Size()) -> torch.Tensor:
+        shape = self._extended_shape(sample_shape)
+        eps = torch.randn(shape, dtype=self.loc.dtype, device=self.loc.device)
+        return self.loc + eps * self.scale
+
     def log_prob(self, value):
         diff = value - self.loc
         M = torch.sum(diff**2 / self.variances, dim=-1)
         log_det = self.variances.log().sum(-1)
         return -0.5 * (self._event_shape[0] * math.log(2 * math.pi) + M + log_det)
 
+    def entropy(self) -> torch.Tensor:
+        D = self._event_shape[0]
+        return 0.5 * (D * (1 + math.log(2 * math.pi)) + self.variances.log().sum(-1))
+
+
+class DiagonalGaussianMixture(Distribution):
+    """A mixture of multivariate normals with diagonal covariances.
+
+    Mirrors the parts of the `MixtureSameFamily` interface used throughout the repo
+    (mixture_distribution, component_distribution, log_prob, sample), but evaluates the
+    log likelihood in a single log-sum-exp over the components, and samples by gathering
+    the selected component instead of sampling all of them.
+    """
+
+    arg_constraints = {}
+    support = constraints.real_vector
+    has_rsample = True
+
+    def __init__(
+        self,
+        mixture_probs: torch.Tensor,
+        locs: torch.Tensor,
+        variances: torch.Tensor,
+        validate_args=None,
+    ):
+        """
+        Args:
+            mixture_probs (torch.Tensor): The mixture probabilities of shape (..., K).
+            locs (torch.Tensor): The component means of shape (..., K, D).
+            variances (torch.Tensor): The component variance diagonals of shape (..., K, D).
+            validate_args (optional): Whether to validate the arguments. Defaults to None.
+        """
+        self.mixture_distribution = Categorical(
+            probs=mixture_probs, validate_args=validate_args
+        )
+        self.component_distribution = MultivariateNormalDiag(
+            loc=locs, variances=variances, validate_args=validate_args
+        )
+        super(DiagonalGaussianMixture, self).__init__(
+            batch_shape=self.mixture_distribution.batch_shape,
+            event_shape=self.component_distribution.event_shape,
+            validate_args=validate_args,
+        )
+
+    @property
+    def mean(self) -> torch.Tensor:
+        probs = self.mixture_distribution.probs.unsqueeze(-1)
+        return (probs * self.component_distribution.loc).sum(dim=-2)
+
+    @property
+    def variance(self) -> torch.Tensor:
+        probs = self.mixture_distribution.probs.unsqueeze(-1)
+        locs = self.component_distribution.loc
+        second_moment = (probs * (self.component_distribution.variances + locs**2)).sum(
+            dim=-2
+        )
+        return second_moment - self.mean**2
+
+    def log_prob(self, value: torch.Tensor) -> torch.Tensor:
+        """Computes log p(value) with a single log-sum-exp over the components.
+
+        Args:
+            value (torch.Tensor): The values of shape (..., D), broadcastable with the batch shape.
+
+        Returns:
+            torch.Tensor: The log likelihoods of the broadcasted batch shape.
+        """
+        component_log_probs = self.component_distribution.log_prob(
+            value.unsqueeze(-2)
+        )  # (..., K)
+        return torch.logsumexp(
+            component_log_probs + self.mixture_distribution.logits, dim=-1
+        )
+
+    def mixture_entropy(self) -> torch.Tensor:
+        """The entropy of the mixture weights."""
+        return self.mixture_distribution.entropy()
+
+    def rsample(self, sample_shape=torch.Size()) -> torch.Tensor:
+        """Samples a component per element and reparameterizes the sample within the selected
+        component, i.e gradients flow to the means and variances but not to the mixture weights.
+        """
+        k = self.mixture_distribution.sample(sample_shape)  # (*sample_shape, *batch)
+        locs = self.component_distribution.loc
+        variances = self.component_distribution.variances
+        shape = self._extended_shape(sample_shape)
+        index = k[..., None, None].expand(*k.shape, 1, shape[-1])
+        locs = torch.gather(locs.expand(*k.shape, *locs.shape[-2:]), -2, index)
+        variances = torch.gather(
+            variances.expand(*k.shape, *variances.shape[-2:]), -2, index
+        )
+        eps = torch.randn(shape, dtype=locs.dtype, device=locs.device)
+        return locs.squeeze(-2) + eps * variances.squeeze(-2).sqrt()
+
 
 class QFAT(GenerativeModel):
     """Implements a simplified infinite vocabulary transformer, without a VAE.
@@ -96,6 +279,7 @@ class QFAT(GenerativeModel):
         sample_fn: Literal["gmm", "modes"] = "modes",
         goal_pos_emb: bool = False,
         history_mask_prob: float = 0,
+        compile_loss: bool = False,
         **kwargs,
     ):
         """Instantiates a QFAT model, based on the minGPT backbone.
@@ -125,6 +309,8 @@ class QFAT(GenerativeModel):
             sample_fn: (Literal["gmm", "modes"]): Whether to sample from the gmm or only sample the GMM modes.
             goal_pos_emb (bool, optional): Whether or not to add a positional embedding to the conditional sequence.
                 Defaults to False.
+            compile_loss (bool, optional): Whether to compile the fused GMM loss used with diagonal
+                covariances with torch.compile. Defaults to False.
 
         Raises:
             ValueError: If the state encoder is not shared and the model uses a conditional sequence.
@@ -195,6 +381,7 @@ class QFAT(GenerativeModel):
                 "It is only supported to share the state encoder with the conditional sequence."
             )
         self.mha_kwargs = self.register_mask(self.masking_strategy)
+        self._attn_masks: Dict[Tuple[int, int, torch.device], torch.Tensor] = {}
         self.fc_out = nn.Linear(
             decoder_block_cfg.mha_cfg.embed_dim, self._get_gmm_param_size()
         )
@@ -210,6 +397,11 @@ class QFAT(GenerativeModel):
         logger.info("number of parameters: %.2fM" % (n_params / 1e6,))
         self.history_mask_prob = history_mask_prob
         self.sample_fn = sample_fn
+        # set by `qfat.models.quantization.quantize_qfat` to sample under autocast
+        self.autocast_dtype: Optional[torch.dtype] = None
+        self._gmm_nll_loss = (
+            torch.compile(gmm_nll_loss, dynamic=True) if compile_loss else gmm_nll_loss
+        )
 
     def _configure_optimizer(self) -> None:
         """Configures the optimizer, excluding encoder parameters from decay/no_decay sets."""
@@ -240,7 +432,7 @@ class QFAT(GenerativeModel):
                     isinstance(m, whitelist_weight_modules)
                     or (
                         pn.endswith("in_proj_weight")
-                        and isinstance(m, torch.nn.MultiheadAttention)
+                        and isinstance(m, (torch.nn.MultiheadAttention, SelfAttention))
                     )
                 ):
                     decay.add(fpn)
@@ -300,10 +492,16 @@ class QFAT(GenerativeModel):
 
     def to(self, *args, **kwargs):
         super().to(*args, **kwargs)
+        self._attn_masks.clear()
         self.device = next(
             self.parameters()
         ).device  # assumes model params are on the same device, which is fine for small models like mine :(
 
+    def load_state_dict(self, *args, **kwargs):
+        # the cached attention masks are derived from the (possibly loaded) mask buffer
+        self._attn_masks.clear()
+        return super().load_state_dict(*args, **kwargs)
+
     def _get_gmm_param_size(self) -> int:
         """Returns the shape of the gmm parametrization.
 
@@ -412,9 +610,9 @@ class QFAT(GenerativeModel):
             NotImplementedError: If the masking strategy is not yet implemented.
 
         Returns:
-            Dict[str, Any]: Extra parameters to the multiheaded attention module forward pass.
-            For all options, please check here:
-            https://pytorch.org/docs/stable/generated/torch.nn.MultiheadAttention.html#torch.nn.MultiheadAttention.forward
+            Dict[str, Any]: Extra parameters to the decoder blocks forward pass, `is_causal` is set
+            when the mask is the plain causal mask, such that the fused causal attention kernels
+            can be used when there are no conditional tokens.
         """
         if masking_strategy == "causal":
             self.register_buffer(
@@ -429,7 +627,7 @@ class QFAT(GenerativeModel):
                 "mask",
                 torch.eye(self.context_len, self.context_len, dtype=torch.bool),
             )
-            return {"is_causal": True}
+            return {"is_causal": False}
         else:
             raise NotImplementedError("Only causal masking is currently supported.")
 
@@ -443,22 +641,30 @@ class QFAT(GenerativeModel):
         Returns:
             BatchSequenceGMMParams: A dataclass that wraps the parsed GMM parameters.
         """
-        gmm_params = self.fc_out(x)
+        return self.parse_gmm_params(self.fc_out(x))
 
+    def parse_gmm_params(self, gmm_out: torch.Tensor) -> BatchSequenceGMMParams:
+        """Parses the GMM parameters from the output of the GMM head (fc_out).
+
+        Args:
+            gmm_out (torch.Tensor): The output of fc_out.
+
+        Returns:
+            BatchSequenceGMMParams: A dataclass that wraps the parsed GMM parameters, in float32.
+        """
+        # the softplus and the variance floor underflow in half precision
+        gmm_out = gmm_out.float()
         locs, mixtures, variances = (
-            gmm_params[:, :, : self.mixture_size * self.out_dim],
-            gmm_params[
+            gmm_out[:, :, : self.mixture_size * self.out_dim],
+            gmm_out[
                 :,
                 :,
                 self.mixture_size * self.out_dim : self.mixture_size * self.out_dim
                 + self.mixture_size,
             ],
-            gmm_params[:, :, self.mixture_size * self.out_dim + self.mixture_size :],
-        )
-        variances = torch.max(
-            self.scale_normalization(variances),
-            torch.tensor(self.variance_tol).expand_as(variances).to(x.device),
+            gmm_out[:, :, self.mixture_size * self.out_dim + self.mixture_size :],
         )
+        variances = self.scale_normalization(variances).clamp_min(self.variance_tol)
         mixtures = self.mixtures_normalization(
             mixtures
         )  # (batch_size, sequence_length, mixture_size)
@@ -495,24 +701,25 @@ class QFAT(GenerativeModel):
         if last_only:
             gmm_params = gmm_params[:, -1, ...]
 
+        if not self.full_covariance:
+            return DiagonalGaussianMixture(
+                mixture_probs=gmm_params.mixture_probs,
+                locs=gmm_params.locs,
+                variances=gmm_params.variances,
+                validate_args=False,
+            )
+
         categorical_dist = torch.distributions.Categorical(
             probs=gmm_params.mixture_probs
         )
-        if self.full_covariance:
-            variances = torch.zeros(
-                *gmm_params.variances.shape[:-1], self.out_dim, self.out_dim
-            ).to(gmm_params.variances.device)
-            tril_indices = torch.tril_indices(row=self.out_dim, col=self.out_dim)
-            variances[..., tril_indices[0], tril_indices[1]] = gmm_params.variances
-            gaussian_dist = torch.distributions.MultivariateNormal(
-                loc=gmm_params.locs, scale_tril=variances**0.5
-            )
-        else:
-            variances = torch.diag_embed(gmm_params.variances)
-            gaussian_dist = MultivariateNormalDiag(
-                loc=gmm_params.locs, variances=gmm_params.variances
-            )
-
+        variances = torch.zeros(
+            *gmm_params.variances.shape[:-1], self.out_dim, self.out_dim
+        ).to(gmm_params.variances.device)
+        tril_indices = torch.tril_indices(row=self.out_dim, col=self.out_dim)
+        variances[..., tril_indices[0], tril_indices[1]] = gmm_params.variances
+        gaussian_dist = torch.distributions.MultivariateNormal(
+            loc=gmm_params.locs, scale_tril=variances**0.5
+        )
         dist = MixtureSameFamily(
             mixture_distribution=categorical_dist,
             component_distribution=gaussian_dist,
@@ -553,30 +760,121 @@ class QFAT(GenerativeModel):
         # Multiply the input by the mask (in-place if desired)
         return x * mask
 
-    @profile
-    def forward(self, batch: Batch) -> ModelOutput:
-        """Computes the GIVT output and optionally the loss function if a target y is passed.
+    def _embed_states(
+        self, x: torch.Tensor, prev_actions: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Encodes the states, optionally concatenated with the previous actions,
+        and projects them to the embedding dimension (without positional embedding).
 
         Args:
-            batch (Batch): Dataclass containing the batched inputs x, outputs y,
-                and a validiting mask for each input token.
+            x (torch.Tensor): The states of shape (batch_size, sequence_length, ...).
+            prev_actions (Optional[torch.Tensor]): The previous actions, aligned with x.
 
         Returns:
-            ModelOutput: Dataclass containing the predicted sequence of GMM params,
-                and an optional loss.
+            torch.Tensor: The token embeddings of shape (batch_size, sequence_length, embed_dim).
         """
-        x, y, validity_mask, cond_seq, prev_actions = (
-            batch.x,
-            batch.y,
-            batch.validity_mask,
-            batch.conditional_seq,
-            batch.prev_actions,
-        )
         x = self.encoder(x)
-
         if prev_actions is not None:
             prev_actions = self.act_dropout(prev_actions)
             x = torch.cat([x, prev_actions], dim=-1)
+        return self.transformer.fc_in(x)
+
+    def _embed_conditional_seq(self, cond_seq: torch.Tensor) -> torch.Tensor:
+        """Embeds the conditional sequence (e.g goals) into the token space of the states.
+
+        Args:
+            cond_seq (torch.Tensor): The conditional sequence of shape (batch_size, cond_sequence_length, ...).
+
+        Returns:
+            torch.Tensor: The conditional tokens of shape (batch_size, cond_sequence_length, embed_dim).
+        """
+        x_cond_seq = self.encoder(cond_seq)
+        x_cond_seq = self.conditional_seq_layer(x_cond_seq)
+        if self.transformer.goal_pos_embed is not None:
+            cond_seq_len = x_cond_seq.size(1)
+            goal_pos_emb = self.transformer.goal_pos_embed.weight[:cond_seq_len]
+            x_cond_seq = x_cond_seq + goal_pos_emb
+        return x_cond_seq
+
+    def _pos_embed(self, start: int, end: int) -> torch.Tensor:
+        """Returns the positional embeddings of the positions [start, end).
+
+        Embedding the positions arange(start, end) is a slice of the embedding table, so a view of
+        the weights is returned instead of building the indices and gathering. The view tracks the
+        weights (and their gradients), which is why it is not cached like the masks.
+
+        Returns:
+            torch.Tensor: The embeddings of shape (end - start, embed_dim), broadcastable over the batch.
+        """
+        return self.transformer.pos_embed.weight[start:end]
+
+    def _get_attn_mask(
+        self, T: int, T_cond: int = 0, device: Optional[torch.device] = None
+    ) -> torch.Tensor:
+        """Returns the boolean attention mask of the (conditional tokens + state tokens) layout.
+
+        True marks the positions that are allowed to be attended to. The conditional tokens attend
+        to each other only, while the state tokens attend to all conditional tokens and to the
+        state tokens allowed by the registered mask.
+
+        Args:
+            T (int): The number of state tokens.
+            T_cond (int): The number of conditional tokens. Defaults to 0.
+            device (Optional[torch.device]): The device of the mask. Defaults to the mask buffer device.
+
+        The masks are built once per layout and device and cached, so they should not be modified.
+        The cache is cleared whenever the model is moved with `to` or a state dict is loaded.
+
+        Returns:
+            torch.Tensor: A mask of shape (T_cond + T, T_cond + T).
+        """
+        device = self.mask.device if device is None else torch.device(device)
+        if torch.jit.is_tracing():
+            # a cached mask would be recorded as a constant of the traced graph
+            return self._build_attn_mask(T, T_cond, device)
+        key = (T, T_cond, device)
+        mask = self._attn_masks.get(key)
+        if mask is None:
+            mask = self._build_attn_mask(T, T_cond, device)
+            self._attn_masks[key] = mask
+        return mask
+
+    def _build_attn_mask(
+        self, T: int, T_cond: int, device: torch.device
+    ) -> torch.Tensor:
+        mask = self.mask[:T, :T].to(device)
+        if T_cond > 0:
+            T_ext = T + T_cond
+            _mask = torch.ones(T_ext, T_ext, dtype=torch.bool, device=device)
+            _mask[-T:, -T:] = mask
+            _mask[:-T, -T:] = False
+            mask = _mask
+        return mask
+
+    def _decode(
+        self,
+        x: torch.Tensor,
+        prev_actions: Optional[torch.Tensor] = None,
+        cond_seq: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Runs the decoder blocks over the (conditional tokens + state tokens) sequence.
+
+        Only takes and returns tensors, such that it can be traced or compiled for inference
+        (see `qfat.models.export`).
+
+        Args:
+            x (torch.Tensor): The states of shape (batch_size, sequence_length, ...).
+            prev_actions (Optional[torch.Tensor]): The previous actions, aligned with x.
+            cond_seq (Optional[torch.Tensor]): The conditional sequence, ignored if the model
+                has no conditional sequence layer.
+
+        Returns:
+            torch.Tensor: The normalized outputs of the state tokens, of shape
+                (batch_size, sequence_length, embed_dim).
+        """
+        x = self._embed_states(
+            x, prev_actions
+        )  # (batch_size, sequence_length, embed_dim)
 
         B, T = x.shape[0:2]  # batch_size, sequence_length
         if T > self.context_len:
@@ -584,48 +882,159 @@ class QFAT(GenerativeModel):
                 "The input sequence length exceeds the maximum context length."
             )
 
-        x = self.transformer.fc_in(x)  # (batch_size, sequence_length, embed_dim)
-        pos_idx = torch.arange(T).expand(B, -1).to(x.device)
-        pos_embed = self.transformer.pos_embed(pos_idx)
-        x += pos_embed
+        x += self._pos_embed(0, T)
         if self.training:
             x = self.mask_history_states(x, self.history_mask_prob)
 
         x = self.transformer.dropout(x)
 
-        mask = self.mask[:T, :T]
+        T_cond = 0
         if self.conditional_seq_layer is not None and cond_seq is not None:
-            T_ext = x.size(1) + cond_seq.size(1)
-            _mask = torch.ones(T_ext, T_ext, dtype=torch.bool, device=x.device)
-            _mask[-T:, -T:] = mask
-            _mask[:-T, -T:] = False
-            mask = _mask
-            x_cond_seq = self.encoder(cond_seq)
-            x_cond_seq = self.conditional_seq_layer(x_cond_seq)
-            if self.transformer.goal_pos_embed is not None:
-                cond_seq_len = x_cond_seq.size(1)
-                goal_pos_idx = torch.arange(cond_seq_len, device=x_cond_seq.device)
-                goal_pos_idx = goal_pos_idx.unsqueeze(0)
-                goal_pos_emb = self.transformer.goal_pos_embed(goal_pos_idx)
-                x_cond_seq = x_cond_seq + goal_pos_emb
-
+            x_cond_seq = self._embed_conditional_seq(cond_seq)
+            T_cond = x_cond_seq.size(1)
             x = torch.cat([x_cond_seq, x], dim=1)
+        # the plain causal mask is left to the fused causal attention kernels
+        is_causal = self.mha_kwargs["is_causal"] and T_cond == 0
+        mask = None if is_causal else self._get_attn_mask(T, T_cond, device=x.device)
         for dec_block in self.transformer.dec_blocks:
-            x = dec_block(
-                x,
-                attn_mask=~mask if mask is not None else None,
-                **self.mha_kwargs,
+            x = dec_block(x, attn_mask=mask, is_causal=is_causal)
+        # -T: indexing is to account for conditioning tokens
+        return self.transformer.ln_f(x[:, -T:, ...])
+
+    @profile
+    def forward(self, batch: Batch) -> ModelOutput:
+        """Computes the GIVT output and optionally the loss function if a target y is passed.
+
+        Args:
+            batch (Batch): Dataclass containing the batched inputs x, outputs y,
+                and a validiting mask for each input token.
+
+        Returns:
+            ModelOutput: Dataclass containing the predicted sequence of GMM params,
+                and an optional loss.
+        """
+        y, validity_mask = batch.y, batch.validity_mask
+        x = self._decode(batch.x, batch.prev_actions, batch.conditional_seq)
+        # the GMM parameters and the likelihood are always computed in float32, also under autocast
+        gmm_out = self.fc_out(x).float()
+        with torch.autocast(device_type=gmm_out.device.type, enabled=False):
+            gmm_params = self.parse_gmm_params(gmm_out)
+            loss = None
+            if y is not None and self.full_covariance:
+                loss = self.compute_loss(
+                    gmm_params=gmm_params, y=y.float(), validity_mask=validity_mask
+                )
+            elif y is not None:
+                loss = self._gmm_nll_loss(
+                    gmm_out,
+                    y.float(),
+                    validity_mask,
+                    mixture_size=self.mixture_size,
+                    out_dim=self.out_dim,
+                    variance_tol=self.variance_tol,
+                    lambda_mixtures=self.lambda_mixtures,
+                )
+        return ModelOutput(output=gmm_params, loss=loss)
+
+    def token_nll(self, batch: Batch) -> torch.Tensor:
+        """Computes the negative log likelihood of every target token, without the mixture entropy
+        regularization of the training loss, e.g to weight a validation loss by the valid tokens.
+
+        Args:
+            batch (Batch): Dataclass containing the batched inputs x and the targets y.
+
+        Returns:
+            torch.Tensor: The negative log likelihoods of shape (batch_size, sequence_length), which
+                the validity mask of the batch still has to be applied to.
+        """
+        x = self._decode(batch.x, batch.prev_actions, batch.conditional_seq)
+        gmm_out = self.fc_out(x).float()
+        with torch.autocast(device_type=gmm_out.device.type, enabled=False):
+            if self.full_covariance:
+                distribution = self.get_distribution(self.parse_gmm_params(gmm_out))
+                return -distribution.log_prob(batch.y.float())
+            return gmm_token_nll(
+                gmm_out,
+                batch.y.float(),
+                mixture_size=self.mixture_size,
+                out_dim=self.out_dim,
+                variance_tol=self.variance_tol,
             )
-        x = self.transformer.ln_f(x)
-        gmm_params = self.get_gmm_params(
-            x[:, -T:, ...]
-        )  # -T: indexing is to account for conditioning tokens
-        loss = None
-        if y is not None:
-            loss = self.compute_loss(
-                gmm_params=gmm_params, y=y, validity_mask=validity_mask
+
+    @profile
+    def forward_with_cache(self, batch: Batch, kv_cache: KVCache) -> ModelOutput:
+        """Computes the GMM params of the newly observed tokens only, reusing cached keys and values.
+
+        The batch should only contain the states (and previous actions) observed since the previous
+        call, while the conditional sequence is passed in full. The cache is updated in-place.
+        Whenever the context window slides, the conditional sequence changes or the batch size
+        changes, the keys and values are recomputed from the cached token embeddings, since the
+        learned positional embedding of every token in the window shifts.
+
+        Args:
+            batch (Batch): Dataclass containing the new inputs x, and optionally the new prev_actions
+                and the conditional sequence.
+            kv_cache (KVCache): The cache of the previous steps, empty at the start of an episode.
+
+        Returns:
+            ModelOutput: Dataclass containing the predicted GMM params of the new tokens.
+        """
+        if self.training:
+            raise RuntimeError("Cached decoding is only supported in eval mode.")
+        x_new = self._embed_states(batch.x, batch.prev_actions)
+        x_new = x_new[:, -self.context_len :]
+        B, T_new = x_new.shape[0:2]
+        cond_seq = (
+            batch.conditional_seq if self.conditional_seq_layer is not None else None
+        )
+        if kv_cache.seq_len > 0 and kv_cache.token_embeds.size(0) != B:
+            kv_cache.reset()
+
+        T_past = kv_cache.seq_len
+        token_embeds = (
+            x_new if T_past == 0 else torch.cat([kv_cache.token_embeds, x_new], dim=1)
+        )
+        token_embeds = token_embeds[:, -self.context_len :]
+        T = token_embeds.size(1)
+        rebuild = (
+            T_past == 0
+            or T_past + T_new > self.context_len
+            or kv_cache.is_stale(cond_seq)
+        )
+        if rebuild:
+            x = self.transformer.dropout(token_embeds + self._pos_embed(0, T))
+            T_cond = 0
+            if cond_seq is not None:
+                x_cond_seq = self._embed_conditional_seq(cond_seq)
+                T_cond = x_cond_seq.size(1)
+                x = torch.cat([x_cond_seq, x], dim=1)
+            mask = self._get_attn_mask(T, T_cond, device=x.device)
+            past_key_values = [None] * len(self.transformer.dec_blocks)
+        else:
+            x = self.transformer.dropout(x_new + self._pos_embed(T_past, T))
+            T_cond = kv_cache.cond_len
+            mask = self._get_attn_mask(T, T_cond, device=x.device)[-T_new:]
+            past_key_values = list(zip(kv_cache.keys, kv_cache.values))
+
+        keys, values = [], []
+        for dec_block, past_key_value in zip(
+            self.transformer.dec_blocks, past_key_values
+        ):
+            x, (k, v) = dec_block.forward_with_cache(
+                x, attn_mask=mask, past_key_value=past_key_value
             )
-        return ModelOutput(output=gmm_params, loss=loss)
+            keys.append(k)
+            values.append(v)
+
+        kv_cache.keys = keys
+        kv_cache.values = values
+        kv_cache.token_embeds = token_embeds
+        kv_cache.conditional_seq = cond_seq
+        kv_cache.cond_len = T_cond
+
+        x = self.transformer.ln_f(x[:, -T_new:, ...])
+        gmm_params = self.get_gmm_params(x)
+        return ModelOutput(output=gmm_params, loss=None)
 
     @profile
     def compute_loss(
@@ -645,7 +1054,7 @@ class QFAT(GenerativeModel):
         Returns:
             torch.Tensor: The loss value.
         """
-        distribution: MixtureSameFamily = self.get_distribution(gmm_params)
+        distribution: Distribution = self.get_distribution(gmm_params)
         neglog_prob = -distribution.log_prob(y)
         if validity_mask is not None:
             masked_loss = (neglog_prob * validity_mask).sum()
@@ -750,30 +1159,43 @@ class QFAT(GenerativeModel):
         elif self.sample_fn == "modes":
             return self.sample_modes(**kwargs)
 
-    @torch.inference_mode()
-    def sample_gmm(
+    def _sampling_forward(
         self,
         x: Union[torch.Tensor, NDArray],
         prev_actions: Optional[Union[torch.Tensor, NDArray]] = None,
         conditional_seq: Optional[Union[torch.Tensor, NDArray]] = None,
-        return_output: bool = True,
-        temperature: float = 1,
-    ) -> Tuple[torch.Tensor, Optional[ModelOutput], Dict[str, int]]:
-        """Samples the next token in the output sequence from a GMM predicted by the model.
-
-        Args:
-            x (Union[torch.Tensor, NDArray]): The input sequence or context.
-            return_output (bool): Whether to return the model output.
-            temperature (float): A scale to adjust the variance of the model.
+        kv_cache: Optional[KVCache] = None,
+    ) -> ModelOutput:
+        """Runs the forward pass used by the sample functions.
 
-        Returns:
-            Tuple[torch.Tensor, Optional[ModelOutput]]: A tuple containing the sampled output,
-            the model output (if return_output=True), and additional sampling details.
+        If a cache is passed, x (and prev_actions) should only contain the newly observed tokens.
         """
+        if kv_cache is not None and self.pad_sampling:
+            raise ValueError("Cached decoding is not supported with 'pad_sampling'.")
         batch = self.sampling_preprocessing(
             x, conditional_seq=conditional_seq, prev_actions=prev_actions
         )
-        out: ModelOutput = self.forward(batch)
+        if self.autocast_dtype is None:
+            autocast = contextlib.nullcontext()
+        else:
+            autocast = torch.autocast(
+                device_type=torch.device(self.device).type, dtype=self.autocast_dtype
+            )
+        # the GMM parameters are parsed in float32, so the sampling (e.g the mode search) is too
+        with autocast:
+            if kv_cache is None:
+                out = self.forward(batch)
+            else:
+                out = self.forward_with_cache(batch, kv_cache)
+        return out
+
+    def _sample_gmm_from_output(
+        self,
+        out: ModelOutput,
+        return_output: bool = True,
+        temperature: float = 1,
+    ) -> Tuple[torch.Tensor, Optional[ModelOutput], Dict[str, int]]:
+        """Samples the next token from the GMM of the last element of a model output."""
         dist_params: BatchSequenceGMMParams = out.output
 
         if temperature != 1:
@@ -784,13 +1206,24 @@ class QFAT(GenerativeModel):
             )
 
         dist = self.get_distribution(gmm_params=dist_params, last_only=True)
-        sampled_k = dist.mixture_distribution.sample().item()
-        sample = dist.component_distribution.sample()[:, sampled_k, :]
+        sampled_k = dist.mixture_distribution.sample()  # (batch_size,)
+        # only the sampled component of every row is drawn from, like `sample_gmm_tensors`
+        components = dist.component_distribution
+        batch_idx = torch.arange(sampled_k.size(0), device=sampled_k.device)
+        loc = components.loc[batch_idx, sampled_k]  # (batch_size, out_dim)
+        noise = torch.randn_like(loc)
+        if self.full_covariance:
+            scale_tril = components.scale_tril[batch_idx, sampled_k]
+            sample = loc + (scale_tril @ noise.unsqueeze(-1)).squeeze(-1)
+        else:
+            sample = loc + noise * components.variances[batch_idx, sampled_k].sqrt()
         return (
-            sample,
+            sample.unsqueeze(1),  # (batch_size, 1, out_dim)
             out if return_output else None,
             {
-                "sampled_component": sampled_k,
+                "sampled_component": sampled_k.item()
+                if sampled_k.numel() == 1
+                else sampled_k.cpu().numpy(),
                 "mixture_probabilities": dist.mixture_distribution.probs.squeeze()
                 .cpu()
                 .numpy(),
@@ -798,6 +1231,40 @@ class QFAT(GenerativeModel):
             },
         )
 
+    @torch.inference_mode()
+    def sample_gmm(
+        self,
+        x: Union[torch.Tensor, NDArray],
+        prev_actions: Optional[Union[torch.Tensor, NDArray]] = None,
+        conditional_seq: Optional[Union[torch.Tensor, NDArray]] = None,
+        return_output: bool = True,
+        temperature: float = 1,
+        kv_cache: Optional[KVCache] = None,
+    ) -> Tuple[torch.Tensor, Optional[ModelOutput], Dict[str, int]]:
+        """Samples the next token in the output sequence from a GMM predicted by the model.
+
+        Args:
+            x (Union[torch.Tensor, NDArray]): The input sequence or context of shape (B, T, ...).
+            return_output (bool): Whether to return the model output.
+            temperature (float): A scale to adjust the variance of the model.
+            kv_cache (Optional[KVCache]): If passed, decodes incrementally and x should only contain
+                the tokens observed since the previous call. Defaults to None.
+
+        Returns:
+            Tuple[torch.Tensor, Optional[ModelOutput]]: A tuple containing the sampled output of
+            shape (B, 1, out_dim), the model output (if return_output=True), and additional
+            sampling details. For B > 1 the sampled components are returned as an array.
+        """
+        out: ModelOutput = self._sampling_forward(
+            x,
+            prev_actions=prev_actions,
+            conditional_seq=conditional_seq,
+            kv_cache=kv_cache,
+        )
+        return self._sample_gmm_from_output(
+            out, return_output=return_output, temperature=temperature
+        )
+
     @torch.inference_mode()
     def sample_modes(
         self,
@@ -810,281 +1277,134 @@ class QFAT(GenerativeModel):
         probs_tol: float = 1e-2,
         norm_tol: float = 1e-12,
         min_diff: float = 1e-8,
+        n_newton_steps: int = 0,
+        kv_cache: Optional[KVCache] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional["ModelOutput"], Dict[str, Any]]:
-        """
-        Example: Instead of returning just a single point from the set of modes,
-        we build a mixture of local Gaussians around each valid mode, using
-        the inverse Hessians as covariances.
-        """
+        """Samples the next token around the modes of the GMM predicted by the model.
 
-        def compute_grad_and_hessian_logp_vectorized(
-            x_modes: torch.Tensor, distribution
-        ):
-            """
-            Vectorized version of gradient and Hessian computation for log p(x)
-            of a diagonal Gaussian mixture. Now returns the inverse of (-H_logp) at each x,
-            but only for those points where -H_logp is positive-definite.
-
-            Returns:
-                max_eigvals: [M_valid]
-                    The largest eigenvalue of the Hessian of log p(x)
-                    for each valid mode (negative-definite H).
-                logdet_hess_logp: [M_valid]
-                    = log(det(-H_logp)), valid only if H is negative-definite.
-                grad_norms: [M_valid]
-                    Euclidean norm of ∇ log p(x).
-                negH_inv: [M_valid, D, D]
-                    The inverse of -H_logp for each valid mode x.
-                valid_mask: [M]
-                    Boolean mask indicating which input modes were valid
-                    (i.e., H was negative-definite).
-            """
-            mixture_probs = distribution.mixture_distribution.probs
-            means = distribution.component_distribution.loc
-            variances = distribution.component_distribution.variances
-
-            # --- Make sure shapes are consistent ---
-            mixture_probs = mixture_probs.squeeze()
-            if mixture_probs.ndim == 0:
-                mixture_probs = mixture_probs[None]  # shape [K=1]
-
-            means = means.squeeze()
-            if means.ndim == 1:
-                means = means.unsqueeze(0)  # shape [K, D]
-
-            variances = variances.squeeze()
-            if variances.ndim == 1:
-                variances = variances.unsqueeze(0)  # shape [K, D]
-
-            D = means.shape[1]
-            # ----------------------------------------------------------------
-            # 1) Compute per-component densities f_i(x) and mixture weights alpha_i(x)
-            # ----------------------------------------------------------------
-            x_expanded = x_modes.unsqueeze(1)  # [M, 1, D]
-            means_expanded = means.unsqueeze(0)  # [1, K, D]
-            diff = x_expanded - means_expanded  # [M, K, D]
-
-            inv_var = 1.0 / variances.clamp(min=1e-12)  # [K, D]
-            inv_var_expanded = inv_var.unsqueeze(0)  # [1, K, D]
-
-            # log f_i(x): [M, K]
-            log_fi = (
-                -0.5 * (diff**2 * inv_var_expanded).sum(dim=-1)
-                - 0.5 * D * math.log(2.0 * math.pi)
-                - 0.5 * torch.log(variances).sum(dim=-1).unsqueeze(0)
-            )
-            pdf_values = log_fi.exp()  # [M, K]
-
-            mixture_probs_expanded = mixture_probs.unsqueeze(0)  # [1, K]
-            p_x = (mixture_probs_expanded * pdf_values).sum(dim=1)  # [M]
-            alpha = (
-                mixture_probs_expanded * pdf_values / p_x.unsqueeze(-1).clamp(min=1e-30)
-            )  # [M, K]
-
-            # ----------------------------------------------------------------
-            # 2) grad and Hess log f_i(x)
-            # ----------------------------------------------------------------
-            grads_fi = -(diff * inv_var_expanded)  # [M, K, D]
-            hess_fi = -inv_var_expanded  # [1, K, D] => broadcast => [M, K, D]
-
-            # ----------------------------------------------------------------
-            # 3) grad log p(x) = sum_i alpha_i * grad log f_i(x)
-            # ----------------------------------------------------------------
-            grad_logp = torch.sum(alpha.unsqueeze(-1) * grads_fi, dim=1)  # [M, D]
-            grad_norms = grad_logp.norm(dim=-1)  # [M]
-
-            # ----------------------------------------------------------------
-            # 4) Hess log p(x) = sum_i alpha_i * Hess_fi
-            #                    + sum_i [ grad_alpha_i ⊗ grad log f_i(x) ]
-            # ----------------------------------------------------------------
-            # termA: diagonal part from sum_i alpha_i * Hess_fi
-            termA_diags = torch.sum(alpha.unsqueeze(-1) * hess_fi, dim=1)  # [M, D]
-            termA = torch.diag_embed(termA_diags)  # [M, D, D]
-
-            # grad_alpha_i = alpha_i * (grads_fi[i] - grad_logp)
-            grad_alpha = alpha.unsqueeze(-1) * (
-                grads_fi - grad_logp.unsqueeze(1)
-            )  # [M, K, D]
-
-            # termB: sum over i of (grad_alpha_i outer grads_fi[i])
-            # shape => [M, K, D, D]
-            grad_alpha_i_expanded = grad_alpha.unsqueeze(-1)  # [M, K, D, 1]
-            grads_fi_i_expanded = grads_fi.unsqueeze(-2)  # [M, K, 1, D]
-            termB_full = grad_alpha_i_expanded * grads_fi_i_expanded  # [M, K, D, D]
-            termB = termB_full.sum(dim=1)  # [M, D, D]
-
-            H_logp = termA + termB  # [M, D, D]   # Hessian of log p(x)
-
-            # ----------------------------------------------------------------
-            # 5) Check negative-definiteness: largest eigenvalue < 0
-            #    Then invert -H if valid
-            # ----------------------------------------------------------------
-            eigvals, _ = torch.linalg.eigh(H_logp)  # [M, D], [M, D, D]
-            max_eigvals = eigvals.max(dim=-1).values  # [M]
-
-            # A local maximum => H is negative-definite => all eigenvalues < 0
-            valid_mask = max_eigvals < 0
-
-            # -H for invertible covariance (only for valid ones)
-            negH = -H_logp[valid_mask]  # [M_valid, D, D]
-            logdet_negH = torch.logdet(negH)  # [M_valid]
-            negH_inv = torch.linalg.inv(negH)  # [M_valid, D, D]
-
-            max_eigvals_valid = max_eigvals[valid_mask]
-            logdet_hess_logp = logdet_negH
-            grad_norms_valid = grad_norms[valid_mask]
+        Instead of returning just a single point from the set of modes, we build a mixture of
+        local Gaussians around each valid mode, using the inverse Hessians as covariances.
+        Every context in the batch gets its own modes, and rows for which no valid mode is
+        found fall back to sampling from the GMM.
 
-            return (
-                max_eigvals_valid,
-                logdet_hess_logp,
-                grad_norms_valid,
-                negH_inv,
-                valid_mask,
-            )
+        Args:
+            x (Union[torch.Tensor, NDArray]): The input sequence or context of shape (B, T, ...).
+            return_output (bool): Whether to return the model output.
+            max_iter (int): The maximum number of fixed-point iterations of the mode search.
+            mode_tol (float): The movement below which a mode is considered converged.
+            probs_tol (float): Components with a probability below probs_tol times the largest
+                probability are dropped before the mode search.
+            norm_tol (float): Lower bound of the normalization constants and denominators.
+            min_diff (float): Modes closer than this squared distance are merged.
+            n_newton_steps (int): The number of Newton steps refining the modes after the
+                fixed-point iteration. Defaults to 0.
+            kv_cache (Optional[KVCache]): If passed, decodes incrementally and x should only contain
+                the tokens observed since the previous call. Defaults to None.
 
+        Returns:
+            Tuple[torch.Tensor, Optional[ModelOutput], Dict[str, Any]]: A tuple containing the
+            sampled output of shape (B, 1, out_dim), the model output (if return_output=True), and
+            additional sampling details. For B > 1 the metadata holds one entry per row.
+        """
         temp = kwargs.get("temperature", 1.0)
 
-        with torch.inference_mode():
-            batch = self.sampling_preprocessing(
-                x, conditional_seq=conditional_seq, prev_actions=prev_actions
-            )
-            out: "ModelOutput" = self.forward(batch)
-            dist_params: "BatchSequenceGMMParams" = out.output
-            raw_dist_out = self.get_distribution(gmm_params=dist_params, last_only=True)
-
-            probs = raw_dist_out.mixture_distribution.probs.squeeze()
-            means = raw_dist_out.component_distribution.loc.squeeze()
-            variances = raw_dist_out.component_distribution.variances.squeeze()
-
-            valid_idx = (probs / probs.max()) > probs_tol
-            probs = probs[valid_idx]
-            probs = probs / probs.sum()
-            means = means[valid_idx]
-            variances = variances[valid_idx]
+        out: "ModelOutput" = self._sampling_forward(
+            x,
+            prev_actions=prev_actions,
+            conditional_seq=conditional_seq,
+            kv_cache=kv_cache,
+        )
+        dist_params: "BatchSequenceGMMParams" = out.output
+        raw_dist_out = self.get_distribution(gmm_params=dist_params, last_only=True)
+
+        probs = raw_dist_out.mixture_distribution.probs  # [B, K]
+        means = raw_dist_out.component_distribution.loc  # [B, K, D]
+        variances = raw_dist_out.component_distribution.variances  # [B, K, D]
+        B, K, dim = means.shape
+        batch_idx = torch.arange(B, device=means.device)
+
+        # dropped components keep their slot with a zero probability
+        valid_components = (probs / probs.max(dim=-1, keepdim=True).values) > probs_tol
+        probs = probs * valid_components
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+        n_valid = valid_components.sum(dim=-1)  # [B]
+
+        def _metadata(sampled_component, valid_modes):
+            if B == 1:
+                return {
+                    "sampled_component": sampled_component,
+                    "mixture_probabilities": probs[0, valid_components[0]]
+                    .detach()
+                    .cpu()
+                    .numpy(),
+                    "distribution": raw_dist_out,
+                    "valid_modes": valid_modes[0],
+                }
+            return {
+                "sampled_component": None,
+                "mixture_probabilities": probs.detach().cpu().numpy(),
+                "distribution": raw_dist_out,
+                "valid_modes": valid_modes,
+            }
 
-            dist_params = BatchSequenceGMMParams(
-                variances=variances[None, None, ...],
-                locs=means[None, None, ...],
-                mixture_probs=probs[None, None, ...],
+        # If there's only 1 component, its single mode is just the mean
+        if torch.all(n_valid == 1):
+            k = probs.argmax(dim=-1)
+            single_mode = means[batch_idx, k]  # [B, D]
+            sample = (
+                single_mode
+                + torch.randn_like(single_mode)
+                * (temp * variances[batch_idx, k]).sqrt()
+            )
+            return (
+                sample.unsqueeze(1),
+                out if return_output else None,
+                _metadata(0, list(single_mode.unsqueeze(1))),
             )
-            dist_out = self.get_distribution(gmm_params=dist_params, last_only=True)
-
-            # If there's only 1 component, its single mode is just the mean
-            K, dim = means.shape
-            if K == 1:
-                single_mode = (
-                    means.clone()
-                    + MultivariateNormalDiag(
-                        loc=torch.zeros_like(means), variances=temp * variances
-                    ).sample()
-                )
-                return (
-                    single_mode.unsqueeze(0).unsqueeze(0),
-                    out if return_output else None,
-                    {
-                        "sampled_component": 0,
-                        "mixture_probabilities": probs.detach().cpu().numpy(),
-                        "distribution": raw_dist_out,
-                        "valid_modes": single_mode,
-                    },
-                )
 
-            init_list = []
-            for _ in range(K):
-                w = torch.rand(K, device=means.device)
-                w = w / w.sum()
-                init_pt = (w[:, None] * means).sum(dim=0)
-                init_list.append(init_pt)
-            init_list += [m for m in means]
-            modes = torch.stack(init_list, dim=0)
-
-        converged = torch.zeros(modes.shape[0], dtype=torch.bool, device=modes.device)
-        base_normalization = math.sqrt((2 * math.pi) ** dim)
-        log_var = variances.log().sum(dim=-1)
-
-        for it in range(max_iter):
-            not_converged = ~converged
-            if not torch.any(not_converged):
-                logger.debug(f"All modes converged at iteration {it}.")
-                break
-
-            diff = modes[not_converged, None, :] - means[None, :, :]  # [Nc, K, D]
-            dist = torch.sum(diff**2 / variances[None, ...], dim=-1)  # [Nc, K]
-            normalization = base_normalization * torch.exp(0.5 * log_var)  # [K]
-            normalization = torch.clamp(normalization, min=norm_tol)
-            likelihoods = torch.exp(-0.5 * dist) / normalization[None, :]  # [Nc, K]
-
-            weighted_means = (probs[None, :] * likelihoods)[:, :, None] * means[
-                None, :, :
-            ]
-            numerator = (weighted_means / variances[None, :, :]).sum(dim=1)  # [Nc, D]
-            denominator = (
-                (probs[None, :] * likelihoods)[..., None] / variances[None, ...]
-            ).sum(dim=1)  # [Nc, D]
-            denominator = torch.clamp(denominator, min=norm_tol)
-            updated_modes = numerator / denominator  # [Nc, D]
-
-            movement = (updated_modes - modes[not_converged]).norm(dim=-1)
-            modes[not_converged] = updated_modes
-            newly_converged = movement < mode_tol
-            converged[not_converged] |= newly_converged
-
-        mode_loglikelihoods = dist_out.log_prob(modes)  # [num_init]
-        _, logdet_hess, _, negH_inv, valid_mask = (
-            compute_grad_and_hessian_logp_vectorized(modes, dist_out)
+        gmm_modes = find_gmm_modes(
+            probs,
+            means,
+            variances,
+            max_iter=max_iter,
+            mode_tol=mode_tol,
+            norm_tol=norm_tol,
+            min_diff=min_diff,
+            n_newton_steps=n_newton_steps,
         )
+        modes, selected = gmm_modes.modes, gmm_modes.valid
+
+        # -H for invertible covariance, the invalid ones are replaced by the identity
+        eye = torch.eye(dim, device=means.device, dtype=gmm_modes.hessians.dtype)
+        negH = torch.where(selected[..., None, None], -gmm_modes.hessians, eye)
+        logdet_hess_logp = torch.logdet(negH)  # [B, M]
+        negH_inv = torch.linalg.inv(negH)
+        negH_inv = 0.5 * (negH_inv + negH_inv.transpose(-1, -2))  # [B, M, D, D]
+
+        has_modes = selected.any(dim=-1)  # [B]
+        weights = gmm_modes.log_likelihoods - 0.5 * logdet_hess_logp
+        weights = weights.masked_fill(~selected, -torch.inf)
+        weights = weights.masked_fill(~has_modes[:, None], 0.0)
+        sampled_mode = torch.distributions.Categorical(logits=weights).sample()  # [B]
+        mvn = torch.distributions.MultivariateNormal(
+            loc=modes[batch_idx, sampled_mode],  # shape [B, D]
+            covariance_matrix=negH_inv[batch_idx, sampled_mode] * temp,
+        )
+        sample = mvn.sample()
 
-        if not valid_mask.any():
+        if not torch.all(has_modes):
             logger.warning(
                 "No valid negative-definite Hessians found. Fallback sampler."
             )
-            return self.sample_gmm(x=x, **kwargs)
-        modes = modes[valid_mask]
-        mode_loglikelihoods = mode_loglikelihoods[valid_mask]
-
-        def merge_close_modes(modes_, mode_lls, min_diff):
-            sorted_indices = torch.argsort(mode_lls, descending=True)
-            selected_indices = []
-            for i in sorted_indices:
-                candidate = modes_[i]
-                too_close = any(
-                    (torch.norm(candidate - modes_[sel_idx]) ** 2 < min_diff)
-                    for sel_idx in selected_indices
-                )
-                if not too_close:
-                    selected_indices.append(i)
-            return torch.stack(selected_indices)
-
-        selected_indices = merge_close_modes(
-            modes, mode_loglikelihoods, min_diff=min_diff
-        )
-        modes = modes[selected_indices]  # shape [Nm, D]
-        mode_loglikelihoods = mode_loglikelihoods[selected_indices]
-        logdet_hess_logp = logdet_hess[selected_indices]
-        negH_inv = negH_inv[selected_indices]  # shape [Nm, D, D]
-
-        weights = mode_loglikelihoods - 0.5 * logdet_hess_logp
-        mode_dist = torch.distributions.Categorical(logits=weights)
-        mvn = torch.distributions.MultivariateNormal(
-            loc=modes,  # shape [Nm, D]
-            covariance_matrix=negH_inv * temp,  # shape [Nm, D, D]
-        )
-        mix_dist = torch.distributions.MixtureSameFamily(
-            mode_dist,
-            mvn,
-        )
-        sample = mix_dist.sample()
-        sample = sample.unsqueeze(0).unsqueeze(0)
+            fallback, *_ = self._sample_gmm_from_output(
+                out, return_output=False, temperature=temp
+            )
+            sample = torch.where(has_modes[:, None], sample, fallback[:, -1])
         return (
-            sample.detach(),
+            sample.unsqueeze(1).detach(),
             out if return_output else None,
-            {
-                "sampled_component": None,
-                "mixture_probabilities": probs.detach().cpu().numpy(),
-                "distribution": raw_dist_out,
-                "valid_modes": modes,
-            },
+            _metadata(None, [modes[b, selected[b]] for b in range(B)]),
         )
 
     def sample_from_model_output(
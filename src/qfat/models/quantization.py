@@ -0,0 +1,171 @@
+import copy
+import logging
+from typing import Dict, List, Literal
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from torch.utils.data import DataLoader, Dataset
+
+from qfat.datasets.dataset import Batch, collate_policy
+from qfat.models.decoder_block import SelfAttention
+from qfat.models.qfat import QFAT
+
+logger = logging.getLogger(__name__)
+
+Precision = Literal["fp32", "bf16", "int8"]
+
+
+def _quantizable_linears(model: QFAT) -> List[str]:
+    """Names the linear layers of the token path: the input and output projections, the
+    attention projections and the decoder MLPs. The state encoder is left as is."""
+    names = ["transformer.fc_in", "fc_out"]
+    for name, module in model.transformer.dec_blocks.named_modules(
+        prefix="transformer.dec_blocks"
+    ):
+        if isinstance(module, SelfAttention):
+            names += [f"{name}.in_proj", f"{name}.out_proj"]
+        elif name.endswith(".mlp"):
+            names += [f"{name}.c_fc", f"{name}.c_proj"]
+    if (
+        model.conditional_seq_layer is not None
+        and model.conditional_seq_layer is not model.transformer.fc_in
+    ):
+        names.append("conditional_seq_layer")
+    return names
+
+
+def _unfuse_in_proj(attn: SelfAttention) -> None:
+    """Moves the fused query, key and value projection into an `nn.Linear`, which can be quantized."""
+    linear = nn.Linear(
+        attn.embed_dim,
+        3 * attn.embed_dim,
+        bias=attn.in_proj_bias is not None,
+        device=attn.in_proj_weight.device,
+    )
+    with torch.no_grad():
+        linear.weight.copy_(attn.in_proj_weight)
+        if attn.in_proj_bias is not None:
+            linear.bias.copy_(attn.in_proj_bias)
+    attn.in_proj = linear
+
+
+def quantize_qfat(
+    model: QFAT, precision: Precision = "int8", inplace: bool = False
+) -> QFAT:
+    """Prepares a trained QFAT model for (CPU) inference in a lower precision.
+
+    - "int8": dynamic int8 quantization of the linear layers of the token path (see
+      `_quantizable_linears`). The weights are quantized once, the activations at every call.
+      Quantized linear layers only run on the CPU.
+    - "bf16": the sample functions run the forward under bfloat16 autocast, and cast the
+      GMM parameters back to float32 before sampling.
+    - "fp32": the model is returned as is.
+
+    Args:
+        model (QFAT): The trained model, it is set to eval mode.
+        precision (Precision): The inference precision. Defaults to "int8".
+        inplace (bool): Whether to modify the model instead of a copy. Defaults to False.
+
+    Returns:
+        QFAT: The model to sample from, which should not be trained any further.
+
+    Raises:
+        ValueError: If the precision is unknown, or int8 is requested for a model that is not
+            on the CPU.
+    """
+    if precision not in ("fp32", "bf16", "int8"):
+        raise ValueError(f"Unknown precision '{precision}'.")
+    if precision == "fp32":
+        return model
+    if precision == "int8" and torch.device(model.device).type != "cpu":
+        raise ValueError("Dynamic int8 quantization is only supported on the CPU.")
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    if precision == "bf16":
+        model.autocast_dtype = torch.bfloat16
+        return model
+
+    for module in model.transformer.dec_blocks.modules():
+        if isinstance(module, SelfAttention):
+            _unfuse_in_proj(module)
+    names = _quantizable_linears(model)
+    quantize_dynamic(model, set(names), dtype=torch.qint8, inplace=True)
+    logger.info(f"Quantized {len(names)} linear layers to int8.")
+    return model
+
+
+@torch.inference_mode()
+def compare_precision(
+    reference: QFAT,
+    candidate: QFAT,
+    dataset: Dataset,
+    batch_size: int = 64,
+    collate_fn=collate_policy,
+) -> Dict[str, float]:
+    """Compares the GMM parameters predicted by a (quantized) model with the ones of the float32
+    model, on the valid tokens of a held-out dataset (e.g the validation split).
+
+    Args:
+        reference (QFAT): The float32 model.
+        candidate (QFAT): The model to check, see `quantize_qfat`.
+        dataset (Dataset): The held-out dataset, e.g a `SlicedTrajectoryDataset` of windows that
+            fit in the context of the model.
+        batch_size (int): The batch size. Defaults to 64.
+        collate_fn: The collate function of the dataset. Defaults to collate_policy.
+
+    Returns:
+        Dict[str, float]: The mean and max absolute errors of the locs, the mixture probabilities
+            and the variances, the agreement of the most likely component, and the negative
+            log-likelihood of the actions under both models.
+    """
+    reference.eval()
+    candidate.eval()
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    sums: Dict[str, float] = {}
+    maxs: Dict[str, float] = {}
+    n_tokens = 0
+    for batch in loader:
+        batch: Batch
+        batch.to(reference.device)
+        # the sampling forward runs under the autocast of the model, and may pre-pad the inputs
+        T = batch.x.size(1)
+        ref_params = reference._sampling_forward(
+            batch.x, batch.prev_actions, batch.conditional_seq
+        ).output[:, -T:]
+        cand_params = candidate._sampling_forward(
+            batch.x, batch.prev_actions, batch.conditional_seq
+        ).output[:, -T:]
+        mask = (
+            batch.validity_mask.bool()
+            if batch.validity_mask is not None
+            else torch.ones(batch.x.shape[:2], dtype=torch.bool, device=batch.x.device)
+        )
+        n_tokens += int(mask.sum())
+        for name in ("locs", "mixture_probs", "variances"):
+            err = (getattr(cand_params, name) - getattr(ref_params, name)).abs()
+            err = err[mask]
+            sums[name] = sums.get(name, 0.0) + err.flatten(1).mean(dim=1).sum().item()
+            maxs[name] = max(maxs.get(name, 0.0), err.max().item())
+        agree = ref_params.mixture_probs.argmax(-1) == cand_params.mixture_probs.argmax(
+            -1
+        )
+        sums["component_agreement"] = (
+            sums.get("component_agreement", 0.0) + agree[mask].sum().item()
+        )
+        if batch.y is not None:
+            y = batch.y.to(reference.device)
+            for name, params, model in (
+                ("nll_reference", ref_params, reference),
+                ("nll_candidate", cand_params, candidate),
+            ):
+                nll = -model.get_distribution(params).log_prob(y)
+                sums[name] = sums.get(name, 0.0) + nll[mask].sum().item()
+
+    metrics = {f"{name}_mean_abs_err": sums[name] / n_tokens for name in maxs}
+    metrics.update({f"{name}_max_abs_err": value for name, value in maxs.items()})
+    for name in ("component_agreement", "nll_reference", "nll_candidate"):
+        if name in sums:
+            metrics[name] = sums[name] / n_tokens
+    return metrics
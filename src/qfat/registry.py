@@ -0,0 +1,321 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Union
+
+import hydra
+import torch
+import yaml
+from omegaconf import DictConfig, OmegaConf
+
+from qfat.conf.configs import TrainingEntrypointCfg
+from qfat.constants import MODEL_REGISTRY_PATH
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+CONFIG_FILE = "config.yaml"
+WEIGHTS_FILE = "model.pth"
+STATS_FILE = "stats.json"
+
+
+def ref_name(model_afid: str) -> str:
+    """Turns a wandb artifact id (e.g 'entity/project/model_epoch_10_abc:v3') into the name it is
+    registered under ('model_epoch_10_abc:v3'). Every version is registered separately, a name
+    without a version points to the latest model registered under it (e.g by the training)."""
+    return model_afid.split("/")[-1]
+
+
+def artifact_name(model_afid: str) -> str:
+    """Strips the entity, project and version of a wandb artifact id."""
+    return ref_name(model_afid).split(":")[0]
+
+
+def is_concrete_version(model_afid: str) -> bool:
+    """Whether an artifact id pins a version ('...:v3'), rather than a moving alias ('...:latest')
+    or no version at all."""
+    return re.fullmatch(r"v\d+", ref_name(model_afid).partition(":")[2]) is not None
+
+
+def _hash_state_dict(
+    h: "hashlib._Hash", state_dict: Mapping[str, torch.Tensor]
+) -> None:
+    for key in sorted(state_dict):
+        tensor = state_dict[key].detach().cpu().contiguous()
+        h.update(key.encode())
+        h.update(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+        h.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+@dataclass(frozen=True)
+class RegistryEntry:
+    """A model stored in the registry."""
+
+    digest: str
+    path: Path
+    manifest: Dict[str, Any]
+
+    @property
+    def config_path(self) -> Path:
+        return self.path / CONFIG_FILE
+
+    @property
+    def weights_path(self) -> Path:
+        return self.path / WEIGHTS_FILE
+
+    @property
+    def stats_path(self) -> Optional[Path]:
+        """The normalizer stats of the training dataset, if they were registered."""
+        path = self.path / STATS_FILE
+        return path if path.exists() else None
+
+    def load_config(self) -> TrainingEntrypointCfg:
+        with open(self.config_path, "r") as f:
+            return OmegaConf.create(yaml.safe_load(f))
+
+    def load_model(self, device: Union[str, torch.device] = "cpu") -> torch.nn.Module:
+        """Instantiates the model of the training config and loads its weights, in eval mode."""
+        model = hydra.utils.instantiate(
+            self.load_config().model_cfg, _recursive_=False, _convert_="none"
+        )
+        model.load_state_dict(
+            torch.load(
+                self.weights_path, weights_only=True, map_location=torch.device(device)
+            ),
+            strict=False,
+        )
+        model.to(device)
+        model.eval()
+        return model
+
+
+class ModelRegistry:
+    def __init__(self, root: Union[str, Path] = MODEL_REGISTRY_PATH) -> None:
+        """A local, content-addressed store of trained models.
+
+        Every entry holds the training config, the model state dict and optionally the normalizer
+        stats of the training dataset, together with a manifest. Entries live under
+        `objects/<digest>`, where the digest hashes their content, and are written to a temporary
+        directory first, such that a partially written entry is never visible. Human readable
+        names (e.g the wandb artifact names) point to digests through `refs/<name>.json`.
+
+        Models are only fetched from wandb when explicitly asked (see `fetch_from_wandb`), after
+        which they are served from the disk, e.g on hosts without network access.
+
+        Args:
+            root (Union[str, Path]): The directory of the registry. Defaults to MODEL_REGISTRY_PATH.
+        """
+        self.root = Path(root)
+        self.objects_dir = self.root / "objects"
+        self.refs_dir = self.root / "refs"
+
+    def _ref_path(self, name: str) -> Path:
+        # the version is kept apart from the name, e.g 'model:v3' -> 'model@v3.json'
+        safe_name = re.sub(r"[^A-Za-z0-9_.@-]", "_", ref_name(name).replace(":", "@"))
+        return self.refs_dir / f"{safe_name}.json"
+
+    def resolve(self, name_or_digest: str) -> Optional[str]:
+        """Returns the digest of a name (or of a digest prefix), None if it is not registered."""
+        ref_path = self._ref_path(name_or_digest)
+        if ref_path.exists():
+            with open(ref_path, "r") as f:
+                return json.load(f)["digest"]
+        if self.objects_dir.exists() and re.fullmatch(
+            r"[0-9a-f]{6,64}", name_or_digest
+        ):
+            matches = [
+                p.name
+                for p in self.objects_dir.iterdir()
+                if p.name.startswith(name_or_digest)
+            ]
+            if len(matches) == 1:
+                return matches[0]
+        return None
+
+    def __contains__(self, name_or_digest: str) -> bool:
+        return self.resolve(name_or_digest) is not None
+
+    def get(self, name_or_digest: str) -> RegistryEntry:
+        """Returns a registered entry.
+
+        Raises:
+            KeyError: If the name or digest is not registered.
+        """
+        digest = self.resolve(name_or_digest)
+        if digest is None:
+            raise KeyError(
+                f"'{name_or_digest}' is not in the model registry {self.root}."
+            )
+        path = self.objects_dir / digest
+        with open(path / MANIFEST_FILE, "r") as f:
+            return RegistryEntry(digest=digest, path=path, manifest=json.load(f))
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Returns the manifests of all the entries."""
+        if not self.objects_dir.exists():
+            return []
+        manifests = []
+        for path in sorted(self.objects_dir.iterdir()):
+            with open(path / MANIFEST_FILE, "r") as f:
+                manifests.append(json.load(f))
+        return manifests
+
+    def tag(self, name: str, digest: str) -> None:
+        """Points a name to an entry, replacing what it pointed to before."""
+        self.refs_dir.mkdir(parents=True, exist_ok=True)
+        ref_path = self._ref_path(name)
+        tmp_path = ref_path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump({"name": name, "digest": digest}, f)
+        os.replace(tmp_path, ref_path)
+
+    def put(
+        self,
+        trainer_cfg: Union[DictConfig, Dict[str, Any]],
+        state_dict: Mapping[str, torch.Tensor],
+        stats_path: Optional[Union[str, Path]] = None,
+        name: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> RegistryEntry:
+        """Stores a model, or only tags it if an identical entry exists.
+
+        Args:
+            trainer_cfg (Union[DictConfig, Dict[str, Any]]): The training config, whose model_cfg
+                instantiates the model.
+            state_dict (Mapping[str, torch.Tensor]): The model weights.
+            stats_path (Optional[Union[str, Path]]): The normalizer stats file of the training
+                dataset. Defaults to None.
+            name (Optional[str]): A name to tag the entry with. Defaults to None.
+            metadata (Optional[Dict[str, Any]]): Extra information kept in the manifest, e.g the
+                wandb run. Defaults to None.
+
+        Returns:
+            RegistryEntry: The entry.
+        """
+        config_bytes = OmegaConf.to_yaml(OmegaConf.create(trainer_cfg)).encode()
+        stats_bytes = (
+            Path(stats_path).read_bytes()
+            if stats_path is not None and Path(stats_path).exists()
+            else None
+        )
+        h = hashlib.sha256()
+        h.update(config_bytes)
+        _hash_state_dict(h, state_dict)
+        if stats_bytes is not None:
+            h.update(stats_bytes)
+        digest = h.hexdigest()
+
+        path = self.objects_dir / digest
+        if not path.exists():
+            self.objects_dir.mkdir(parents=True, exist_ok=True)
+            tmp_dir = Path(tempfile.mkdtemp(dir=self.objects_dir, prefix=".tmp_"))
+            try:
+                (tmp_dir / CONFIG_FILE).write_bytes(config_bytes)
+                buffer = io.BytesIO()
+                torch.save({k: v.detach().cpu() for k, v in state_dict.items()}, buffer)
+                (tmp_dir / WEIGHTS_FILE).write_bytes(buffer.getvalue())
+                if stats_bytes is not None:
+                    (tmp_dir / STATS_FILE).write_bytes(stats_bytes)
+                manifest = {
+                    "digest": digest,
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "torch_version": torch.__version__,
+                    "files": sorted(p.name for p in tmp_dir.iterdir()),
+                    "metadata": metadata or {},
+                }
+                with open(tmp_dir / MANIFEST_FILE, "w") as f:
+                    json.dump(manifest, f, indent=2)
+                os.rename(tmp_dir, path)
+                logger.info(f"Registered model {digest[:12]} in {self.root}")
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not path.exists():
+                    raise
+        if name is not None:
+            self.tag(name, digest)
+        return self.get(digest)
+
+    def fetch_from_wandb(self, training_run_id: str, model_afid: str) -> RegistryEntry:
+        """Downloads a model (or the model of a checkpoint) and its training config from wandb,
+        and registers it under the artifact name and its concrete version (e.g 'model:v3' for
+        'model:latest').
+
+        Args:
+            training_run_id (str): The path of the training run.
+            model_afid (str): The artifact id of a 'model_*' or 'checkpoint_*' artifact.
+
+        Returns:
+            RegistryEntry: The registered entry.
+        """
+        import wandb
+
+        api = wandb.Api()
+        training_run = api.run(training_run_id)
+        is_checkpoint = "checkpoint" in artifact_name(model_afid)
+        artifact = api.artifact(model_afid, type=None if is_checkpoint else "model")
+        versioned_afid = f"{model_afid.split(':')[0]}:{artifact.version}"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_run.file("hydra_config.yaml").download(root=tmp_dir, replace=True)
+            with open(f"{tmp_dir}/hydra_config.yaml", "r") as f:
+                trainer_cfg = OmegaConf.create(yaml.safe_load(f))
+            artifact_dir = Path(artifact.download(root=f"{tmp_dir}/artifact"))
+            weights = torch.load(
+                next(artifact_dir.glob("*.pth")), map_location="cpu", weights_only=False
+            )
+        state_dict = weights["model"] if is_checkpoint else weights
+        stats_path = trainer_cfg.training_dataset_cfg.get("stats_path")
+        return self.put(
+            trainer_cfg,
+            state_dict,
+            stats_path=stats_path,
+            name=versioned_afid,
+            metadata={"training_run_id": training_run_id, "model_afid": versioned_afid},
+        )
+
+    @staticmethod
+    def _resolve_wandb_alias(model_afid: str) -> str:
+        """Returns the artifact id of the version a wandb alias points to."""
+        import wandb
+
+        artifact = wandb.Api().artifact(model_afid)
+        return f"{model_afid.split(':')[0]}:{artifact.version}"
+
+    def load(
+        self,
+        model_afid: str,
+        training_run_id: Optional[str] = None,
+        wandb_fallback: bool = False,
+    ) -> RegistryEntry:
+        """Returns a registered entry, fetching it from wandb first if it is missing and
+        `wandb_fallback` is set.
+
+        With the fallback, a moving alias (e.g '...:latest') is first resolved to the version it
+        currently points to on wandb, such that a newer version is fetched once it is logged.
+
+        Raises:
+            KeyError: If the model is not registered and can't be fetched.
+        """
+        if (
+            wandb_fallback
+            and training_run_id is not None
+            and ":" in model_afid
+            and not is_concrete_version(model_afid)
+        ):
+            model_afid = self._resolve_wandb_alias(model_afid)
+        if model_afid in self:
+            return self.get(model_afid)
+        if not wandb_fallback or training_run_id is None:
+            raise KeyError(
+                f"'{model_afid}' is not in the model registry {self.root}. Register it with "
+                "scripts/model_registry.py, or enable the wandb fallback with a training run id."
+            )
+        logger.info(f"'{model_afid}' is not registered, fetching it from wandb.")
+        return self.fetch_from_wandb(training_run_id, model_afid)
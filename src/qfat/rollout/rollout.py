@@ -0,0 +1,212 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+import gym
+import numpy as np
+from tqdm import tqdm
+
+from qfat.environments.goal_conditional import GoalAppendingWrapper
+from qfat.samplers.sampler import BatchedAutoRegressiveSampler, ModelSampler
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EpisodeResult:
+    rewards: List[float]  # the reward of every step of the episode
+    completed_tasks: Optional[List[str]] = None  # if the environment tracks tasks
+
+
+class SerialRollout:
+    """Rolls out a model in a single environment, one episode after the other."""
+
+    def __init__(
+        self,
+        env: gym.Env,
+        sampler: ModelSampler,
+        max_steps: int,
+        is_goal_conditional: bool = False,
+    ) -> None:
+        """
+        Args:
+            env (gym.Env): The environment.
+            sampler (ModelSampler): The sampler of the model.
+            max_steps (int): The maximum number of steps per episode.
+            is_goal_conditional (bool): Whether the environment is goal conditional, in which case
+                its current goal is passed as the conditional sequence.
+
+        Raises:
+            ValueError: If the environment is goal conditional but not wrapped by a GoalAppendingWrapper.
+        """
+        if is_goal_conditional and not isinstance(env, GoalAppendingWrapper):
+            raise ValueError(
+                "For goal conditional tasks, the environment must be an instance of the class GoalAppendingWrapper"
+            )
+        self.env = env
+        self.sampler = sampler
+        self.max_steps = max_steps
+        self.is_goal_conditional = is_goal_conditional
+
+    def run(self, n_episodes: int, progress_bar: bool = True) -> List[EpisodeResult]:
+        """Runs n_episodes episodes, executing every sampled action chunk (of size
+        sampler.horizon + 1) before sampling the next one.
+
+        Args:
+            n_episodes (int): The number of episodes to run.
+            progress_bar (bool): Whether to display a progress bar over the episodes.
+
+        Returns:
+            List[EpisodeResult]: The results, in order.
+        """
+        results = []
+        for _ in tqdm(
+            range(n_episodes), desc="Model Rollouts", disable=not progress_bar
+        ):
+            s = self.env.reset()
+            self.sampler.reset()
+            done = False
+            step = 0
+            rewards = []
+            s_context = [s]
+            while not done and step < self.max_steps:
+                model_kwargs = {}
+                if self.is_goal_conditional:
+                    model_kwargs = {"conditional_seq": self.env.current_goal}
+                a, *_ = self.sampler.sample(x=s_context, model_kwargs=model_kwargs)
+                action_chunk = np.split(a.squeeze(), self.sampler.horizon + 1)
+                s_context = []
+                for a_h in action_chunk:
+                    s, r, done, *_ = self.env.step(a_h)
+                    rewards.append(r)
+                    s_context.append(s)
+                    step += 1
+                    if done or step >= self.max_steps:
+                        break
+            completed_tasks = getattr(self.env, "completed_tasks", None)
+            results.append(
+                EpisodeResult(
+                    rewards=rewards,
+                    completed_tasks=list(completed_tasks)
+                    if completed_tasks is not None
+                    else None,
+                )
+            )
+        return results
+
+
+class VectorizedRollout:
+    """Rolls out a model in several environment copies, batching the model calls of all live episodes."""
+
+    def __init__(
+        self,
+        envs: List[gym.Env],
+        sampler: BatchedAutoRegressiveSampler,
+        max_steps: int,
+        is_goal_conditional: bool = False,
+    ) -> None:
+        """
+        Args:
+            envs (List[gym.Env]): The environment copies, one per sampler slot.
+            sampler (BatchedAutoRegressiveSampler): The sampler, with a batch size equal to the number of envs.
+            max_steps (int): The maximum number of steps per episode.
+            is_goal_conditional (bool): Whether the environments are goal conditional, in which case
+                the current goal of every environment is passed as the conditional sequence.
+
+        Raises:
+            ValueError: If the sampler batch size does not match the number of environments.
+            ValueError: If the environments are goal conditional but not wrapped by a GoalAppendingWrapper.
+        """
+        if sampler.batch_size != len(envs):
+            raise ValueError(
+                f"The sampler batch size ({sampler.batch_size}) must match the number of environments ({len(envs)})."
+            )
+        if is_goal_conditional and not all(
+            isinstance(env, GoalAppendingWrapper) for env in envs
+        ):
+            raise ValueError(
+                "For goal conditional tasks, the environments must be instances of the class GoalAppendingWrapper"
+            )
+        self.envs = envs
+        self.sampler = sampler
+        self.max_steps = max_steps
+        self.is_goal_conditional = is_goal_conditional
+
+    def run(self, n_episodes: int, progress_bar: bool = True) -> List[EpisodeResult]:
+        """Runs n_episodes episodes, resetting every environment as soon as its episode ends.
+
+        Every environment keeps executing the actions of its last sampled action chunk (of size
+        sampler.horizon + 1). Once the chunk is exhausted, the environment requests a new one, and
+        all the requests of a step are sampled together.
+
+        Args:
+            n_episodes (int): The total number of episodes to run.
+            progress_bar (bool): Whether to display a progress bar over the finished episodes.
+
+        Returns:
+            List[EpisodeResult]: The results, in the order the episodes finished.
+        """
+        n_envs = len(self.envs)
+        pending_obs: List[List[Any]] = [[] for _ in range(n_envs)]
+        action_chunks: List[List[np.ndarray]] = [[] for _ in range(n_envs)]
+        rewards: List[List[float]] = [[] for _ in range(n_envs)]
+        steps = [0] * n_envs
+        active = [False] * n_envs
+        started = 0
+        results = []
+        pbar = tqdm(total=n_episodes, desc="Model Rollouts", disable=not progress_bar)
+
+        def start_episode(i: int) -> None:
+            nonlocal started
+            self.sampler.reset(i)
+            pending_obs[i] = [self.envs[i].reset()]
+            action_chunks[i] = []
+            rewards[i] = []
+            steps[i] = 0
+            active[i] = True
+            started += 1
+
+        for i in range(min(n_envs, n_episodes)):
+            start_episode(i)
+
+        while any(active):
+            requests = [i for i in range(n_envs) if active[i] and not action_chunks[i]]
+            if requests:
+                for i in requests:
+                    self.sampler.update_context(i, pending_obs[i])
+                    pending_obs[i] = []
+                conditional_seqs = (
+                    [self.envs[i].current_goal for i in requests]
+                    if self.is_goal_conditional
+                    else None
+                )
+                actions = self.sampler.sample(
+                    requests, conditional_seqs=conditional_seqs
+                )
+                for i, a in zip(requests, actions):
+                    action_chunks[i] = np.split(a, self.sampler.horizon + 1)
+
+            for i in range(n_envs):
+                if not active[i]:
+                    continue
+                s, r, done, *_ = self.envs[i].step(action_chunks[i].pop(0))
+                rewards[i].append(r)
+                pending_obs[i].append(s)
+                steps[i] += 1
+                if done or steps[i] >= self.max_steps:
+                    completed_tasks = getattr(self.envs[i], "completed_tasks", None)
+                    results.append(
+                        EpisodeResult(
+                            rewards=rewards[i],
+                            completed_tasks=list(completed_tasks)
+                            if completed_tasks is not None
+                            else None,
+                        )
+                    )
+                    pbar.update(1)
+                    if started < n_episodes:
+                        start_episode(i)
+                    else:
+                        active[i] = False
+        pbar.close()
+        return results
@@ -0,0 +1,181 @@
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import hydra
+import torch
+import torch.multiprocessing as mp
+
+from qfat.rollout.rollout import EpisodeResult, SerialRollout, VectorizedRollout
+from qfat.samplers.sampler import BatchedAutoRegressiveSampler
+from qfat.utils import set_seed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RolloutTask:
+    model_cfg: Any  # instantiates the model, e.g the model_cfg of the training config
+    state_dict: Dict[str, torch.Tensor]
+    env_cfg: Any
+    sampler_cfg: Any
+    n_episodes: int
+    max_steps: int
+    is_goal_conditional: bool = False
+    n_envs: int = 1
+    seed: int = 0
+
+
+def run_rollout_task(task: RolloutTask) -> List[EpisodeResult]:
+    """Rolls out a snapshot of a model on the cpu, in the process of a rollout worker.
+
+    Args:
+        task (RolloutTask): The model snapshot and the rollout parameters.
+
+    Returns:
+        List[EpisodeResult]: The results of the episodes.
+    """
+    set_seed(task.seed)
+    model = hydra.utils.instantiate(task.model_cfg, _recursive_=False, _convert_="none")
+    model.load_state_dict(task.state_dict, strict=False)
+    model.to("cpu")
+    model.eval()
+    envs = [
+        hydra.utils.instantiate(task.env_cfg, _recursive_=True, _convert_="none")
+        for _ in range(task.n_envs)
+    ]
+    sampler_kwargs = {"batch_size": task.n_envs} if task.n_envs > 1 else {}
+    sampler = hydra.utils.instantiate(
+        task.sampler_cfg,
+        model=model,
+        _recursive_=False,
+        _convert_="none",
+        **sampler_kwargs,
+    )
+    if task.n_envs > 1:
+        if not isinstance(sampler, BatchedAutoRegressiveSampler):
+            raise ValueError(
+                "For n_envs > 1, the sampler must be an instance of the class BatchedAutoRegressiveSampler"
+            )
+        rollout = VectorizedRollout(
+            envs=envs,
+            sampler=sampler,
+            max_steps=task.max_steps,
+            is_goal_conditional=task.is_goal_conditional,
+        )
+    else:
+        rollout = SerialRollout(
+            env=envs[0],
+            sampler=sampler,
+            max_steps=task.max_steps,
+            is_goal_conditional=task.is_goal_conditional,
+        )
+    try:
+        return rollout.run(n_episodes=task.n_episodes, progress_bar=False)
+    finally:
+        for env in envs:
+            env.close()
+
+
+def _init_worker(num_threads: int) -> None:
+    torch.set_num_threads(num_threads)
+
+
+class RolloutWorkerPool:
+    def __init__(self, n_workers: int, num_threads: int = 1) -> None:
+        """A pool of processes that roll out snapshots of a model in the background, such that
+        the evaluation doesn't block the training loop.
+
+        Every submission splits its episodes across the workers. Its results are only returned
+        by `collect` once all of its episodes finished, together with the key it was submitted
+        with (e.g the epoch of the snapshot), in submission order.
+
+        Args:
+            n_workers (int): The number of worker processes.
+            num_threads (int): The number of torch threads of every worker. Defaults to 1, such
+                that the workers don't compete with the training process for the cores.
+        """
+        self.n_workers = n_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            # forking a process that already runs torch (and maybe cuda) is unsafe
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(num_threads,),
+        )
+        self._pending: List[Tuple[int, List[Future]]] = []
+
+    def submit(
+        self,
+        key: int,
+        model: torch.nn.Module,
+        model_cfg: Any,
+        n_episodes: int,
+        seed: int = 0,
+        **task_kwargs,
+    ) -> None:
+        """Snapshots the weights of a model and schedules its rollouts.
+
+        Args:
+            key (int): Returned with the results, e.g the epoch of the snapshot.
+            model (torch.nn.Module): The model, whose weights are copied to the cpu.
+            model_cfg (Any): The config that instantiates the model.
+            n_episodes (int): The total number of episodes.
+            seed (int): The seed of the first worker, the others use the next seeds. Defaults to 0.
+            **task_kwargs: The other fields of `RolloutTask`.
+        """
+        state_dict = {
+            k: v.detach().cpu().clone() for k, v in model.state_dict().items()
+        }
+        n_chunks = min(self.n_workers, n_episodes)
+        futures = []
+        for i in range(n_chunks):
+            task = RolloutTask(
+                model_cfg=model_cfg,
+                state_dict=state_dict,
+                n_episodes=n_episodes // n_chunks + int(i < n_episodes % n_chunks),
+                seed=seed + i,
+                **task_kwargs,
+            )
+            futures.append(self.executor.submit(run_rollout_task, task))
+        self._pending.append((key, futures))
+
+    @property
+    def n_pending(self) -> int:
+        return len(self._pending)
+
+    def collect(
+        self, wait: bool = False, max_pending: Optional[int] = None
+    ) -> List[Tuple[int, List[EpisodeResult]]]:
+        """Returns the results of the finished submissions.
+
+        Args:
+            wait (bool): Whether to wait for all the submissions to finish. Defaults to False.
+            max_pending (Optional[int]): Waits for the oldest submissions until at most
+                max_pending are left. Defaults to None, i.e only the finished ones are returned.
+
+        Returns:
+            List[Tuple[int, List[EpisodeResult]]]: The key and the episode results of every
+                finished submission, in submission order.
+
+        Raises:
+            Exception: The exception of a failed rollout.
+        """
+        finished = []
+        while self._pending:
+            key, futures = self._pending[0]
+            must_wait = wait or (
+                max_pending is not None and len(self._pending) > max_pending
+            )
+            if not must_wait and not all(f.done() for f in futures):
+                break
+            results = []
+            for f in futures:
+                results.extend(f.result())
+            finished.append((key, results))
+            self._pending.pop(0)
+        return finished
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,163 @@
+import math
+from typing import Optional, Tuple
+
+import einops
+import torch
+import torch.nn.functional as F
+
+# ITU-R 601-2 luma weights, as used by torchvision's rgb_to_grayscale
+LUMA_WEIGHTS = (0.2989, 0.587, 0.114)
+
+
+def rgb_to_grayscale(img: torch.Tensor) -> torch.Tensor:
+    """Converts images of shape (N, 3, H, W) to grayscale images of shape (N, 1, H, W)."""
+    weights = img.new_tensor(LUMA_WEIGHTS).view(1, 3, 1, 1)
+    return (img * weights).sum(dim=1, keepdim=True)
+
+
+class BatchedImageAugmentation:
+    def __init__(
+        self,
+        output_size: Optional[int] = None,
+        brightness: float = 0.2,
+        contrast: float = 0.2,
+        saturation: float = 0.2,
+        jitter_prob: float = 0.5,
+        crop_scale: Tuple[float, float] = (0.8, 1.0),
+        crop_ratio: Tuple[float, float] = (3 / 4, 4 / 3),
+        crop_prob: float = 0.5,
+        grayscale_prob: float = 0.5,
+        per_sequence: bool = False,
+        max_value: float = 255.0,
+        interpolation: str = "bilinear",
+    ) -> None:
+        """Color jitter, random resized crop and grayscale applied to a whole batch of image
+        sequences with a handful of tensor operations.
+
+        The parameters of every augmentation are sampled as tensors, either per frame or per
+        sequence (such that all the frames of a sequence are augmented identically), and the crops
+        of all the frames are resampled by a single `grid_sample`.
+
+        Args:
+            output_size (Optional[int]): The size of the (square) output images. Defaults to None,
+                i.e the input height and width.
+            brightness (float): The brightness factor is sampled in [1 - brightness, 1 + brightness].
+            contrast (float): The contrast factor is sampled in [1 - contrast, 1 + contrast].
+            saturation (float): The saturation factor is sampled in [1 - saturation, 1 + saturation].
+            jitter_prob (float): Probability of applying the color jitter. Defaults to 0.5.
+            crop_scale (Tuple[float, float]): Range of the crop area, as a fraction of the image area.
+            crop_ratio (Tuple[float, float]): Range of the crop aspect ratio (width / height).
+            crop_prob (float): Probability of applying the random resized crop. Defaults to 0.5.
+            grayscale_prob (float): Probability of converting to grayscale. Defaults to 0.5.
+            per_sequence (bool): Whether to share the parameters across the frames of a sequence.
+                Defaults to False.
+            max_value (float): The maximum pixel value, e.g 1 or 255. Defaults to 255.
+            interpolation (str): The `grid_sample` interpolation mode. Defaults to "bilinear".
+        """
+        self.output_size = output_size
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.jitter_prob = jitter_prob
+        self.crop_scale = crop_scale
+        self.crop_ratio = crop_ratio
+        self.crop_prob = crop_prob
+        self.grayscale_prob = grayscale_prob
+        self.per_sequence = per_sequence
+        self.max_value = max_value
+        self.interpolation = interpolation
+
+    def _uniform(
+        self, low: float, high: float, b: int, t: int, device: torch.device
+    ) -> torch.Tensor:
+        """Samples one value per frame, shared by the frames of a sequence if `per_sequence`."""
+        n = b if self.per_sequence else b * t
+        values = torch.empty(n, device=device).uniform_(low, high)
+        return values.repeat_interleave(t) if self.per_sequence else values
+
+    def _bernoulli(
+        self, p: float, b: int, t: int, device: torch.device
+    ) -> torch.Tensor:
+        return self._uniform(0, 1, b, t, device) < p
+
+    def _factor(
+        self, strength: float, apply: torch.Tensor, b: int, t: int
+    ) -> torch.Tensor:
+        factor = self._uniform(1 - strength, 1 + strength, b, t, apply.device)
+        return torch.where(apply, factor, torch.ones_like(factor)).view(-1, 1, 1, 1)
+
+    def _color_jitter(self, img: torch.Tensor, b: int, t: int) -> torch.Tensor:
+        apply = self._bernoulli(self.jitter_prob, b, t, img.device)
+        if not apply.any():
+            return img
+        brightness = self._factor(self.brightness, apply, b, t)
+        img = (img * brightness).clamp(0, self.max_value)
+
+        contrast = self._factor(self.contrast, apply, b, t)
+        mean = rgb_to_grayscale(img).mean(dim=(-3, -2, -1), keepdim=True)
+        img = (contrast * img + (1 - contrast) * mean).clamp(0, self.max_value)
+
+        saturation = self._factor(self.saturation, apply, b, t)
+        gray = rgb_to_grayscale(img)
+        return (saturation * img + (1 - saturation) * gray).clamp(0, self.max_value)
+
+    def _crop_resize(self, img: torch.Tensor, b: int, t: int) -> torch.Tensor:
+        N, C, H, W = img.shape
+        size = self.output_size
+        out_h, out_w = (H, W) if size is None else (size, size)
+        apply = self._bernoulli(self.crop_prob, b, t, img.device)
+        if not apply.any() and (out_h, out_w) == (H, W):
+            return img
+
+        area = self._uniform(*self.crop_scale, b, t, img.device)
+        log_ratio = self._uniform(
+            math.log(self.crop_ratio[0]), math.log(self.crop_ratio[1]), b, t, img.device
+        )
+        ratio = log_ratio.exp()
+        # crop width and height as a fraction of the image width and height
+        crop_w = (area * ratio * H / W).sqrt().clamp(max=1)
+        crop_h = (area / ratio * W / H).sqrt().clamp(max=1)
+        crop_w = torch.where(apply, crop_w, torch.ones_like(crop_w))
+        crop_h = torch.where(apply, crop_h, torch.ones_like(crop_h))
+        # crop centers in normalized [-1, 1] coordinates
+        center_x = (self._uniform(0, 1, b, t, img.device) * 2 - 1) * (1 - crop_w)
+        center_y = (self._uniform(0, 1, b, t, img.device) * 2 - 1) * (1 - crop_h)
+
+        theta = torch.zeros(N, 2, 3, device=img.device, dtype=img.dtype)
+        theta[:, 0, 0] = crop_w
+        theta[:, 0, 2] = center_x
+        theta[:, 1, 1] = crop_h
+        theta[:, 1, 2] = center_y
+        grid = F.affine_grid(theta, [N, C, out_h, out_w], align_corners=False)
+        return F.grid_sample(
+            img,
+            grid,
+            mode=self.interpolation,
+            padding_mode="border",
+            align_corners=False,
+        )
+
+    def _grayscale(self, img: torch.Tensor, b: int, t: int) -> torch.Tensor:
+        apply = self._bernoulli(self.grayscale_prob, b, t, img.device)
+        if not apply.any():
+            return img
+        gray = rgb_to_grayscale(img).expand_as(img)
+        return torch.where(apply.view(-1, 1, 1, 1), gray, img)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        """Augments a batch of image sequences.
+
+        Args:
+            x (torch.Tensor): The images of shape (B, T, H, W, C), with C = 3.
+
+        Returns:
+            torch.Tensor: The augmented images of shape (B, T, output_size, output_size, C).
+        """
+        b, t = x.shape[:2]
+        img = einops.rearrange(x, "b t h w c -> (b t) c h w").float()
+        img = self._color_jitter(img, b, t)
+        img = self._crop_resize(img, b, t)
+        img = self._grayscale(img, b, t)
+        if not x.is_floating_point():
+            img = img.round()
+        return einops.rearrange(img, "(b t) c h w -> b t h w c", b=b, t=t).to(x.dtype)
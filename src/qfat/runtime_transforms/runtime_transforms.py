@@ -2,12 +2,11 @@ import math
 from abc import ABC, abstractmethod
 from typing import Optional
 
-import einops
 import torch
-from torchvision import transforms
 
 import wandb
 from qfat.datasets.dataset import Batch
+from qfat.runtime_transforms.image_augmentation import BatchedImageAugmentation
 
 
 class RuntimeTransform(ABC):
@@ -187,56 +186,40 @@ class AnnealedGaussianPerturbation(RuntimeTransform):
 
 
 class ImageAugmentationTransform(RuntimeTransform):
-    def __init__(self, image_size: int, prob: float = 0.5):
+    def __init__(
+        self,
+        image_size: int,
+        prob: float = 0.5,
+        per_sequence: bool = False,
+        max_value: float = 255.0,
+    ):
         """
         Args:
             image_size (int): The desired size for random cropping.
             prob (float): Probability of applying each augmentation.
+            per_sequence (bool): Whether to augment all the frames of a sequence identically.
+            max_value (float): The maximum pixel value of the images.
         """
         self.image_size = image_size
         self.prob = prob
-
-        self.augmentations = transforms.Compose(
-            [
-                transforms.RandomApply(
-                    [
-                        transforms.ColorJitter(
-                            brightness=0.2, contrast=0.2, saturation=0.2
-                        )
-                    ],
-                    p=self.prob,
-                ),
-                transforms.RandomApply(
-                    [transforms.RandomResizedCrop(size=image_size, scale=(0.8, 1.0))],
-                    p=self.prob,
-                ),
-                transforms.RandomApply(
-                    [transforms.RandomGrayscale(p=1.0)],
-                    p=self.prob,
-                ),
-            ]
-        )
-
-        self.pipeline = transforms.Compose(
-            [
-                transforms.Lambda(
-                    lambda x: torch.stack([self.augmentations(x_) for x_ in x])
-                )
-            ]
+        self.augmentations = BatchedImageAugmentation(
+            output_size=image_size,
+            brightness=0.2,
+            contrast=0.2,
+            saturation=0.2,
+            jitter_prob=prob,
+            crop_scale=(0.8, 1.0),
+            crop_prob=prob,
+            grayscale_prob=prob,
+            per_sequence=per_sequence,
+            max_value=max_value,
         )
 
     def _augment_tensor(self, x):
-        """Rearrange, augment via self.pipeline, and reshape back."""
+        """Augments a (B, T, H, W, C) batch of images on its own device."""
         if x is None:
             return None
-
-        device = x.device
-        b, t, h, w, c = x.shape
-
-        x = einops.rearrange(x, "b t h w c -> (b t) c h w")
-        x = self.pipeline(x)
-        x = x.view(b, t, *x.shape[1:]).permute(0, 1, 3, 4, 2)
-        return x.to(device)
+        return self.augmentations(x)
 
     def __call__(self, batch: Batch, epoch: int) -> Batch:
         """Applies augmentations to `batch.x` and `batch.conditional_seq` if available."""
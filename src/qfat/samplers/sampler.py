@@ -1,14 +1,24 @@
 import logging
 from abc import ABC, abstractmethod
+from collections import defaultdict, deque
 from queue import Queue
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 from line_profiler import profile
 from numpy.typing import NDArray
 
+from qfat.models.export import (
+    ExportMethod,
+    QFATInferenceModule,
+    export_qfat,
+    most_likely_mean,
+    sample_gmm_tensors,
+    sample_modes_tensors,
+)
 from qfat.models.generative_model import GenerativeModel, ModelOutput
+from qfat.models.qfat import QFAT, KVCache
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +56,7 @@ class AutoRegressiveSampler(ModelSampler):
         horizon: int = 0,
         use_tensors: bool = False,
         sample_fn: str = "modes",
+        use_kv_cache: bool = False,
     ) -> None:
         """Keeps track of inputs in a queue and passes it autoregressively to the model's sample function.
 
@@ -56,6 +67,13 @@ class AutoRegressiveSampler(ModelSampler):
             temperature (float, optional): A temperature to scale the variances of the model. Defaults to 1.
             use_tensors (bool, optional): If True, keeps the context in PyTorch tensors. Defaults to False (NumPy).
             sample_fn (str): Which sample function to set for the model. For QFAT, can be either "modes" or "gmm".
+            use_kv_cache (bool): Whether to pass only the new observations to the model, which caches the
+                rest. Requires the model to support a 'kv_cache' sample kwarg. For QFAT, only the first
+                context_len steps of an episode are decoded incrementally from the cached keys and values.
+                Once the context is full, every step slides the window and shifts the learned positional
+                embedding of every token, so the decoder runs over the whole window again and only the
+                encoding of the past observations is saved. See scripts/benchmark_kv_cache.py.
+                Defaults to False.
         Raises:
             ValueError: If the passed model has no attribute 'context_len'.
         """
@@ -71,6 +89,14 @@ class AutoRegressiveSampler(ModelSampler):
         self.horizon = horizon
         self.use_tensors = use_tensors
         self.model.sample_fn = sample_fn
+        self.kv_cache = None
+        if use_kv_cache:
+            if getattr(self.model, "pad_sampling", False):
+                logger.warning(
+                    "Cached decoding is not supported for models with 'pad_sampling'. Disabling it."
+                )
+            else:
+                self.kv_cache = KVCache()
 
     def _convert_to_context_format(
         self, x: Union[np.ndarray, torch.Tensor]
@@ -116,6 +142,8 @@ class AutoRegressiveSampler(ModelSampler):
         """Clears the context."""
         with self.context.mutex:
             self.context.queue.clear()
+        if self.kv_cache is not None:
+            self.kv_cache.reset()
 
     @profile
     def sample(
@@ -137,7 +165,18 @@ class AutoRegressiveSampler(ModelSampler):
         """
         if model_kwargs is None:
             model_kwargs = {}
-        x = self.update_context(x=x)[None, ...]  # add batch dimension
+        if self.kv_cache is not None:
+            self.update_context(x=x)
+            if not isinstance(x, list):
+                x = [x]
+            x = [self._convert_to_context_format(_x) for _x in x]
+            # only the new observations are passed, the rest is cached by the model
+            x = (torch.stack(x, dim=0) if self.use_tensors else np.stack(x, axis=0))[
+                None, ...
+            ]
+            model_kwargs = {**model_kwargs, "kv_cache": self.kv_cache}
+        else:
+            x = self.update_context(x=x)[None, ...]  # add batch dimension
         output, model_out, metadata = self.model.sample(
             x=x, temperature=self.temperature, **model_kwargs
         )
@@ -149,6 +188,133 @@ class AutoRegressiveSampler(ModelSampler):
         )
 
 
+class BatchedAutoRegressiveSampler(ModelSampler):
+    def __init__(
+        self,
+        model: GenerativeModel,
+        batch_size: int,
+        context_len: Optional[int] = None,
+        temperature: float = 1,
+        horizon: int = 0,
+        use_tensors: bool = False,
+        sample_fn: str = "gmm",
+    ) -> None:
+        """Keeps track of one context per slot (e.g one per environment copy) and samples
+        the next output of several slots with a single batched forward pass.
+
+        Slots whose contexts have different lengths (e.g after a slot was reset) can't share a
+        forward pass without changing the attention, so they are grouped by context length.
+
+        Args:
+            model (GenerativeModel): The generative model used for sampling.
+            batch_size (int): The number of slots.
+            context_len (Optional[int], optional): The context length. Defaults to None, which
+                will assume the model has an attribute 'context_len' which will be used.
+            temperature (float, optional): A temperature to scale the variances of the model. Defaults to 1.
+            horizon (int, optional): The number of extra actions predicted per sample. Defaults to 0.
+            use_tensors (bool, optional): If True, keeps the context in PyTorch tensors. Defaults to False (NumPy).
+            sample_fn (str): Which sample function to set for the model. For QFAT, can be either "modes" or "gmm".
+        Raises:
+            ValueError: If the passed model has no attribute 'context_len'.
+        """
+        super().__init__(model)
+        if hasattr(self.model, "context_len") and context_len is None:
+            context_len = self.model.context_len
+        if context_len is None:
+            raise ValueError(
+                "'context_len' was not passed and it was not found as an attribute of the model."
+            )
+        self.batch_size = batch_size
+        self.contexts = [deque(maxlen=context_len) for _ in range(batch_size)]
+        self.temperature = temperature
+        self.horizon = horizon
+        self.use_tensors = use_tensors
+        self.model.sample_fn = sample_fn
+
+    def _convert_to_context_format(
+        self, x: Union[np.ndarray, torch.Tensor]
+    ) -> Union[np.ndarray, torch.Tensor]:
+        """Converts input to the desired context format (NumPy or PyTorch)."""
+        if self.use_tensors:
+            return x if isinstance(x, torch.Tensor) else torch.from_numpy(x)
+        else:
+            return x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else x
+
+    def _stack(
+        self, x: List[Union[np.ndarray, torch.Tensor]]
+    ) -> Union[np.ndarray, torch.Tensor]:
+        return torch.stack(x, dim=0) if self.use_tensors else np.stack(x, axis=0)
+
+    def update_context(
+        self,
+        idx: int,
+        x: Union[np.ndarray, torch.Tensor, List[Union[np.ndarray, torch.Tensor]]],
+    ) -> None:
+        """Appends the new observation(s) to the context of a slot.
+
+        Args:
+            idx (int): The slot index.
+            x (Union[np.ndarray, torch.Tensor, List[Union[np.ndarray, torch.Tensor]]]): The new observation(s).
+        """
+        if not isinstance(x, list):
+            x = [x]
+        self.contexts[idx].extend(self._convert_to_context_format(_x) for _x in x)
+
+    def reset(self, idx: Optional[int] = None) -> None:
+        """Clears the context of a slot, or of all the slots if idx is None."""
+        contexts = self.contexts if idx is None else [self.contexts[idx]]
+        for context in contexts:
+            context.clear()
+
+    @profile
+    def sample(
+        self,
+        indices: List[int],
+        conditional_seqs: Optional[List[Union[np.ndarray, torch.Tensor]]] = None,
+        model_kwargs: Optional[Dict] = None,
+    ) -> np.ndarray:
+        """Samples the next output of the given slots from their current contexts.
+
+        Args:
+            indices (List[int]): The slots to sample for.
+            conditional_seqs (Optional[List[Union[np.ndarray, torch.Tensor]]]): One conditional sequence
+                of shape (1, T_cond, ...) per slot in indices, e.g the goals. Defaults to None.
+            model_kwargs (Optional[Dict]): Keyword arguments for the model's sample function.
+
+        Returns:
+            np.ndarray: The sampled outputs of shape (len(indices), output_dim), ordered as indices.
+        """
+        if model_kwargs is None:
+            model_kwargs = {}
+        groups = defaultdict(list)
+        for row, idx in enumerate(indices):
+            groups[len(self.contexts[idx])].append(row)
+
+        outputs = [None] * len(indices)
+        for rows in groups.values():
+            x = self._stack(
+                [self._stack(list(self.contexts[indices[row]])) for row in rows]
+            )
+            batch_kwargs = dict(model_kwargs)
+            if conditional_seqs is not None:
+                cond = [conditional_seqs[row] for row in rows]
+                batch_kwargs["conditional_seq"] = (
+                    torch.cat(cond, dim=0)
+                    if isinstance(cond[0], torch.Tensor)
+                    else np.concatenate(cond, axis=0)
+                )
+            output, *_ = self.model.sample(
+                x=x,
+                temperature=self.temperature,
+                return_output=False,
+                **batch_kwargs,
+            )
+            output = output.reshape(len(rows), -1).cpu().numpy()
+            for row, out in zip(rows, output):
+                outputs[row] = out
+        return np.stack(outputs, axis=0)
+
+
 class DualContextAutoRegressiveSampler(ModelSampler):
     def __init__(
         self,
@@ -300,7 +466,7 @@ class DualContextAutoRegressiveSampler(ModelSampler):
             **model_input, temperature=self.temperature, **model_kwargs
         )
 
-        new_action = output.squeeze(0)
+        new_action = output[0, -1]
         self.update_contexts(action=new_action)
         final_action = (
             output.squeeze((0, 1)).cpu().numpy()
@@ -313,3 +479,120 @@ class DualContextAutoRegressiveSampler(ModelSampler):
             model_out if return_output else None,
             metadata,
         )
+
+
+class ExportedSampler(ModelSampler):
+    def __init__(
+        self,
+        model: QFAT,
+        context_len: Optional[int] = None,
+        temperature: float = 1,
+        horizon: int = 0,
+        sample_fn: str = "modes",
+        method: ExportMethod = "compile",
+    ) -> None:
+        """Samples from an exported QFAT forward (see `qfat.models.export`), that only returns the
+        raw GMM tensors of the last token, and samples the next output from those tensors.
+
+        The exported forward is specialized to the shapes of its inputs. It is exported (once per
+        input shapes) for full contexts only, while the first steps of an episode, whose contexts
+        are still growing, run the same forward eagerly. Models with 'pad_sampling' always see
+        full contexts.
+
+        Args:
+            model (QFAT): The model to export.
+            context_len (Optional[int], optional): The context length. Defaults to None, i.e the
+                context length of the model.
+            temperature (float, optional): A temperature to scale the variances of the model. Defaults to 1.
+            horizon (int, optional): The number of extra actions predicted per sample. Defaults to 0.
+            sample_fn (str): Either "modes", "gmm" or "mean" (the mean of the most likely component).
+                Defaults to "modes".
+            method (ExportMethod): The export method, see `export_qfat`. Defaults to "compile".
+
+        Raises:
+            ValueError: If the sample function is unknown.
+        """
+        super().__init__(model)
+        if sample_fn not in ("modes", "gmm", "mean"):
+            raise ValueError(f"Unknown sample function '{sample_fn}'.")
+        self.context_len = (
+            self.model.context_len if context_len is None else context_len
+        )
+        self.context = deque(maxlen=self.context_len)
+        self.temperature = temperature
+        self.horizon = horizon
+        self.sample_fn = sample_fn
+        self.method = method
+        self.eager_forward = QFATInferenceModule(self.model)
+        self._exported: Dict[Tuple, Callable] = {}
+
+    def reset(self) -> None:
+        """Clears the context."""
+        self.context.clear()
+
+    def _forward(self, **inputs: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        if inputs["x"].shape[1] < self.context_len:
+            return self.eager_forward(**inputs)
+        key = tuple((name, tuple(value.shape)) for name, value in inputs.items())
+        if key not in self._exported:
+            logger.info(f"Exporting the model with '{self.method}' for inputs {key}")
+            self._exported[key] = export_qfat(self.model, method=self.method, **inputs)
+        return self._exported[key](**inputs)
+
+    @profile
+    def sample(
+        self,
+        x: Union[np.ndarray, torch.Tensor, List[Union[np.ndarray, torch.Tensor]]],
+        model_kwargs: Optional[Dict] = None,
+        return_output: bool = True,
+    ) -> Tuple[np.ndarray, None, Dict[str, Any]]:
+        """Samples the next output, while keeping track of the previously passed context.
+
+        Args:
+            x (Union[np.ndarray, torch.Tensor]): The new observation to add to the context.
+            model_kwargs (Optional[Dict]): Can hold the 'prev_actions' and the 'conditional_seq'.
+            return_output (bool): Unused, no model output is built. Defaults to True.
+
+        Returns:
+            Tuple[np.ndarray, None, Dict[str, Any]]: A tuple of the sampled output, None in place
+                of the model output, and the mixture probabilities as metadata.
+        """
+        if model_kwargs is None:
+            model_kwargs = {}
+        if not isinstance(x, list):
+            x = [x]
+        self.context.extend(
+            _x if isinstance(_x, torch.Tensor) else torch.from_numpy(np.asarray(_x))
+            for _x in x
+        )
+        batch = self.model.sampling_preprocessing(
+            torch.stack(list(self.context), dim=0)[None, ...],
+            conditional_seq=model_kwargs.get("conditional_seq"),
+            prev_actions=model_kwargs.get("prev_actions"),
+        )
+        inputs = {"x": batch.x}
+        if batch.prev_actions is not None:
+            inputs["prev_actions"] = batch.prev_actions
+        if (
+            batch.conditional_seq is not None
+            and self.model.conditional_seq_layer is not None
+        ):
+            inputs["conditional_seq"] = batch.conditional_seq
+
+        with torch.inference_mode():
+            locs, mixture_probs, variances = self._forward(**inputs)
+            if self.sample_fn == "gmm":
+                output = sample_gmm_tensors(
+                    locs, mixture_probs, variances, self.temperature
+                )
+            elif self.sample_fn == "mean":
+                output = most_likely_mean(locs, mixture_probs)
+            else:
+                output = sample_modes_tensors(
+                    locs, mixture_probs, variances, self.temperature
+                )
+        return (
+            output.squeeze(0).cpu().numpy(),
+            None,
+            {"mixture_probabilities": mixture_probs.squeeze(0).cpu().numpy()},
+        )
@@ -4,7 +4,6 @@ import tempfile
 from collections import Counter
 from typing import Dict, Hashable, List, Tuple, Union
 
-import hydra
 import numpy as np
 import torch
 import yaml
@@ -15,6 +14,7 @@ from torch.distributions import MixtureSameFamily
 
 import wandb
 from qfat.conf.configs import TrainingEntrypointCfg
+from qfat.registry import ModelRegistry
 
 # matplotlib.use("Agg")
 
@@ -97,19 +97,12 @@ def load_training_config(training_run_id: str) -> TrainingEntrypointCfg:
 
 
 def load_model_from_wandb(training_run_id: str, model_afid: str) -> torch.nn.Module:
-    """Loads a model from a training run"""
-    api = wandb.Api()
-    artifact = api.artifact(model_afid, type="model")
-    trainer_cfg = load_training_config(training_run_id)
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        artifact_dir = artifact.download(root=tmp_dir)
-        model = hydra.utils.instantiate(
-            trainer_cfg.model_cfg, _recursive_=False, _convert_="none"
-        )
-        model_path = f"{artifact_dir}/model.pth"
-        model.load_state_dict(torch.load(model_path, weights_only=True), strict=False)
-    model.eval()
-    return model
+    """Loads a model from a training run, through the local model registry such that it is
+    only downloaded once"""
+    entry = ModelRegistry().load(
+        model_afid, training_run_id=training_run_id, wandb_fallback=True
+    )
+    return entry.load_model()
 
 
 def get_latest_model_name(training_run_id: str, checkpoint: bool = False) -> str:
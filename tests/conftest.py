@@ -0,0 +1,54 @@
+from typing import Callable
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from qfat.conf.configs import (
+    DecoderBlockCfg,
+    IdentityEncoderCfg,
+    MultiheadAttentionCfg,
+    OptimizerCfg,
+)
+from qfat.models.qfat import QFAT
+
+
+@pytest.fixture
+def make_qfat() -> Callable[..., QFAT]:
+    """Returns a factory of small, randomly initialized QFAT models in eval mode."""
+
+    def _make_qfat(
+        context_len: int = 6,
+        input_dim: int = 5,
+        out_dim: int = 3,
+        mixture_size: int = 4,
+        n_layer: int = 2,
+        embed_dim: int = 16,
+        num_heads: int = 2,
+        seed: int = 0,
+        **kwargs,
+    ) -> QFAT:
+        torch.manual_seed(seed)
+        model = QFAT(
+            context_len=context_len,
+            input_dim=input_dim,
+            n_layer=n_layer,
+            out_dim=out_dim,
+            mixture_size=mixture_size,
+            embd_dropout=0,
+            encoder_cfg=IdentityEncoderCfg(),
+            # a DictConfig like the one hydra passes, since the decoder blocks unpack it
+            decoder_block_cfg=OmegaConf.structured(
+                DecoderBlockCfg(
+                    mha_cfg=MultiheadAttentionCfg(
+                        embed_dim=embed_dim, num_heads=num_heads
+                    )
+                )
+            ),
+            optimizer_cfg=OptimizerCfg(n_epochs=1),
+            **kwargs,
+        )
+        model.eval()
+        return model
+
+    return _make_qfat
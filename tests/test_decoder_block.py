@@ -0,0 +1,142 @@
+import pytest
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from qfat.conf.configs import DecoderBlockCfg, MultiheadAttentionCfg
+from qfat.models.decoder_block import DecoderBlock, SelfAttention
+
+B, T, EMBED_DIM, NUM_HEADS = 3, 5, 16, 4
+
+
+class BaselineDecoderBlock(nn.Module):
+    """The decoder block before `SelfAttention`, built on nn.MultiheadAttention."""
+
+    def __init__(self, cfg: DecoderBlockCfg):
+        super().__init__()
+        mha_cfg = cfg.mha_cfg
+        self.ln_1 = nn.LayerNorm(mha_cfg.embed_dim)
+        self.attn = nn.MultiheadAttention(**mha_cfg, batch_first=True)
+        self.ln_2 = nn.LayerNorm(mha_cfg.embed_dim)
+        self.mlp = nn.ModuleDict(
+            dict(
+                c_fc=nn.Linear(
+                    mha_cfg.embed_dim, cfg.mlp_expansion_factor * mha_cfg.embed_dim
+                ),
+                c_proj=nn.Linear(
+                    cfg.mlp_expansion_factor * mha_cfg.embed_dim, mha_cfg.embed_dim
+                ),
+                act=nn.GELU(),
+                dropout=nn.Dropout(cfg.residual_dropout),
+            )
+        )
+
+    def forward(self, x: torch.Tensor, **mha_kwargs) -> torch.Tensor:
+        m = self.mlp
+        x = self.ln_1(x)
+        attn_out, _ = self.attn(query=x, key=x, value=x, **mha_kwargs)
+        x = x + attn_out
+        x = x + m.dropout(m.c_proj(m.act(m.c_fc(self.ln_2(x)))))
+        return x
+
+
+def make_cfg(**mha_kwargs) -> DecoderBlockCfg:
+    return OmegaConf.structured(
+        DecoderBlockCfg(
+            mha_cfg=MultiheadAttentionCfg(
+                embed_dim=EMBED_DIM, num_heads=NUM_HEADS, **mha_kwargs
+            )
+        )
+    )
+
+
+def make_blocks(**mha_kwargs):
+    """Returns a baseline block and a block loaded from its state dict."""
+    torch.manual_seed(0)
+    cfg = make_cfg(**mha_kwargs)
+    baseline = BaselineDecoderBlock(cfg)
+    for p in baseline.parameters():  # the biases are initialized to zeros
+        nn.init.normal_(p, std=0.2)
+    block = DecoderBlock(cfg)
+    block.load_state_dict(baseline.state_dict(), strict=True)
+    return baseline.eval(), block.eval()
+
+
+CAUSAL = torch.ones(T, T, dtype=torch.bool).tril()
+DIAGONAL = torch.eye(T, dtype=torch.bool)
+# padding at the end of the sequences, such that no query is left without keys
+KEY_PADDING = torch.arange(T)[None, :] >= torch.tensor([T, 3, 1])[:, None]
+
+
+def test_state_dict_names_match_multihead_attention():
+    attn = SelfAttention(EMBED_DIM, NUM_HEADS, add_bias_kv=True)
+    reference = nn.MultiheadAttention(EMBED_DIM, NUM_HEADS, add_bias_kv=True)
+    assert set(attn.state_dict()) == set(reference.state_dict())
+    for name, tensor in reference.state_dict().items():
+        assert attn.state_dict()[name].shape == tensor.shape, name
+
+
+@pytest.mark.parametrize(
+    "mask, key_padding_mask, is_causal",
+    [
+        (CAUSAL, None, True),
+        (CAUSAL, None, False),
+        (DIAGONAL, None, False),
+        (None, KEY_PADDING, False),
+        (CAUSAL, KEY_PADDING, True),
+        (CAUSAL, KEY_PADDING, False),
+    ],
+    ids=[
+        "is_causal",
+        "causal_mask",
+        "diagonal_mask",
+        "key_padding",
+        "is_causal_key_padding",
+        "causal_mask_key_padding",
+    ],
+)
+@pytest.mark.parametrize(
+    "mha_kwargs",
+    [{}, {"add_bias_kv": True}, {"add_zero_attn": True}, {"bias": False}],
+    ids=["default", "add_bias_kv", "add_zero_attn", "no_bias"],
+)
+def test_decoder_block_matches_multihead_attention_baseline(
+    mask, key_padding_mask, is_causal, mha_kwargs
+):
+    baseline, block = make_blocks(**mha_kwargs)
+    x = torch.randn(B, T, EMBED_DIM)
+
+    baseline_kwargs = {}
+    if mask is not None:
+        # nn.MultiheadAttention masks the positions that are True
+        baseline_kwargs["attn_mask"] = ~mask
+    if key_padding_mask is not None:
+        baseline_kwargs["key_padding_mask"] = key_padding_mask
+    with torch.no_grad():
+        expected = baseline(x, **baseline_kwargs)
+        out = block(
+            x,
+            attn_mask=None if is_causal else mask,
+            is_causal=is_causal,
+            key_padding_mask=key_padding_mask,
+        )
+    torch.testing.assert_close(out, expected, atol=1e-5, rtol=1e-4)
+
+
+def test_cached_block_matches_forward():
+    _, block = make_blocks()
+    x = torch.randn(B, T, EMBED_DIM)
+    with torch.no_grad():
+        expected = block(x, is_causal=True)
+        out, past_key_value = block.forward_with_cache(
+            x[:, :2], attn_mask=CAUSAL[:2, :2]
+        )
+        outs = [out]
+        for t in range(2, T):
+            out, past_key_value = block.forward_with_cache(
+                x[:, t : t + 1],
+                attn_mask=CAUSAL[t : t + 1, : t + 1],
+                past_key_value=past_key_value,
+            )
+            outs.append(out)
+    torch.testing.assert_close(torch.cat(outs, dim=1), expected, atol=1e-5, rtol=1e-4)
@@ -0,0 +1,103 @@
+import pytest
+import torch
+from torch.distributions import Categorical, MixtureSameFamily, MultivariateNormal
+
+from qfat.models.qfat import DiagonalGaussianMixture, MultivariateNormalDiag
+
+BATCH_SHAPE = (3, 5)
+K, D = 4, 3
+
+
+def random_params(seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    mixture_probs = torch.softmax(
+        torch.randn(*BATCH_SHAPE, K, generator=generator), dim=-1
+    )
+    locs = torch.randn(*BATCH_SHAPE, K, D, generator=generator)
+    variances = torch.rand(*BATCH_SHAPE, K, D, generator=generator) + 0.1
+    return mixture_probs, locs, variances
+
+
+def reference_mixture(mixture_probs, locs, variances) -> MixtureSameFamily:
+    return MixtureSameFamily(
+        mixture_distribution=Categorical(probs=mixture_probs),
+        component_distribution=MultivariateNormal(
+            loc=locs, scale_tril=torch.diag_embed(variances.sqrt())
+        ),
+    )
+
+
+@pytest.mark.parametrize("temperature", [1.0, 0.5, 2.0])
+def test_log_prob_matches_mixture_same_family(temperature):
+    mixture_probs, locs, variances = random_params()
+    variances = variances * temperature
+    dist = DiagonalGaussianMixture(mixture_probs, locs, variances)
+    reference = reference_mixture(mixture_probs, locs, variances)
+
+    value = torch.randn(*BATCH_SHAPE, D)
+    torch.testing.assert_close(dist.log_prob(value), reference.log_prob(value))
+    # values broadcast against the batch shape, e.g several samples at once
+    value = torch.randn(7, *BATCH_SHAPE, D)
+    torch.testing.assert_close(dist.log_prob(value), reference.log_prob(value))
+
+
+def test_component_log_prob_matches_multivariate_normal():
+    _, locs, variances = random_params()
+    value = torch.randn(*BATCH_SHAPE, K, D)
+    reference = MultivariateNormal(
+        loc=locs, scale_tril=torch.diag_embed(variances.sqrt())
+    )
+    component = MultivariateNormalDiag(loc=locs, variances=variances)
+    torch.testing.assert_close(component.log_prob(value), reference.log_prob(value))
+    torch.testing.assert_close(component.entropy(), reference.entropy())
+    torch.testing.assert_close(component.scale_tril, reference.scale_tril)
+
+
+@pytest.mark.parametrize("temperature", [1.0, 0.5])
+def test_mean_and_variance_match_mixture_same_family(temperature):
+    mixture_probs, locs, variances = random_params()
+    variances = variances * temperature
+    dist = DiagonalGaussianMixture(mixture_probs, locs, variances)
+    reference = reference_mixture(mixture_probs, locs, variances)
+
+    torch.testing.assert_close(dist.mean, reference.mean)
+    torch.testing.assert_close(dist.variance, reference.variance)
+    torch.testing.assert_close(
+        dist.mixture_entropy(), Categorical(mixture_probs).entropy()
+    )
+
+
+@pytest.mark.parametrize("sample_shape", [(), (2,), (2, 6)])
+def test_sample_shape_matches_mixture_same_family(sample_shape):
+    mixture_probs, locs, variances = random_params()
+    dist = DiagonalGaussianMixture(mixture_probs, locs, variances)
+    reference = reference_mixture(mixture_probs, locs, variances)
+
+    sample = dist.sample(torch.Size(sample_shape))
+    assert sample.shape == reference.sample(torch.Size(sample_shape)).shape
+    assert sample.shape == (*sample_shape, *BATCH_SHAPE, D)
+
+
+@pytest.mark.parametrize("temperature", [1.0, 0.25])
+def test_sample_moments_match_mixture_same_family(temperature):
+    torch.manual_seed(0)
+    mixture_probs, locs, variances = random_params()
+    variances = variances * temperature
+    dist = DiagonalGaussianMixture(mixture_probs, locs, variances)
+    reference = reference_mixture(mixture_probs, locs, variances)
+
+    samples = dist.sample((20_000,))
+    torch.testing.assert_close(samples.mean(dim=0), reference.mean, atol=0.1, rtol=0.05)
+    torch.testing.assert_close(
+        samples.var(dim=0), reference.variance, atol=0.15, rtol=0.1
+    )
+
+
+def test_rsample_propagates_gradients_to_the_components():
+    mixture_probs, locs, variances = random_params()
+    locs.requires_grad_()
+    variances.requires_grad_()
+    dist = DiagonalGaussianMixture(mixture_probs, locs, variances)
+    dist.rsample((4,)).sum().backward()
+    assert locs.grad is not None and locs.grad.abs().sum() > 0
+    assert variances.grad is not None and variances.grad.abs().sum() > 0
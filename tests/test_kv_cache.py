@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import torch
+
+from qfat.datasets.dataset import Batch
+from qfat.models.qfat import KVCache
+from qfat.samplers.sampler import AutoRegressiveSampler
+
+CONTEXT_LEN = 4
+INPUT_DIM = 5
+
+
+def run_episode(sampler: AutoRegressiveSampler, observations: np.ndarray):
+    sampler.reset()
+    actions, params = [], []
+    for step, obs in enumerate(observations):
+        torch.manual_seed(step)
+        action, out, _ = sampler.sample(obs)
+        actions.append(action)
+        params.append(out.output[:, -1])
+    return actions, params
+
+
+@pytest.mark.parametrize("sample_fn", ["modes", "gmm"])
+def test_cached_sampling_matches_full_forward(make_qfat, sample_fn):
+    model = make_qfat(context_len=CONTEXT_LEN, input_dim=INPUT_DIM)
+    # runs past the context length, such that the window slides and the cache is rebuilt
+    observations = (
+        np.random.default_rng(0)
+        .standard_normal((3 * CONTEXT_LEN, INPUT_DIM))
+        .astype(np.float32)
+    )
+    full = run_episode(
+        AutoRegressiveSampler(model, sample_fn=sample_fn, use_kv_cache=False),
+        observations,
+    )
+    cached_sampler = AutoRegressiveSampler(
+        model, sample_fn=sample_fn, use_kv_cache=True
+    )
+    assert cached_sampler.kv_cache is not None
+    cached = run_episode(cached_sampler, observations)
+
+    for step, (action, expected_action) in enumerate(zip(cached[0], full[0])):
+        np.testing.assert_allclose(
+            action, expected_action, atol=1e-4, err_msg=f"step {step}"
+        )
+    for step, (params, expected_params) in enumerate(zip(cached[1], full[1])):
+        for name in ["locs", "variances", "mixture_probs"]:
+            torch.testing.assert_close(
+                getattr(params, name),
+                getattr(expected_params, name),
+                atol=1e-5,
+                rtol=1e-4,
+                msg=f"{name} at step {step}",
+            )
+
+
+def test_cached_sampling_restarts_after_reset(make_qfat):
+    model = make_qfat(context_len=CONTEXT_LEN, input_dim=INPUT_DIM)
+    observations = (
+        np.random.default_rng(1)
+        .standard_normal((2 * CONTEXT_LEN, INPUT_DIM))
+        .astype(np.float32)
+    )
+    sampler = AutoRegressiveSampler(model, sample_fn="gmm", use_kv_cache=True)
+    first = run_episode(sampler, observations)
+    second = run_episode(sampler, observations)  # resets the cache first
+    for params, expected_params in zip(second[1], first[1]):
+        torch.testing.assert_close(params.locs, expected_params.locs)
+
+
+def test_forward_with_cache_matches_forward_for_batches(make_qfat):
+    model = make_qfat(context_len=CONTEXT_LEN, input_dim=INPUT_DIM)
+    x = torch.randn(3, 2 * CONTEXT_LEN + 1, INPUT_DIM)
+    kv_cache = KVCache()
+    with torch.no_grad():
+        # a first chunk of several tokens, then one token per step
+        chunks = [x[:, :2]] + [x[:, t : t + 1] for t in range(2, x.size(1))]
+        t_end = 0
+        for chunk in chunks:
+            t_end += chunk.size(1)
+            out = model.forward_with_cache(Batch(x=chunk), kv_cache)
+            window = x[:, max(0, t_end - CONTEXT_LEN) : t_end]
+            expected = model(Batch(x=window)).output
+            torch.testing.assert_close(
+                out.output.locs,
+                expected.locs[:, -chunk.size(1) :],
+                atol=1e-5,
+                rtol=1e-4,
+            )
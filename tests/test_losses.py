@@ -0,0 +1,136 @@
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from qfat.datasets.dataset import Batch
+from qfat.entrypoints.training import TrainingEntrypoint
+from qfat.models.losses import gmm_nll_loss, gmm_token_nll
+from qfat.models.qfat import DiagonalGaussianMixture
+
+B, T, K, D = 4, 6, 3, 2
+VARIANCE_TOL = 1e-6
+
+
+def random_inputs(seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    gmm_out = torch.randn(B, T, K * (2 * D + 1), generator=generator)
+    y = torch.randn(B, T, D, generator=generator)
+    lengths = torch.tensor([T, 3, 0, 1])  # the third row is padding only
+    # the windows are left-padded, like `collate_policy` does
+    validity_mask = (torch.arange(T).flip(0)[None, :] < lengths[:, None]).float()
+    return gmm_out, y, validity_mask
+
+
+def reference_distribution(gmm_out: torch.Tensor) -> DiagonalGaussianMixture:
+    """Parses the raw GMM head output like `QFAT.parse_gmm_params`."""
+    locs = gmm_out[..., : K * D].unflatten(-1, (K, D))
+    mixture_probs = torch.softmax(gmm_out[..., K * D : K * D + K], dim=-1)
+    variances = F.softplus(gmm_out[..., K * D + K :]).clamp_min(VARIANCE_TOL)
+    return DiagonalGaussianMixture(mixture_probs, locs, variances.unflatten(-1, (K, D)))
+
+
+def reference_loss(gmm_out, y, validity_mask, lambda_mixtures=0.0) -> torch.Tensor:
+    distribution = reference_distribution(gmm_out)
+    neglog_prob = -distribution.log_prob(y)
+    loss = (neglog_prob * validity_mask).sum() / validity_mask.sum()
+    if lambda_mixtures != 0:
+        loss = loss + lambda_mixtures * distribution.mixture_entropy().mean()
+    return loss
+
+
+@pytest.mark.parametrize("lambda_mixtures", [0.0, 0.1])
+def test_gmm_nll_loss_and_gradients_match_distribution(lambda_mixtures):
+    gmm_out, y, validity_mask = random_inputs()
+    fused_out = gmm_out.clone().requires_grad_()
+    reference_out = gmm_out.clone().requires_grad_()
+
+    loss = gmm_nll_loss(
+        fused_out,
+        y,
+        validity_mask,
+        mixture_size=K,
+        out_dim=D,
+        variance_tol=VARIANCE_TOL,
+        lambda_mixtures=lambda_mixtures,
+    )
+    expected = reference_loss(reference_out, y, validity_mask, lambda_mixtures)
+    torch.testing.assert_close(loss, expected)
+
+    loss.backward()
+    expected.backward()
+    torch.testing.assert_close(fused_out.grad, reference_out.grad)
+    if lambda_mixtures == 0:
+        # the padding tokens, e.g the whole third row, don't contribute to the loss
+        padding = validity_mask == 0
+        assert torch.all(fused_out.grad[padding] == 0)
+
+
+def test_gmm_nll_loss_without_mask_averages_all_tokens():
+    gmm_out, y, _ = random_inputs()
+    loss = gmm_nll_loss(gmm_out, y, None, mixture_size=K, out_dim=D)
+    expected = -reference_distribution(gmm_out).log_prob(y).mean()
+    torch.testing.assert_close(loss, expected)
+
+
+def test_gmm_token_nll_matches_distribution():
+    gmm_out, y, _ = random_inputs()
+    nll = gmm_token_nll(gmm_out, y, mixture_size=K, out_dim=D)
+    assert nll.shape == (B, T)
+    torch.testing.assert_close(nll, -reference_distribution(gmm_out).log_prob(y))
+
+
+def test_qfat_loss_and_gradients_match_distribution(make_qfat):
+    model = make_qfat(out_dim=D, mixture_size=K, context_len=T, lambda_mixtures=0.1)
+    model.train()
+    _, y, validity_mask = random_inputs()
+    batch = Batch(x=torch.randn(B, T, 5), y=y, validity_mask=validity_mask)
+    params = [p for p in model.parameters() if p.requires_grad]
+
+    out = model(batch)
+    grads = torch.autograd.grad(out.loss, params, retain_graph=True)
+    expected = model.compute_loss(out.output, y, validity_mask)
+    expected_grads = torch.autograd.grad(expected, params)
+
+    torch.testing.assert_close(out.loss, expected)
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
+
+
+def test_token_weighted_val_loss_averages_over_valid_tokens(make_qfat):
+    model = make_qfat(out_dim=D, mixture_size=K, context_len=T)
+    batches = []
+    # the batches hold different numbers of valid tokens
+    for seed, n_rows in enumerate([2, 3, 4]):
+        _, y, validity_mask = random_inputs(seed)
+        batches.append(
+            Batch(
+                x=torch.randn(n_rows, T, 5),
+                y=y[:n_rows],
+                validity_mask=validity_mask[:n_rows],
+            )
+        )
+
+    with torch.no_grad():
+        batch_nlls = [
+            -model.get_distribution(model(b).output).log_prob(b.y)[
+                b.validity_mask.bool()
+            ]
+            for b in batches
+        ]
+        trainer = object.__new__(TrainingEntrypoint)
+        trainer.model = model
+        trainer.val_loader = batches
+        trainer.cfg = SimpleNamespace(device="cpu")
+        trainer.loss_scaling = 1.0
+        trainer._autocast = contextlib.nullcontext
+        val_loss = trainer._compute_val_loss()
+
+    nll = torch.cat(batch_nlls)
+    assert trainer.val_metrics["val/n_tokens"] == nll.numel()
+    assert val_loss == pytest.approx(nll.mean().item(), rel=1e-5)
+    # weighting every batch equally would differ, since their token counts differ
+    batch_means = torch.stack([batch_nll.mean() for batch_nll in batch_nlls])
+    assert val_loss != pytest.approx(batch_means.mean().item(), rel=1e-5)
@@ -0,0 +1,117 @@
+import pytest
+import torch
+
+from qfat.models.mode_search import (
+    find_gmm_modes,
+    gmm_grad_and_hessian_logp,
+    gmm_log_prob,
+    merge_close_modes,
+)
+
+
+def separated_mixtures():
+    """Two mixtures of well separated components, the second padded with a zero probability."""
+    means = torch.tensor(
+        [
+            [[-5.0, 0.0], [0.0, 5.0], [5.0, 0.0]],
+            [[0.0, 0.0], [6.0, 6.0], [0.0, 0.0]],
+        ]
+    )
+    variances = torch.tensor(
+        [
+            [[0.5, 0.5], [0.3, 0.6], [0.4, 0.2]],
+            [[0.5, 0.5], [0.5, 0.5], [1.0, 1.0]],
+        ]
+    )
+    probs = torch.tensor([[0.2, 0.5, 0.3], [0.6, 0.4, 0.0]])
+    return probs, means, variances
+
+
+def valid_modes(gmm_modes, row: int) -> torch.Tensor:
+    return gmm_modes.modes[row, gmm_modes.valid[row]]
+
+
+def assert_same_points(points: torch.Tensor, expected: torch.Tensor, atol: float):
+    assert len(points) == len(expected)
+    for point in expected:
+        assert (points - point).norm(dim=-1).min() < atol, f"{point} not in {points}"
+
+
+@pytest.mark.parametrize("n_newton_steps", [0, 2])
+def test_modes_of_separated_components_are_their_means(n_newton_steps):
+    torch.manual_seed(0)
+    probs, means, variances = separated_mixtures()
+    gmm_modes = find_gmm_modes(
+        probs, means, variances, n_newton_steps=n_newton_steps, min_diff=1e-4
+    )
+    assert_same_points(valid_modes(gmm_modes, 0), means[0], atol=1e-3)
+    assert_same_points(valid_modes(gmm_modes, 1), means[1, :2], atol=1e-3)
+
+
+def test_unimodal_close_components_give_a_single_mode():
+    torch.manual_seed(0)
+    # the first two components are much closer than their widths, i.e share a single mode
+    means = torch.tensor([[[0.0, 0.0], [0.05, 0.0], [8.0, 8.0]]])
+    variances = torch.ones(1, 3, 2)
+    probs = torch.tensor([[0.4, 0.4, 0.2]])
+    gmm_modes = find_gmm_modes(probs, means, variances, min_diff=1e-4)
+    assert_same_points(
+        valid_modes(gmm_modes, 0),
+        torch.tensor([[0.025, 0.0], [8.0, 8.0]]),
+        atol=1e-3,
+    )
+
+
+def test_modes_closer_than_the_merge_radius_are_merged():
+    torch.manual_seed(0)
+    # narrow components, i.e two distinct modes 0.1 apart, and a third far away
+    means = torch.tensor([[[0.0, 0.0], [0.1, 0.0], [8.0, 8.0]]])
+    variances = torch.tensor([[[1e-4, 1e-4], [1e-4, 1e-4], [1.0, 1.0]]])
+    probs = torch.tensor([[0.3, 0.5, 0.2]])
+
+    gmm_modes = find_gmm_modes(probs, means, variances, min_diff=1e-4)
+    assert_same_points(valid_modes(gmm_modes, 0), means[0], atol=1e-3)
+
+    # a merge radius above their (squared) distance of 1e-2 keeps the most likely one only
+    gmm_modes = find_gmm_modes(probs, means, variances, min_diff=5e-2)
+    assert_same_points(valid_modes(gmm_modes, 0), means[0, 1:], atol=1e-3)
+
+
+def test_merge_close_modes_keeps_the_most_likely_candidate():
+    modes = torch.tensor([[[0.0, 0.0], [0.001, 0.0], [3.0, 0.0], [3.0, 0.001]]])
+    log_likelihoods = torch.tensor([[-2.0, -1.0, -3.0, -4.0]])
+    candidates = torch.tensor([[True, True, True, False]])
+    kept = merge_close_modes(modes, log_likelihoods, candidates, min_diff=1e-4)
+    # the second candidate is more likely than the first, the last one is not a candidate
+    assert kept.tolist() == [[False, True, True, False]]
+    # below the merge radius, nothing is merged
+    kept = merge_close_modes(modes, log_likelihoods, candidates, min_diff=1e-8)
+    assert kept.tolist() == [[True, True, True, False]]
+
+
+def test_grad_and_hessian_match_autograd():
+    torch.manual_seed(0)
+    probs = torch.softmax(torch.randn(2, 3), dim=-1)
+    means = torch.randn(2, 3, 2)
+    variances = torch.rand(2, 3, 2) + 0.2
+    x = torch.randn(2, 4, 2)
+    grads, hessians = gmm_grad_and_hessian_logp(x, probs, means, variances)
+
+    for b in range(2):
+        for m in range(4):
+
+            def log_p(point):
+                return gmm_log_prob(
+                    point[None, None],
+                    probs[b : b + 1],
+                    means[b : b + 1],
+                    variances[b : b + 1],
+                ).squeeze()
+
+            point = x[b, m]
+            torch.testing.assert_close(
+                grads[b, m], torch.autograd.functional.jacobian(log_p, point)
+            )
+            torch.testing.assert_close(
+                hessians[b, m], torch.autograd.functional.hessian(log_p, point)
+            )
@@ -0,0 +1,57 @@
+from typing import List
+
+import numpy as np
+import pytest
+import torch
+
+from qfat.datasets.dataset import Trajectory, TrajectoryDataset, collate_policy
+from qfat.datasets.slicer import SlicedTrajectoryDataset
+
+
+class RandomTrajectoryDataset(TrajectoryDataset):
+    def __init__(self, lengths: List[int], include_goals: bool = True) -> None:
+        super().__init__()
+        rng = np.random.default_rng(0)
+        self._include_goals = include_goals
+        self._trajectories = [
+            Trajectory(
+                states=rng.standard_normal((T, 3)).astype(np.float32),
+                actions=rng.standard_normal((T, 2)).astype(np.float32),
+                prev_actions=rng.standard_normal((T, 2)).astype(np.float32),
+                goals=rng.standard_normal((T, 4)).astype(np.float32)
+                if include_goals
+                else None,
+            )
+            for T in lengths
+        ]
+
+    @property
+    def trajectories(self) -> List[Trajectory]:
+        return self._trajectories
+
+    @property
+    def include_goals(self) -> bool:
+        return self._include_goals
+
+
+@pytest.mark.parametrize("action_horizon", [0, 2])
+@pytest.mark.parametrize("include_goals", [False, True])
+def test_get_batch_matches_collated_windows(action_horizon, include_goals):
+    dataset = SlicedTrajectoryDataset(
+        RandomTrajectoryDataset([9, 4, 15], include_goals=include_goals),
+        window=5,
+        action_horizon=action_horizon,
+        future_seq_len=2 if include_goals else 0,
+        only_sample_tail=True,  # deterministic goals
+    )
+    # windows of different lengths, several per trajectory, in a shuffled order
+    indices = np.random.default_rng(0).permutation(len(dataset))[:12].tolist()
+
+    batch = dataset.get_batch(indices)
+    expected = collate_policy([dataset[idx] for idx in indices])
+    for name in ["x", "y", "prev_actions", "validity_mask", "conditional_seq"]:
+        value, expected_value = getattr(batch, name), getattr(expected, name)
+        if expected_value is None:
+            assert value is None, name
+        else:
+            torch.testing.assert_close(value, expected_value, msg=name)